@@ -0,0 +1,180 @@
+#!/usr/bin/env python3.2
+#
+# Copyright (c) Net24 Limited, Christchurch, New Zealand 2011-2012
+#       and     Voyager Internet Ltd, New Zealand, 2012-2013
+#
+#    This file is part of py-magcode-core.
+#
+#    Py-magcode-core is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU  General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Py-magcode-core is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU  General Public License for more details.
+#
+#    You should have received a copy of the GNU  General Public License
+#    along with py-magcode-core.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Benchmark for the dmsdmd partitioned event queue
+
+Runs fake zone publish events through a DmsEventQueue against a local stub
+name server.  Not used by dmsdmd itself.
+
+Benchmark by using:   from dms.app.dms_test_event_queue import *
+                      benchmark_event_partitions()
+"""
+
+
+import time
+import struct
+import threading
+import socketserver
+
+import dns.message
+import dns.query
+import dns.update
+
+from magcode.core.globals_ import *
+from magcode.core.database import *
+from dms.event_queue import DmsEventQueue
+
+
+class _StubDNSHandler(socketserver.BaseRequestHandler):
+    """
+    Stub name server TCP handler.  Answers everything with NOERROR after
+    a delay to simulate the time named takes to process an update.
+    """
+    def handle(self):
+        sock = self.request
+        while True:
+            data = sock.recv(2)
+            if len(data) < 2:
+                return
+            (length,) = struct.unpack('!H', data)
+            wire = b''
+            while len(wire) < length:
+                chunk = sock.recv(length - len(wire))
+                if not chunk:
+                    return
+                wire += chunk
+            query = dns.message.from_wire(wire)
+            time.sleep(self.server.latency)
+            wire = dns.message.make_response(query).to_wire()
+            sock.sendall(struct.pack('!H', len(wire)) + wire)
+
+
+class _StubDNSServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _BenchmarkSession(object):
+    """
+    Stand in DB session for benchmarking.  Benchmark events are not in
+    the database.
+    """
+    def merge(self, event):
+        return event
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class _BenchmarkSessionClass(object):
+    """
+    Stand in scoped session class for benchmarking
+    """
+    def __call__(self):
+        return _BenchmarkSession()
+
+    def remove(self):
+        pass
+
+
+class _BenchmarkEvent(object):
+    """
+    Fake zone publish event, for benchmarking.  Does an SOA query and an
+    update round trip to the stub name server, and records the order
+    events are processed in for each zone.
+    """
+    def __init__(self, id_, zone_id, port, record):
+        self.id_ = id_
+        self.zone_id = zone_id
+        self.server_id = None
+        self.master_id = None
+        self.port = port
+        self.record = record
+
+    def _process_wrapper(self, db_session):
+        processed, active, errors, lock = self.record
+        with lock:
+            if self.zone_id in active:
+                errors.append(self.id_)
+            active.add(self.zone_id)
+        zone = 'zone%s.example.' % self.zone_id
+        query = dns.message.make_query(zone, 'SOA')
+        dns.query.tcp(query, '127.0.0.1', port=self.port)
+        update = dns.update.Update(zone)
+        update.add('www', 3600, 'A', '192.0.2.1')
+        dns.query.tcp(update, '127.0.0.1', port=self.port)
+        with lock:
+            active.discard(self.zone_id)
+            processed.setdefault(self.zone_id, []).append(self.id_)
+
+
+def benchmark_event_partitions(workers=(1, 2, 4, 8), zones=200,
+        events_per_zone=2, latency=0.02):
+    """
+    Print publish throughput of a DmsEventQueue against number of workers,
+    using a local stub name server.  Checks that the events for each zone
+    are processed in order, and never on two workers at once.
+    """
+    # Benchmark events are not in the database, and are all queued at
+    # once
+    saved_session_class = sql_data.get('scoped_session_class')
+    saved_maxsize = settings['event_queue_maxsize']
+    sql_data['scoped_session_class'] = _BenchmarkSessionClass()
+    settings['event_queue_maxsize'] = 0
+    server = _StubDNSServer(('127.0.0.1', 0), _StubDNSHandler)
+    server.latency = latency
+    port = server.server_address[1]
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    try:
+        for count in workers:
+            processed = {}
+            errors = []
+            record = (processed, set(), errors, threading.Lock())
+            events = [_BenchmarkEvent(i * zones + z, z, port, record)
+                            for i in range(events_per_zone)
+                            for z in range(zones)]
+            event_queue = DmsEventQueue(threads=count)
+            start = time.time()
+            for event in events:
+                event_queue.get_partition(event).put(event)
+            event_queue.join()
+            elapsed = time.time() - start
+            for zone_id in range(zones):
+                event_ids = processed.get(zone_id, [])
+                if (event_ids != sorted(event_ids)
+                        or len(event_ids) != events_per_zone):
+                    errors.append(zone_id)
+            print('%3s workers: %8.3f s - %8.1f events/s, %s out of order'
+                    % (count, elapsed, len(events)/elapsed, len(errors)))
+    finally:
+        server.shutdown()
+        server.server_close()
+        sql_data['scoped_session_class'] = saved_session_class
+        settings['event_queue_maxsize'] = saved_maxsize
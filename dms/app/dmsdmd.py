@@ -41,7 +41,6 @@ from magcode.core.process import ProcessDaemon
 from magcode.core.process import SignalHandler
 from magcode.core.globals_ import *
 from magcode.core.database import *
-from magcode.core.database.event import EventQueue
 from magcode.core.utility import get_numeric_setting
 from magcode.core.utility import get_boolean_setting
 # import to pull in and init ProcessSM
@@ -54,6 +53,7 @@ from dms.database.server_sm import init_soaquery_rcodes
 # import to fully init settings for config file DEFAULT section
 from dms.globals_ import update_engine
 from dms.dyndns_update import DynDNSUpdate
+from dms.event_queue import DmsEventQueue
 from dms.exceptions import DynDNSCantReadKeyError
 
 USAGE_MESSAGE = "Usage: %s [-dhv] [-c config_file]"
@@ -240,8 +240,8 @@ class DmsDMDProcess(ProcessDaemon):
         # Initialize master DNS server data
         self.init_master_dns_server_data()
 
-        # Create a queue
-        event_queue = EventQueue()
+        # Create a queue, with events partitioned by zone over worker threads
+        event_queue = DmsEventQueue()
 
         # Create a Process object so that we can check in on ourself resource
         # wise
@@ -35,7 +35,9 @@ import cmd
 import re
 import errno
 import signal
+import multiprocessing
 import time
+from collections import deque
 import shlex
 import grp
 import pwd
@@ -66,6 +68,7 @@ from magcode.core.process import SignalBusiness
 from magcode.core.process import SignalHandler
 from magcode.core.globals_ import *
 from magcode.core.database import *
+from magcode.core.utility import get_numeric_setting
 from magcode.core.database.event import ESTATE_NEW
 from magcode.core.database.event import ESTATE_RETRY
 from dms.globals_ import *
@@ -76,6 +79,7 @@ from dms.cmdline_engine import server_types
 from dms.cmdline_engine import tsig_key_algorithms
 from dms.zone_text_util import data_to_bind
 from dms.zone_text_util import bind_to_data
+from dms.zone_text_util import bind_to_data_stream
 from dms.database import zone_cfg
 from dms.database.server_sm import SSTATE_OK
 from dms.database.server_sm import SSTATE_CONFIG
@@ -794,6 +798,22 @@ def arg_zi_max_num(zi_max_num, **kwargs):
         return None
     return {'zi_max_num': zi_max_num}
 
+def arg_workers(workers, **kwargs):
+    """
+    Process a <workers>
+    """
+    try:
+        workers = int(workers)
+    except ValueError:
+        print(ERROR_PREFIX + "<workers> can only contain digits.",
+                file=_stdout)
+        return None
+    if workers < 0:
+        print(ERROR_PREFIX + "<workers> cannot be less than 0.", 
+                file=_stdout)
+        return None
+    return {'load_zones_workers': workers}
+
 def arg_hmac_type(hmac_type, **kwargs):
     """
     Process an HMAC name
@@ -817,11 +837,11 @@ def arg_no_rndc(no_rndc, **kwargs):
 
 # Arguments processed by cmdline handler 
 # set these up same as commandline args below which set settings keys 
-short_args = "aofg:ijn:pr:tuvz:"
+short_args = "aofg:ijn:pr:tuvw:z:"
 long_args = ["force", "use-origin-as-name", "server-group=", "sg=", 
         "reference=", "ref=", "verbose", "show-all", "show-active", "zone=",
         "domain=", "zi=", "replica-sg", "inc-updates", "oping-servers",
-        'soa-serial-update']
+        'soa-serial-update', 'workers=']
 
 def parse_getopt(args):
     """
@@ -874,6 +894,11 @@ def parse_getopt(args):
             if not result:
                 raise DoNothing()
             switch_dict.update(result)
+        elif o in ('-w', '--workers'):
+            result = arg_workers(a)
+            if not result:
+                raise DoNothing()
+            switch_dict.update(result)
         else:
             raise DoHelp()
     return args_left
@@ -901,6 +926,52 @@ def parse_line(syntax_list, line):
         arg_dict.update(arg)
     return arg_dict
 
+def _load_zones_worker_init():
+    """
+    Set up a load_zones parsing worker process.  Leave SIGINT to the
+    main process, which shuts the worker pool down.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _load_zones_parse(args):
+    """
+    Parse a zone file for load_zones in a worker process.
+
+    Returns None if the zone file does not parse, and the file is then
+    parsed again in the main process to report the error exactly as
+    before.  Zone files over 'load_zones_worker_max_size' bytes are also
+    left to the main process, which streams them.
+    """
+    file_name, name, use_origin_as_name = args
+    try:
+        # Leave big zone files to be streamed by the main process
+        if (os.path.getsize(file_name)
+                > get_numeric_setting('load_zones_worker_max_size', int)):
+            return None
+        return bind_to_data(file_name, name, use_origin_as_name)
+    except Exception:
+        return None
+
+def _iter_load_zones_parse(pool, tasks, window):
+    """
+    Parse zone files in the worker pool, in order, keeping no more than
+    window files outstanding.  Parsed zones are only handed over as the
+    zones are created in the DB, so memory use does not grow with the
+    number of zone files.
+    """
+    pending = deque()
+    tasks = iter(tasks)
+    for task in tasks:
+        pending.append(pool.apply_async(_load_zones_parse, (task,)))
+        if len(pending) >= window:
+            break
+    while pending:
+        result = pending.popleft().get()
+        for task in tasks:
+            pending.append(pool.apply_async(_load_zones_parse, (task,)))
+            break
+        yield result
+
 class ZoneToolCmd(cmd.Cmd, SystemEditorPager):
     """
     Command processor environment for zone_tool
@@ -1158,6 +1229,18 @@ class ZoneToolCmd(cmd.Cmd, SystemEditorPager):
             return settings['inc_updates_flag']
         return False
 
+    def get_load_zones_workers(self):
+        """
+        Determine number of load_zones parsing worker processes
+        """
+        global switch_dict
+        workers = switch_dict.get('load_zones_workers')
+        if workers is None:
+            workers = get_numeric_setting('load_zones_workers', int)
+        if not workers:
+            workers = multiprocessing.cpu_count()
+        return workers
+
     def get_verbose(self):
         """
         Determine verbose output or not
@@ -2802,7 +2885,7 @@ class ZoneToolCmd(cmd.Cmd, SystemEditorPager):
             file_name = arg_dict.pop('file_name')
             name = arg_dict.get('name')
             arg_dict['zi_data'], origin_name, update_type, zone_reference \
-                            = bind_to_data(file_name, name)
+                            = bind_to_data_stream(file_name, name)
             if not arg_dict.get('reference'):
                 arg_dict['reference'] = zone_reference
             arg_dict['login_id'] = self.login_id
@@ -2879,6 +2962,8 @@ class ZoneToolCmd(cmd.Cmd, SystemEditorPager):
                 -g <sg-name>: specify an SG name other than default_sg
                 -i:            set inc_updates flag on the new zone
                 -r reference:  set reference
+                -w <workers>:  number of zone file parsing processes,
+                               0 for one per CPU
 
         CAREFUL: If $ORIGIN is not in the files, the basename of the 
                  file-name is used as the domain name
@@ -2940,12 +3025,60 @@ class ZoneToolCmd(cmd.Cmd, SystemEditorPager):
         if not self.check_or_force():
             self.exit_code = os.EX_TEMPFAIL
             return
-        for arg_pair in args_list:
+        # Parse zone files in a pool of worker processes, while zones are
+        # created here one at a time.  Files that don't parse in a worker 
+        # are parsed again below to report the error.
+        use_origin_as_name = self.get_use_origin_as_name()
+        workers = self.get_load_zones_workers()
+        pool = None
+        if workers > 1 and len(args_list) > 1:
+            pool = multiprocessing.Pool(workers, _load_zones_worker_init)
+            parse_results = _iter_load_zones_parse(pool,
+                    ((arg_pair['file_name'], arg_pair['name'], 
+                        use_origin_as_name) for arg_pair in args_list),
+                    workers * 2)
+        else:
+            workers = 1
+            parse_results = [None for arg_pair in args_list]
+        start_time = time.time()
+        try:
+            zones_loaded = self._load_zones(args_list, parse_results, 
+                                    seed_arg_dict, use_origin_as_name)
+        except KeyboardInterrupt:
+            self.exit_code = os.EX_TEMPFAIL
+            return
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+        if zones_loaded is None:
+            return
+        elapsed = time.time() - start_time
+        print("Loaded %s of %s zone files in %.1f seconds, %.1f zones/second,"
+                " %s parsing worker(s)." 
+                % (zones_loaded, len(args_list), elapsed,
+                    zones_loaded / elapsed if elapsed else 0.0, workers),
+                file=self.stdout)
+        return
+
+    def _load_zones(self, args_list, parse_results, seed_arg_dict,
+            use_origin_as_name):
+        """
+        Create zones from parsed zone files, for do_load_zones().  Zone
+        files without a parse result are parsed here.
+
+        Returns number of zones loaded, or None if loading was stopped.
+        """
+        zones_loaded = 0
+        for arg_pair, parse_result in zip(args_list, parse_results):
             try:
-                zi_data, name, update_type, zone_reference \
-                        = bind_to_data(arg_pair['file_name'], 
+                if parse_result:
+                    zi_data, name, update_type, zone_reference = parse_result
+                else:
+                    zi_data, name, update_type, zone_reference \
+                        = bind_to_data_stream(arg_pair['file_name'], 
                                     arg_pair['name'], 
-                                    self.get_use_origin_as_name())
+                                    use_origin_as_name)
                 if name.find('.') < 0:
                     msg = ("%s: zone name must have '.' in it!" 
                             % arg_pair['file_name'])
@@ -2958,6 +3091,7 @@ class ZoneToolCmd(cmd.Cmd, SystemEditorPager):
                     arg_dict['reference'] = zone_reference
                 arg_dict['login_id'] = self.login_id
                 load_results = engine.create_zone_batch(**arg_dict)
+                zones_loaded += 1
             except (ParseBaseException, ZoneParseError,
                 ZoneHasNoSOARecord, ZiParseError, SOASerialError) as exc:
                 # Must not commit changes to DB when cleaning up!
@@ -3035,7 +3169,7 @@ class ZoneToolCmd(cmd.Cmd, SystemEditorPager):
             except KeyboardInterrupt:
                 self.exit_code = os.EX_TEMPFAIL
                 return
-        return
+        return zones_loaded
 
     def do_load_zone_zi(self, line):
         """
@@ -3070,7 +3204,7 @@ class ZoneToolCmd(cmd.Cmd, SystemEditorPager):
             file_name = arg_dict.pop('file_name')
             name = arg_dict.get('name')
             arg_dict['zi_data'], origin_name, update_type, zone_reference \
-                                = bind_to_data(file_name, name)
+                                = bind_to_data_stream(file_name, name)
             # Use normalize_ttls with imported data to stop surprises
             arg_dict['normalize_ttls'] = True
             arg_dict['login_id'] = self.login_id
@@ -4717,6 +4851,43 @@ class ZoneToolCmd(cmd.Cmd, SystemEditorPager):
             print(result_msg_wrapper.fill(msg), file=self.stdout)
         return
 
+    def do_fill_rr_hashes(self, line):
+        """
+        Fill in RR hashes of RRs in the DB
+
+        fill_rr_hashes [-v]
+
+        Computes the rr_hash of RRs written before the rr_hash column was
+        added to the resource_records table by sql/rr_hash.sql.  New RRs get
+        their hashes when they are written, and ZI copies take the hashes of
+        the RRs they are copied from.  Only needs to be run once.
+        """
+        syntax = ((),)
+        try:
+            arg_dict = parse_line(syntax, line)
+        except DoHelp:
+            self.do_help('fill_rr_hashes')
+            self.exit_code = os.EX_USAGE
+            return
+        except DoNothing:
+            self.exit_code = os.EX_USAGE
+            return
+        try:
+            result = engine.fill_rr_hashes(**arg_dict)
+        except RRHashColumnMissing as exc:
+            self.exit_code = os.EX_DATAERR
+            msg = str(exc)
+            print(error_msg_wrapper.fill(msg), file=self.stdout)
+            return
+        if result['num_failed']:
+            msg = ("RRs that could not be hashed: %s" 
+                    % result['num_failed'])
+            print(error_msg_wrapper.fill(msg), file=self.stdout)
+        if self.get_verbose():
+            msg = "RR hashes filled in: %s" % result['num_filled']
+            print(result_msg_wrapper.fill(msg), file=self.stdout)
+        return
+
     def _oping_servers(self, server_list):
         """
         OPing a list of servers, and stuff info back into server_list
@@ -5616,21 +5787,17 @@ class ZoneToolCmd(cmd.Cmd, SystemEditorPager):
         (z1_fd, z1_filename) = tempfile.mkstemp(
                                         prefix=settings['process_name']
                                         + '-', suffix='.zone')
-        z1_file = io.open(z1_fd, mode='wt')
         data_to_bind(zi1_data, name=z1_name, 
                 reference=z1_reference, no_info_header=no_info_header,
-                file=z1_file)
-        z1_file.flush()
-        z1_file.close()
+                file=z1_fd)
+        os.close(z1_fd)
         (z2_fd, z2_filename) = tempfile.mkstemp(
                                         prefix=settings['process_name']
                                         + '-', suffix='.zone')
-        z2_file = io.open(z2_fd, mode='wt')
         data_to_bind(zi2_data, name=z2_name, 
                 reference=z2_reference, no_info_header=no_info_header,
-                file=z2_file)
-        z2_file.flush()
-        z2_file.close()
+                file=z2_fd)
+        os.close(z2_fd)
 
         # do diff
         diff_bin = self.get_diff()
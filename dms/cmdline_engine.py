@@ -38,6 +38,8 @@ from subprocess import CalledProcessError
 from subprocess import STDOUT
 from base64 import b64encode
 
+import dns.exception
+
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.orm.exc import MultipleResultsFound
 from sqlalchemy.sql import or_
@@ -74,6 +76,7 @@ from dms.database.zone_sm import ZoneSMDoRefresh
 from dms.database.zone_sm import ZoneSMNukeStart
 from dms.database.zone_sm import ZoneSMDoDestroy
 from dms.database.zone_sm import ZoneSMDoReset
+from dms.database.reverse_network import reverse_networks_changed
 from dms.database.server_group import ServerGroup
 from dms.exceptions import ZoneNotFound
 from dms.exceptions import ZiNotFound
@@ -89,6 +92,7 @@ from dms.database.master_sm import reconfig_master
 from dms.database.master_sm import get_master_sm
 from dms.database.master_sm import get_mastersm_replica_sg
 from dms.database.zone_instance import ZoneInstance
+from dms.database.resource_record import ResourceRecord
 from dms.database.sg_utility import find_sg_byname
 from dms.database.sg_utility import find_sg_byid
 from dms.database.sg_utility import list_all_sgs
@@ -560,6 +564,7 @@ class CmdLineEngine(ZoneEngine):
                 continue
             db_session.delete(zone_sm)
             db_session.commit()
+            reverse_networks_changed()
             count += 1
                     
         # Finally do zone_sm destroy operation to 
@@ -671,6 +676,45 @@ class CmdLineEngine(ZoneEngine):
         self._finish_op()
         return result
 
+    def fill_rr_hashes(self):
+        """
+        Fill in the hashes of RRs written before the rr_hash column was
+        added to the DB
+        """
+        self._begin_op()
+        if not hasattr(ResourceRecord, 'rr_hash'):
+            raise RRHashColumnMissing()
+        db_session = self.db_session
+        db_query_slice = get_numeric_setting('db_query_slice', int)
+        count = 0
+        num_failed = 0
+        last_id = 0
+        while True:
+            # Blank rdata RRs can't be loaded, and have no hash anyway
+            rrs = db_session.query(ResourceRecord)\
+                    .filter(ResourceRecord.rr_hash == None)\
+                    .filter(ResourceRecord.rdata != None)\
+                    .filter(ResourceRecord.rdata != '')\
+                    .filter(ResourceRecord.id_ > last_id)\
+                    .order_by(ResourceRecord.id_)\
+                    .limit(db_query_slice).all()
+            if not rrs:
+                break
+            for rr in rrs:
+                last_id = rr.id_
+                try:
+                    rr.rr_hash = rr.get_rr_hash()
+                except (dns.exception.DNSException, DMSError, ValueError):
+                    num_failed += 1
+                    continue
+                count += 1
+            # Commit each slice as we go, as there can be a lot of RRs
+            db_session.commit()
+
+        result = {'num_filled': count, 'num_failed': num_failed}
+        self._finish_op()
+        return result
+
     def vacuum_syslog (self, age_days=None):
         """
         Destroy syslog messages received more than age_days ago
@@ -27,6 +27,7 @@ from sqlalchemy.orm import relationship
 from sqlalchemy.orm import backref
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.orm.exc import MultipleResultsFound
+from sqlalchemy.sql import text
 
 from magcode.core.database import *
 from dms.exceptions import ReferenceExists
@@ -34,6 +35,17 @@ from dms.exceptions import ReferenceDoesNotExist
 from dms.exceptions import ReferenceStillUsed
 from dms.exceptions import MultipleReferencesFound
 from dms.exceptions import NoReferenceFound
+from dms.zi_render_cache import zi_render_cache
+
+
+# Touch the mtime of the ZIs with RRs tagged with a reference, so that
+# rendered ZI data cached against the ZI mtime in other processes is
+# not used after the reference is renamed
+_touch_reference_zis_sql = text("""
+UPDATE zone_instances SET mtime = now()
+    WHERE id IN (SELECT DISTINCT zi_id FROM resource_records
+                    WHERE ref_id = :ref_id)
+""")
 
 
 @saregister
@@ -186,4 +198,11 @@ def rename_reference(db_session, reference, dst_reference):
         pass
     ref_obj.reference = dst_reference
     db_session.flush()
+    # RR reference names are in rendered ZI data
+    db_session.execute(_touch_reference_zis_sql, {'ref_id': ref_obj.id_})
+    zone_instance_type = sql_types['ZoneInstance']
+    for obj in list(db_session.identity_map.values()):
+        if isinstance(obj, zone_instance_type):
+            db_session.expire(obj, ['mtime'])
+    zi_render_cache.clear()
     return ref_obj
@@ -20,6 +20,8 @@
 #
 
 import re
+import struct
+import hashlib
 
 import dns
 import dns.name
@@ -66,6 +68,9 @@ class ResourceRecord(object):
    
     _rr_class = RRCLASS_IN
     _rr_type = RRTYPE_NULL
+    # dnspython [label, ttl, rdata] list, built on first use when loaded
+    # from the DB
+    _dnspython_rr = None
 
     @classmethod
     def sa_map_subclass(class_):
@@ -158,6 +163,7 @@ class ResourceRecord(object):
             # relativize rdata according to domain via dnspython
             if self.dnspython_rr[2]:
                 self.rdata = str(self.dnspython_rr[2])
+        self.rr_hash = self.get_rr_hash()
     
     def _get_dnspython_ttl(self):
         if (self.ttl is not None):
@@ -193,31 +199,87 @@ class ResourceRecord(object):
             rdata = None
         self.dnspython_rr = [label, ttl, rdata]
 
+    def _get_dnspython_rr(self):
+        """
+        Return dnspython rdata, building it from rdata if needed
+        """
+        if self._dnspython_rr is None:
+            self._dnspython_from_rdata()
+        return self._dnspython_rr
+
+    def _set_dnspython_rr(self, dnspython_rr):
+        self._dnspython_rr = dnspython_rr
+
+    dnspython_rr = property(_get_dnspython_rr, _set_dnspython_rr)
+
+    def get_rr_hash(self):
+        """
+        Return canonical hash of label, class, type and rdata as a hex
+        string, or None if there is no rdata.
+
+        TTL is not included.  Names in rdata are hashed in canonical wire
+        form as dnspython compares them, so RRs with the same hash have
+        equal dnspython label and rdata.
+        """
+        label, ttl, rdata = self.dnspython_rr
+        if rdata is None:
+            return None
+        rr_hash = hashlib.sha1(label.canonicalize().to_text().encode('utf-8'))
+        rr_hash.update(struct.pack('!BHH', 0, rdata.rdclass, rdata.rdtype))
+        rr_hash.update(rdata.to_digestable(dns.name.root))
+        return rr_hash.hexdigest()
+
+    def same_rdata(self, other):
+        """
+        Compare rdata of 2 RRs of the same label and type.  Uses the RR
+        hashes if both RRs have them, to save building dnspython rdata.
+        """
+        rr_hash = getattr(self, 'rr_hash', None)
+        other_hash = getattr(other, 'rr_hash', None)
+        if rr_hash is not None and other_hash is not None:
+            return rr_hash == other_hash
+        return self.dnspython_rr[2] == other.dnspython_rr[2]
+
+    def get_dnspython_label(self):
+        """
+        Return the dnspython label, without building the dnspython rdata
+        """
+        if self._dnspython_rr is not None:
+            return self._dnspython_rr[0]
+        return dns.name.from_text(self.label, dns.name.empty)
+
     @reconstructor
     def rr_reconstructor(self):
         """
-        Reconstruct dnspython rdata and rdata_dict from rdata,
-        when loading from SQLAlchemy
+        Initialise when loading from SQLAlchemy.  dnspython rdata is
+        reconstructed from rdata on first use, as read only operations
+        mostly never need it.
         """
         # Close hole in error handling - these are the only
         # times when rdata can be blank
         if (not self.rdata and self.type_ != RRTYPE_ANY and 
                 self.update_op != RROP_DELETE):
             raise ValueError("RR(%s) - rdata must not be blank" % self.id_)
-        # Complete initialisation from sqlalchemy
-        self._dnspython_from_rdata()
+        self._dnspython_rr = None
 
     def __eq__(self, other):
         """
-        Compare rdata records for equality
+        Compare rdata records for equality.  Uses the RR hashes if both
+        RRs have them, to save building dnspython rdata.
         """
+        rr_hash = getattr(self, 'rr_hash', None)
+        other_hash = getattr(other, 'rr_hash', None)
+        if rr_hash is not None and other_hash is not None:
+            return (rr_hash == other_hash
+                    and self._get_dnspython_ttl() 
+                            == other._get_dnspython_ttl())
         return self.dnspython_rr == other.dnspython_rr
 
     def __ne__(self, other):
         """
         Compare rdata records for inequality
         """
-        return self.dnspython_rr != other.dnspython_rr
+        return not self.__eq__(other)
 
     def __lt__(self, other):
         """
@@ -247,8 +309,8 @@ class ResourceRecord(object):
         """
         Common code between __repr__ and __str__
         """
-        if self.dnspython_rr[2]:
-            rdata = self.dnspython_rr[2].__str__()
+        if self._dnspython_rr is not None and self._dnspython_rr[2]:
+            rdata = self._dnspython_rr[2].__str__()
         elif self.rdata:
             rdata = self.rdata
         else:
@@ -292,6 +354,9 @@ class ResourceRecord(object):
     to_engine = to_engine_brief
 
     def _update_dnspython_ttl(self):
+            if self._dnspython_rr is None:
+                # Picked up when dnspython rdata is built
+                return
             if self.ttl:
                 self.dnspython_rr[1] = dns.ttl.from_text(self.ttl)
             else:
@@ -342,6 +407,7 @@ class RR_SOA(ResourceRecord):
     def update_serial(self, serial):
         self.dnspython_rr[2].serial = serial
         self.rdata = str(self.dnspython_rr[2])
+        self.rr_hash = self.get_rr_hash()
 
     def get_serial(self):
         serial = self.dnspython_rr[2].serial
@@ -23,9 +23,19 @@ Reverse Net table
 """
 
 
+import socket
+import threading
+import time
+import weakref
+
 from sqlalchemy.orm import relationship
+from sqlalchemy.sql import func
+from sqlalchemy.sql import text
 
 from magcode.core.database import *
+from magcode.core.utility import get_numeric_setting
+# import to initialise settings
+import dms.globals_
 
 
 @saregister
@@ -48,5 +58,274 @@ def new_reverse_network(db_session, network):
     reverse_network = ReverseNetwork(network)
     db_session.add(reverse_network)
     db_session.flush()
+    reverse_networks_changed()
     return reverse_network
 
+def parse_network(network):
+    """
+    Parse an IP address or CIDR network string.
+
+    Returns a (family, network integer, mask length) tuple, or None if
+    network cannot be parsed.  Host bits are cleared as PostgreSQL does
+    for cidr.
+    """
+    network = str(network)
+    if network.find('/') > -1:
+        address, mask = network.split('/', 1)
+    else:
+        address, mask = network, None
+    family = socket.AF_INET6 if address.find(':') > -1 else socket.AF_INET
+    try:
+        value = int.from_bytes(socket.inet_pton(family, address), 'big')
+    except (socket.error, ValueError, OSError):
+        return None
+    bits = 128 if family == socket.AF_INET6 else 32
+    try:
+        mask = int(mask) if mask is not None else bits
+    except ValueError:
+        return None
+    if mask < 0 or mask > bits:
+        return None
+    value &= ((1 << mask) - 1) << (bits - mask)
+    return (family, value, mask)
+
+
+class ReverseNetworkTrie(object):
+    """
+    Binary prefix trie of reverse networks, for longest prefix matching
+    of addresses and networks to reverse zones.
+
+    Each node is a list of [0 child, 1 child, entries], where entries is a
+    list of (network, zone_id) tuples for the network ending at the node.
+    There can be more than one zone for a network, as deleted zones keep
+    their reverse network until they are destroyed.
+    """
+
+    def __init__(self, rows=()):
+        """
+        Build trie from (network, zone_id) rows
+        """
+        self._roots = {socket.AF_INET: [None, None, None],
+                        socket.AF_INET6: [None, None, None]}
+        for network, zone_id in rows:
+            self.add(network, zone_id)
+
+    @staticmethod
+    def _bits(family):
+        return 128 if family == socket.AF_INET6 else 32
+
+    def add(self, network, zone_id):
+        """
+        Add a network for a zone
+        """
+        parsed = parse_network(network)
+        if not parsed:
+            return
+        family, value, mask = parsed
+        bits = self._bits(family)
+        node = self._roots[family]
+        for i in range(mask):
+            bit = (value >> (bits - 1 - i)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        if node[2] is None:
+            node[2] = []
+        node[2].append((str(network), zone_id))
+
+    def find_containing(self, network):
+        """
+        Find the reverse networks containing the given address or network,
+        ie network <<= reverse network.  Most specific first.
+        """
+        parsed = parse_network(network)
+        if not parsed:
+            return []
+        family, value, mask = parsed
+        bits = self._bits(family)
+        node = self._roots[family]
+        result = []
+        for i in range(mask + 1):
+            if node[2]:
+                result[0:0] = node[2]
+            if i == mask:
+                break
+            node = node[(value >> (bits - 1 - i)) & 1]
+            if node is None:
+                break
+        return result
+
+    def find_exact(self, network):
+        """
+        Find the reverse networks equal to the given network.
+        """
+        parsed = parse_network(network)
+        if not parsed:
+            return []
+        family, value, mask = parsed
+        bits = self._bits(family)
+        node = self._roots[family]
+        for i in range(mask):
+            node = node[(value >> (bits - 1 - i)) & 1]
+            if node is None:
+                return []
+        return list(node[2]) if node[2] else []
+
+    def find_within(self, network):
+        """
+        Find the reverse networks within the given network, ie
+        network >>= reverse network.  Least specific first.
+        """
+        parsed = parse_network(network)
+        if not parsed:
+            return []
+        family, value, mask = parsed
+        bits = self._bits(family)
+        node = self._roots[family]
+        for i in range(mask):
+            node = node[(value >> (bits - 1 - i)) & 1]
+            if node is None:
+                return []
+        result = []
+        nodes = [node]
+        while nodes:
+            next_nodes = []
+            for node in nodes:
+                if node[2]:
+                    result.extend(node[2])
+                next_nodes.extend([child for child in node[0:2] if child])
+            nodes = next_nodes
+        return result
+
+
+# Read the reverse network generation.  A trigger on reverse_networks sets
+# it to a new value from a sequence whenever reverse_networks changes, so
+# a value is never reused even if the change is rolled back.
+_reverse_networks_generation_sql = text("""
+SELECT generation FROM reverse_networks_generation
+""")
+
+# Check if the reverse_networks_generation table is there
+_reverse_networks_generation_table_sql = text("""
+SELECT count(*) FROM information_schema.tables
+    WHERE table_name = 'reverse_networks_generation'
+""")
+
+# Per process reverse network trie, and the reverse network generation it
+# was built from.  The generation is checked in the database at most once
+# a transaction, so changes committed by other processes are seen by the
+# next transaction.  Changes made by this process are seen at once.  The
+# lock only covers swapping in a new trie, not the database reads.
+_trie_lock = threading.Lock()
+_trie = None
+_trie_generation = None
+_trie_changes = 0
+_trie_check_time = 0
+_generation_table = None
+# Trie checked in each transaction
+_trie_checked = weakref.WeakKeyDictionary()
+
+def reverse_networks_changed():
+    """
+    Invalidate the reverse network trie after reverse networks have been 
+    created or deleted.
+    """
+    global _trie, _trie_changes
+    with _trie_lock:
+        _trie = None
+        _trie_changes += 1
+
+def _reverse_networks_signature(db_session):
+    """
+    Row count and highest id of reverse_networks.  Any create changes the
+    highest id, and any delete the count.
+    """
+    return tuple(db_session.query(func.count(ReverseNetwork.id_),
+                        func.max(ReverseNetwork.id_)).one())
+
+def _read_reverse_networks_generation(db_session):
+    """
+    Read the reverse network generation, or a count/max(id) signature if 
+    the database does not have the reverse_networks_generation table.
+    """
+    global _generation_table
+    if _generation_table is None:
+        _generation_table = bool(db_session.execute(
+                _reverse_networks_generation_table_sql).scalar())
+    if _generation_table:
+        return db_session.execute(_reverse_networks_generation_sql).scalar()
+    return _reverse_networks_signature(db_session)
+
+def get_reverse_network_trie(db_session):
+    """
+    Return the reverse network trie, building it if needed
+    """
+    global _trie, _trie_generation, _trie_check_time
+    with _trie_lock:
+        trie = _trie
+        generation = _trie_generation
+        changes = _trie_changes
+    transaction = db_session.transaction
+    if trie is not None:
+        if transaction is not None and _trie_checked.get(transaction) is trie:
+            return trie
+        # Database not upgraded, so the signature is only checked every 
+        # so often
+        check_interval = get_numeric_setting(
+                            'reverse_network_check_interval', float)
+        if (_generation_table is False
+                and time.time() - _trie_check_time < check_interval):
+            return trie
+    new_generation = _read_reverse_networks_generation(db_session)
+    _trie_check_time = time.time()
+    if trie is None or new_generation != generation:
+        rows = db_session.query(ReverseNetwork.network, 
+                                    ReverseNetwork.zone_id).all()
+        trie = ReverseNetworkTrie(rows)
+        with _trie_lock:
+            # Don't swap in a trie if reverse networks changed while it
+            # was read in
+            if changes == _trie_changes:
+                _trie = trie
+                _trie_generation = new_generation
+    if transaction is not None:
+        _trie_checked[transaction] = trie
+    return trie
+
+def find_reverse_zone_ids(db_session, addresses, exclude_state=None, 
+        inc_updates_only=False):
+    """
+    Find the zone id of the most specific reverse network for each address.
+
+    Returns a dict of address to zone_id, with addresses that have no 
+    reverse zone left out.  Zones can be filtered by state and by whether
+    they have incremental updates enabled.
+    """
+    addresses = list(set(addresses))
+    if not addresses:
+        return {}
+    trie = get_reverse_network_trie(db_session)
+    candidates = {}
+    zone_ids = set()
+    for address in addresses:
+        candidates[address] = [zone_id for network, zone_id 
+                                    in trie.find_containing(address)]
+        zone_ids.update(candidates[address])
+    if not zone_ids:
+        return {}
+    # Filter zones in one query
+    zone_sm_type = sql_types['ZoneSM']
+    query = db_session.query(zone_sm_type.id_)\
+            .filter(zone_sm_type.id_.in_(list(zone_ids)))
+    if exclude_state:
+        query = query.filter(zone_sm_type.state != exclude_state)
+    if inc_updates_only:
+        query = query.filter(zone_sm_type.inc_updates == True)
+    zone_ids = set([row[0] for row in query])
+    result = {}
+    for address in addresses:
+        for zone_id in candidates[address]:
+            if zone_id in zone_ids:
+                result[address] = zone_id
+                break
+    return result
@@ -19,30 +19,78 @@
 #    along with py-magcode-core.  If not, see <http://www.gnu.org/licenses/>.
 #
 """
-Zone instance copying using internal python data structures   Mix in class to modularise ZI classes.
+Zone instance copying, done in the database.  Mix in class to modularise 
+ZI classes.
 """
 
 
+from sqlalchemy.sql import text
+
 from magcode.core.globals_ import *
 from magcode.core.database import *
 from dms.dns import RRTYPE_A
 from dms.dns import RRTYPE_AAAA
 
 
+# Copy the comments and RRs of a ZI in one statement.  comment_map
+# allocates a new comment id for each comment in use by the source ZI, 
+# and the RRs are copied with their comment ids remapped.  Returns the 
+# new apex comment id.  %(rr_hash)s is filled in below, to copy RR hashes
+# if the DB has the rr_hash column.
+_copy_zi_sql_template = """
+WITH comment_map AS (
+        SELECT id AS old_id, nextval('rr_comments_id_seq') AS new_id,
+                comment, tag
+            FROM rr_comments
+            WHERE id IN (SELECT comment_group_id FROM resource_records
+                            WHERE zi_id = :src_zi_id
+                        UNION SELECT comment_rr_id FROM resource_records
+                            WHERE zi_id = :src_zi_id
+                        UNION SELECT apex_comment_group_id 
+                            FROM zone_instances WHERE id = :src_zi_id)),
+    new_comments AS (
+        INSERT INTO rr_comments (id, comment, tag)
+            SELECT new_id, comment, tag FROM comment_map),
+    new_rrs AS (
+        INSERT INTO resource_records (label, type, ttl, class, 
+                comment_group_id, zi_id, rdata, zone_ttl, comment_rr_id,
+                lock_ptr, disable, ref_id, track_reverse%(rr_hash)s)
+            SELECT rr.label, rr.type, rr.ttl, rr.class, group_map.new_id,
+                    :zi_id, rr.rdata, rr.zone_ttl, rr_map.new_id,
+                    rr.lock_ptr, rr.disable, rr.ref_id, rr.track_reverse
+                    %(rr_hash_value)s
+                FROM resource_records AS rr
+                    LEFT OUTER JOIN comment_map AS group_map
+                        ON group_map.old_id = rr.comment_group_id
+                    LEFT OUTER JOIN comment_map AS rr_map
+                        ON rr_map.old_id = rr.comment_rr_id
+                WHERE rr.zi_id = :src_zi_id)
+SELECT new_id FROM comment_map
+    WHERE old_id = (SELECT apex_comment_group_id FROM zone_instances
+                        WHERE id = :src_zi_id)
+"""
+_copy_zi_sql = text(_copy_zi_sql_template 
+                        % {'rr_hash': '', 'rr_hash_value': ''})
+_copy_zi_rr_hash_sql = text(_copy_zi_sql_template
+                        % {'rr_hash': ', rr_hash',
+                            'rr_hash_value': ', rr.rr_hash'})
+
+
 class ZiCopy(object):
     """
-    Contains methods for ZI copying via internal structures
+    Contains methods for ZI copying
     """
 
     def copy(self, db_session, change_by=None):
         """
         Copy ZI
 
-        First initialise base ZI, coppy  comment structure set up,
-        then add records.
+        First initialise base ZI, then copy the comments and RRs inside the
+        database via INSERT ... SELECT, remapping the comment ids as they 
+        are copied.  The RRs and comments of the new ZI are loaded from the
+        database when they are first used.
         """
         ZoneInstance = sql_types['ZoneInstance']
-        RRComment = sql_types['RRComment']
         # Keep previous change_by if it is not being changed. This is useful
         # for auto PTR updates
         if not change_by:
@@ -55,60 +103,24 @@ class ZiCopy(object):
                 change_by=change_by)
         db_session.add(new_zi)
         new_zi.zone = self.zone
-        
-        # Establish Apex comment, which is a special RR_Groups comment
-        # This dict establishes relN between new group comment and old one
-        # by indexing the new comment against the old comments id
-        rr_group_comments = {}
-        if self.apex_comment:
-            new_apex_comment = RRComment(comment=self.apex_comment.comment,
-                                        tag=self.apex_comment.tag)
-            db_session.add(new_apex_comment)
-            new_zi.apex_comment = new_apex_comment
-            rr_group_comments[self.apex_comment.id_] = new_apex_comment
-        
-        # Establish rest of RR_Groups comments
-        for comment in self.rr_group_comments:
-            if self.apex_comment and comment is self.apex_comment:
-                # Apex comment is already done above here
-                continue
-            new_comment = RRComment(comment=comment.comment, tag=comment.tag)
-            db_session.add(new_comment)
-            rr_group_comments[comment.id_] = new_comment
-        
-        # For the sake of making code clearer, do same for RR_Comments as
-        # for group comments
-        rr_comments = {}
-        for comment in self.rr_comments:
-            new_comment = RRComment(comment=comment.comment, tag=comment.tag)
-            db_session.add(new_comment)
-            rr_comments[comment.id_] = new_comment
+        # Flush to DB so that any changes to this ZI are there to be copied,
+        # and to fill in new ZI id
+        db_session.flush()
 
-        # Walk zi RRs, and copy them as we go
-        for rr in self.rrs:
-            rr_type = sql_types[type(rr).__name__]
-            new_rr = rr_type(label=rr.label, domain=self.zone.name, 
-                    ttl=rr.ttl, zone_ttl=rr.zone_ttl,
-                    rdata=rr.rdata, lock_ptr=rr.lock_ptr, disable=rr.disable,
-                    track_reverse=rr.track_reverse)
-            db_session.add(new_rr)
-            new_zi.rrs.append(new_rr)
-            if rr_group_comments.get(rr.comment_group_id):
-                rr_group_comment = rr_group_comments[rr.comment_group_id]
-                new_rr.group_comment = rr_group_comment
-                # Uncomment if above is not 'taking'
-                # rr_group_comment.rr_group.append(new_rr)
-            if rr_comments.get(rr.comment_rr_id):
-                rr_comment = rr_comments[rr.comment_rr_id]
-                new_rr.rr_comment = rr_comment
-                # Uncomment if above is not 'taking'
-                # rr_comment.rr = new_rr
-            if hasattr(rr, 'reference') and rr.reference:
-                # Done this way as relationship is 'loose', 
-                # SA relN is 'viewonly=True'
-                new_rr.ref_id = rr.ref_id
-        # Flush to DB to fill in record IDs
+        # Copy comments and RRs. Returns new apex comment id
+        if hasattr(sql_types['ResourceRecord'], 'rr_hash'):
+            copy_zi_sql = _copy_zi_rr_hash_sql
+        else:
+            copy_zi_sql = _copy_zi_sql
+        result = db_session.execute(copy_zi_sql, 
+                                    {'src_zi_id': self.id_,
+                                        'zi_id': new_zi.id_}).fetchall()
+        if result:
+            new_zi.apex_comment_group_id = result[0][0]
         db_session.flush()
+        # Load copied data from DB on next access
+        db_session.expire(new_zi, ['rrs', 'rr_group_comments', 'rr_comments',
+                                    'apex_comment'])
         return new_zi
 
     def get_auto_ptr_data(self, zone_sm):
@@ -37,6 +37,12 @@ class ZiUpdate(object):
     """
     Container mix in class for ZI update code.
     """
+    # Index of RRs by dnspython label, then type, for incremental updates.
+    # See _get_rr_index()
+    _rr_index = None
+    _rr_index_rrs = None
+    # RRs removed by update operations, yet to be removed from self.rrs
+    _rr_removals = None
 
     def __init__(self, db_session=None, trial_run=False, name=None):
         """
@@ -46,29 +52,118 @@ class ZiUpdate(object):
         self._trial_run = trial_run
         self.name = name
     
+    def _get_rr_index(self):
+        """
+        Return the label/type index of self.rrs, building it if needed.
+
+        The index is rebuilt if self.rrs has been replaced, ie reloaded
+        by SQLAlchemy.
+        """
+        rrs = self.rrs
+        if self._rr_index is None or self._rr_index_rrs is not rrs:
+            rr_index = {}
+            for rr in rrs:
+                if self._rr_removals and id(rr) in self._rr_removals:
+                    continue
+                rr_index.setdefault(rr.get_dnspython_label(), {})\
+                        .setdefault(rr.type_, []).append(rr)
+            self._rr_index = rr_index
+            self._rr_index_rrs = rrs
+        return self._rr_index
+
+    def _rr_index_valid(self):
+        """
+        Check if there is a current index to maintain
+        """
+        return (self._rr_index is not None 
+                and self._rr_index_rrs is self.rrs)
+
+    def _rr_index_add(self, rr):
+        """
+        Add an RR to the label/type index
+        """
+        if not self._rr_index_valid():
+            return
+        self._rr_index.setdefault(rr.get_dnspython_label(), {})\
+                .setdefault(rr.type_, []).append(rr)
+
+    def _rr_index_remove(self, rr):
+        """
+        Remove an RR from the label/type index
+        """
+        if not self._rr_index_valid():
+            return
+        label = rr.get_dnspython_label()
+        type_index = self._rr_index.get(label, {})
+        type_rrs = type_index.get(rr.type_, [])
+        for i in range(len(type_rrs)):
+            if type_rrs[i] is rr:
+                del type_rrs[i]
+                break
+        if not type_rrs:
+            type_index.pop(rr.type_, None)
+        if not type_index:
+            self._rr_index.pop(label, None)
+
+    def _rrop_remove_rr(self, rr):
+        """
+        Remove an RR for an update operation.  The RR is taken out of the
+        index straight away, and out of self.rrs by _compact_rrs() once
+        all the operations have been done.
+        """
+        # Make sure index is there, as removed RR is still in self.rrs
+        self._get_rr_index()
+        self._rr_index_remove(rr)
+        if self._rr_removals is None:
+            self._rr_removals = {}
+        self._rr_removals[id(rr)] = rr
+
+    def _compact_rrs(self):
+        """
+        Remove RRs removed by update operations from self.rrs, in one pass
+
+        Returns list of RRs removed.
+        """
+        if not self._rr_removals:
+            return []
+        removals = self._rr_removals
+        rrs = self.rrs
+        positions = [i for i in range(len(rrs)) if id(rrs[i]) in removals]
+        # Delete from end so that positions stay valid.  Done via del
+        # so that SQLAlchemy sees the removals
+        for i in reversed(positions):
+            del rrs[i]
+        self._rr_removals = None
+        if self._rr_index is not None:
+            self._rr_index_rrs = self.rrs
+        return list(removals.values())
+
     def _rrop_find(self, query_rr, match_type=True, match_rdata=True):
         """
         Given an update_rr, find any matching records in this ZI
 
         Match is done using DNS python  and label rdata for accuracy.
         Type matches don't use dnspython data as dnspython rdata
-        form may not exist.
+        form may not exist.  Uses the label/type index.  RDATA matches
+        use the RR hashes where RRs have them.
         """
         # Some constants
         q_label = query_rr.dnspython_rr[0]
         q_type = query_rr.type_
         q_rdata = query_rr.dnspython_rr[2]
         # 1 Match label
-        result = [rr for rr in self.rrs 
-                if query_rr.dnspython_rr[0] == rr.dnspython_rr[0] ]
+        type_index = self._get_rr_index().get(q_label)
+        if not type_index:
+            return []
         # 2 Match type
         if not match_type or q_type == RRTYPE_ANY:
-            return result
-        result = [rr for rr in result if q_type == rr.type_]
+            return [rr for type_rrs in type_index.values() 
+                        for rr in type_rrs]
+        result = list(type_index.get(q_type, []))
         if not match_rdata or not q_rdata:
             return result
         # 3 Match RDATA
-        result = [rr for rr in result if query_rr.dnspython_rr[2] == q_rdata]
+        result = [rr for rr in result if query_rr.same_rdata(rr)]
         # return list of results
         return result
 
@@ -90,7 +185,7 @@ class ZiUpdate(object):
         old_rrs = self._rrop_find(op_rr, match_rdata=False)
         # update it
         for rr in old_rrs:
-            self.remove_rr(rr)
+            self._rrop_remove_rr(rr)
         self.add_rr(op_rr)
         self._rrop_finish(op_rr)
 
@@ -116,7 +211,7 @@ class ZiUpdate(object):
         old_rrs = self._rrop_find(op_rr)
         # Delete RRs
         for rr in old_rrs:
-            self.remove_rr(rr)
+            self._rrop_remove_rr(rr)
             if hasattr(self, '_trial_run') and self._trial_run:
                 continue
             db_session.delete(rr)
@@ -219,7 +314,7 @@ class ZiUpdate(object):
                     return
             # Remove old RRs and update PTR
             for rr in old_rrs:
-                self.remove_rr(rr)
+                self._rrop_remove_rr(rr)
         self.add_rr(op_rr)
         self._rrop_finish(op_rr)
 
@@ -232,6 +327,8 @@ class ZiUpdate(object):
     def trial_op_rr(self, op_rr):
         """
         Do a trial run of the operation
+
+        Returns list of RRs removed from self.rrs by the operation.
         """
         if not self._trial_run:
             # Should throw an Exception here.
@@ -246,6 +343,8 @@ class ZiUpdate(object):
         sectag = None
         self._update_op_map[op_rr.update_op](self, self.db_session, 
                                                     op_rr, sectag)
+        # Caller checks self.rrs after each operation
+        return self._compact_rrs()
 
 
     def exec_update_group(self, db_session, update_group):
@@ -261,6 +360,7 @@ class ZiUpdate(object):
                 continue
             self._update_op_map[op_rr.update_op](self, db_session, op_rr, 
                                                     update_group.sectag)
+        self._compact_rrs()
         # only go further than this if trial run
         if hasattr(self, '_trial_run') and self._trial_run:
             return
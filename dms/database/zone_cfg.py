@@ -114,6 +114,30 @@ def get_rows(db_session, key, sg=None, sg_name=None, raise_exc=False):
         raise ZoneCfgItemNotFound(key)
     return result
 
+def get_rows_dict(db_session, keys, sg=None, sg_name=None):
+    """
+    Return the values for several keys as a dict of lists, in one query.
+
+    As for get_rows(), values for a key in the SG take precedence over
+    those where sg_id is None.  Keys without values are left out.
+    """
+    result = {}
+    if sg_name:
+        sg = find_sg_byname(db_session, sg_name)
+    if sg:
+        for x in sg.zone_cfg_entries:
+            if x.key in keys:
+                result.setdefault(x.key, []).append(x.value)
+    default_keys = [key for key in keys if key not in result]
+    if not default_keys:
+        return result
+    stuff = db_session.query(ZoneCfg)\
+                .filter(and_(ZoneCfg.key.in_(default_keys), 
+                            ZoneCfg.sg_id == None)).all()
+    for x in stuff:
+        result.setdefault(x.key, []).append(x.value)
+    return result
+
 def get_rows_exc(db_session, key, sg=None, sg_name=None):
     """
     Return all the values found for a key
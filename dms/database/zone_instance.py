@@ -23,8 +23,16 @@ Zone instance record.  Maps a zi_id to zone_id
 """
 
 
+from collections import OrderedDict
+from itertools import groupby
+from itertools import chain
+from operator import itemgetter
+
 import dns.ttl
+from sqlalchemy.sql import func
+from sqlalchemy.sql import text
 from sqlalchemy.orm import relationship
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.orm.session import object_session 
 from sqlalchemy.orm.session import make_transient 
 
@@ -34,10 +42,101 @@ from dms.database.zi_copy import *
 from dms.dns import RRTYPE_SOA
 from dms.dns import RRTYPE_NS
 from dms.dns import new_zone_soa_serial
+from dms.json_stream import JsonStream
 import dms.database.zone_cfg as zone_cfg
 from dms.database.resource_record import RR_SOA
 from dms.database.resource_record import RR_NS
 
+
+# RRs of a ZI that are not in another ZI, and the SOA RR, matched on label,
+# type and rdata text, and TTL text.  For ZoneInstance.diff_dnspython_rrs()
+_zi_rrs_not_in_sql = text("""
+SELECT rr.* FROM resource_records AS rr
+    WHERE rr.zi_id = :zi_id AND rr.disable IS NOT TRUE
+        AND (rr.type = :soa_type OR NOT EXISTS (
+            SELECT 1 FROM resource_records AS other
+                WHERE other.zi_id = :other_zi_id
+                    AND other.label = rr.label
+                    AND other.type = rr.type
+                    AND other.rdata = rr.rdata
+                    AND other.disable IS NOT TRUE
+                    AND COALESCE(other.ttl, other.zone_ttl)
+                        = COALESCE(rr.ttl, rr.zone_ttl)))
+""")
+
+# As above, matched on rr_hash and TTL text through the (zi_id, rr_hash) index
+_zi_rrs_not_in_hash_sql = text("""
+SELECT rr.* FROM resource_records AS rr
+    WHERE rr.zi_id = :zi_id AND rr.disable IS NOT TRUE
+        AND (rr.type = :soa_type OR NOT EXISTS (
+            SELECT 1 FROM resource_records AS other
+                WHERE other.zi_id = :other_zi_id
+                    AND other.rr_hash = rr.rr_hash
+                    AND other.disable IS NOT TRUE
+                    AND COALESCE(other.ttl, other.zone_ttl)
+                        = COALESCE(rr.ttl, rr.zone_ttl)))
+""")
+
+# Count RRs of two ZIs without an rr_hash
+_zi_null_rr_hash_sql = text("""
+SELECT count(*) FROM resource_records
+    WHERE zi_id IN (:zi_id, :other_zi_id) AND rr_hash IS NULL
+""")
+
+# zone_cfg keys for the apex SOA record, in update_soa_record() order
+_apex_soa_cfg_keys = ('soa_mname', 'soa_rname', 'soa_refresh', 'soa_retry',
+                        'soa_expire')
+
+# Set the default TTL of the RRs of a ZI, for update_zone_ttls()
+_update_zone_ttls_sql = text("""
+UPDATE resource_records SET zone_ttl = :zone_ttl
+    WHERE zi_id = :zi_id AND zone_ttl IS DISTINCT FROM :zone_ttl
+""")
+
+# Read the RRs of a ZI with their comments and references in one query,
+# for ZoneInstance.to_data()
+_zi_data_sql = text("""
+SELECT rr.id, rr.label, rr.ttl, rr.class, rr.type, rr.rdata,
+        rr.comment_group_id, rr.comment_rr_id, rr.lock_ptr, rr.disable,
+        rr.track_reverse, ref.reference,
+        group_comment.id, group_comment.comment, group_comment.tag,
+        rr_comment.id, rr_comment.comment, rr_comment.tag
+    FROM resource_records AS rr
+        LEFT OUTER JOIN reference AS ref ON ref.id = rr.ref_id
+        LEFT OUTER JOIN rr_comments AS group_comment
+            ON group_comment.id = rr.comment_group_id
+        LEFT OUTER JOIN rr_comments AS rr_comment
+            ON rr_comment.id = rr.comment_rr_id
+    WHERE rr.zi_id = :zi_id
+    ORDER BY rr.id
+""")
+
+# As above, less any header records, grouped by comment group in order of each
+# group's first RR, for ZoneInstance.iter_rr_groups().  Read through a server
+# side cursor so that RR groups can be sent on as they come.
+_zi_stream_sql = text("""
+SELECT rr.id, rr.label, rr.ttl, rr.class, rr.type, rr.rdata,
+        rr.comment_group_id, rr.comment_rr_id, rr.lock_ptr, rr.disable,
+        rr.track_reverse, ref.reference,
+        group_comment.id, group_comment.comment, group_comment.tag,
+        rr_comment.id, rr_comment.comment, rr_comment.tag
+    FROM resource_records AS rr
+        LEFT OUTER JOIN reference AS ref ON ref.id = rr.ref_id
+        LEFT OUTER JOIN rr_comments AS group_comment
+            ON group_comment.id = rr.comment_group_id
+        LEFT OUTER JOIN rr_comments AS rr_comment
+            ON rr_comment.id = rr.comment_rr_id
+    WHERE rr.zi_id = :zi_id
+        AND (:all_rrs OR (rr.type != :soa_type
+            AND NOT (:use_apex_ns AND rr.label = '@' AND rr.type = :ns_type)))
+    ORDER BY min(rr.id) OVER (PARTITION BY rr.comment_group_id), rr.id
+""").execution_options(stream_results=True)
+
+# Count the RRs of a ZI
+_zi_rr_count_sql = text("""
+SELECT count(*) FROM resource_records WHERE zi_id = :zi_id
+""")
+
 @saregister
 class ZoneInstance(ZiUpdate, ZiCopy):
     """
@@ -112,6 +211,7 @@ class ZoneInstance(ZiUpdate, ZiCopy):
         if (not hasattr(self, 'rrs') or not self.rrs):
             self.rrs = []
         self.rrs.append(rr)
+        self._rr_index_add(rr)
 
     def remove_rr(self, rr):
         """
@@ -120,6 +220,7 @@ class ZoneInstance(ZiUpdate, ZiCopy):
         if (not hasattr(self, 'rrs') or not self.rrs):
             self.rrs = []
         self.rrs.remove(rr)
+        self._rr_index_remove(rr)
 
     def get_soa_serial(self):
         """
@@ -141,18 +242,40 @@ class ZoneInstance(ZiUpdate, ZiCopy):
         self.soa_serial = serial
         rr.update_serial(serial)
 
-    def update_soa_record(self, db_session):
+    def _get_apex_cfg(self, db_session):
+        """
+        Read the zone_cfg values for apex maintenance in one query
+        """
+        return zone_cfg.get_rows_dict(db_session, 
+                    _apex_soa_cfg_keys + (settings['apex_ns_key'],),
+                    sg=self.zone.sg)
+
+    def _apex_rr_matches(self, rr, new_rr):
+        """
+        Check if a stored apex RR is the same as a freshly made one, so
+        that it can be left alone
+        """
+        return (rr.label == new_rr.label and rr.ttl == new_rr.ttl
+                and rr.zone_ttl == new_rr.zone_ttl 
+                and rr.rdata == new_rr.rdata
+                and not rr.disable and not rr.lock_ptr 
+                and not rr.track_reverse and rr.ref_id is None
+                and rr.group_comment is self.apex_comment)
+
+    def update_soa_record(self, db_session, apex_cfg=None):
         """
         Form new SOA record from the information stored in the zi
+
+        The SOA record is only replaced if it is different.  Returns True
+        if the SOA record was changed.
         """
         if self.zone.use_apex_ns:
             # Read in values from DB global config
-            sg = self.zone.sg
-            mname = zone_cfg.get_row(db_session, 'soa_mname', sg=sg)
-            rname = zone_cfg.get_row(db_session, 'soa_rname', sg=sg)
-            refresh = zone_cfg.get_row(db_session, 'soa_refresh', sg=sg)
-            retry = zone_cfg.get_row(db_session, 'soa_retry', sg=sg)
-            expire = zone_cfg.get_row(db_session, 'soa_expire', sg=sg)
+            if apex_cfg is None:
+                apex_cfg = self._get_apex_cfg(db_session)
+            values = [apex_cfg[key][0] if apex_cfg.get(key) else None
+                        for key in _apex_soa_cfg_keys]
+            mname, rname, refresh, retry, expire = values
             # Update zi if different
             if mname != self.soa_mname:
                 self.soa_mname = mname
@@ -178,12 +301,17 @@ class ZoneInstance(ZiUpdate, ZiCopy):
         new_soa_rr = RR_SOA(label='@', ttl=ttl, zone_ttl=zone_ttl,
                 rdata=rdata, domain=self.zone.name)
         
+        # Leave the SOA record alone if it is the only one, and unchanged
+        old_soa_rrs = [r for r in self.rrs if type(r) == RR_SOA]
+        if (len(old_soa_rrs) == 1 
+                and self._apex_rr_matches(old_soa_rrs[0], new_soa_rr)):
+            return False
+
         # Put in new SOA record
         # Remove every soa rr but the first. Have to be careful as deleting
         # from lists while looping over them can be problematic, and ordering
         # can influence SQL statement ordering, which could be sensitive here.
         # Being hyper cautious here...
-        old_soa_rrs = [r for r in self.rrs if type(r) == RR_SOA]
         if len(old_soa_rrs):
             # Remove every soa rr but the first, then grab comment, then remove
             # thold SOA RR.
@@ -200,32 +328,53 @@ class ZoneInstance(ZiUpdate, ZiCopy):
         db_session.add(new_soa_rr)
         new_soa_rr.group_comment = self.apex_comment
         new_soa_rr.rr_comment = rr_comment
+        return True
 
-    def update_apex_ns_records(self, db_session):
+    def update_apex_ns_records(self, db_session, apex_cfg=None):
         """
         Update the apex NS records
+
+        Only apex NS records that differ from those configured are
+        deleted or added.  Returns True if the apex NS records were
+        changed, False if unchanged, or None if no apex NS servers are
+        configured.
         """
         # Check that Apex NS servers are configured.
-        apex_ns_names = zone_cfg.get_rows(db_session, settings['apex_ns_key'],
-                                            sg=self.zone.sg)
+        if apex_cfg is None:
+            apex_cfg = self._get_apex_cfg(db_session)
+        apex_ns_names = apex_cfg.get(settings['apex_ns_key'])
         if not apex_ns_names:
             log_critical("No Apex NS servers are configured, " 
                                 "using current ones")
-            return False
+            return None
 
-        # Locate all apex NS records
+        # New apex NS records from zone_cfg table
+        new_rrs = [RR_NS('@', zone_ttl=self.zone_ttl, rdata=ns_name,
+                        domain=self.zone.name) for ns_name in apex_ns_names]
+
+        # Locate all apex NS records, and keep those that are wanted
         old_apex_ns_rrs = [r for r in self.rrs 
                 if (type(r) == RR_NS and r.label == '@')]
-        # delete them (seperate from above as delete can affect loop!)
+        del_rrs = []
         for rr in old_apex_ns_rrs:
+            for new_rr in new_rrs:
+                if (self._apex_rr_matches(rr, new_rr) 
+                        and rr.rr_comment is None):
+                    new_rrs.remove(new_rr)
+                    break
+            else:
+                del_rrs.append(rr)
+        if not del_rrs and not new_rrs:
+            return False
+
+        # delete them (seperate from above as delete can affect loop!)
+        for rr in del_rrs:
             self.remove_rr(rr)
             db_session.delete(rr)
 
-        # Add new apex NS records from zone_cfg table
+        # Add missing apex NS records
         apex_comment = self.apex_comment
-        for ns_name in apex_ns_names:
-            rr = RR_NS('@', zone_ttl=self.zone_ttl, rdata=ns_name,
-                        domain=self.zone.name)
+        for rr in new_rrs:
             self.add_rr(rr)
             db_session.add(rr)
             rr.group_comment = apex_comment
@@ -235,15 +384,29 @@ class ZoneInstance(ZiUpdate, ZiCopy):
         """
         Update Apex SOA and NS records, according to zone_sm.use_apex_ns 
         flag
+
+        Apex RRs are only rewritten where they differ from what they
+        should be, so nothing is written when the zone_cfg values and SG
+        apex NS servers have not changed since the last update.
         """
-        self.update_apex_comment(db_session)
-        self.update_soa_record(db_session)
+        apex_cfg = self._get_apex_cfg(db_session)
+        changed = self.update_apex_comment(db_session)
+        if self.update_soa_record(db_session, apex_cfg):
+            changed = True
         if self.zone.use_apex_ns or force_apex_ns:
-            self.update_apex_ns_records(db_session)
+            if self.update_apex_ns_records(db_session, apex_cfg):
+                changed = True
+        if not changed:
+            return
+        # Apex RRs are replaced without changing the zone_instances row.
+        # Update it so that its mtime trigger fires, and any rendered copy
+        # of this ZI in a zi_render_cache is no longer used.
+        self.mtime = func.now()
 
     def update_apex_comment(self, db_session):
         """
-        Maintain the Zone Apex RRComment
+        Maintain the Zone Apex RRComment.  Returns True if the comment
+        was created or changed.
         """
         comment = settings['apex_comment_template'] % self.zone.name
         RRComment = sql_types['RRComment']
@@ -253,10 +416,16 @@ class ZoneInstance(ZiUpdate, ZiCopy):
 
             db_session.add(rr_comment)
             self.apex_comment = rr_comment
-        else:
-            if self.zone.use_apex_ns:
-                self.apex_comment.comment = comment
+            return True
+        changed = False
+        if (self.zone.use_apex_ns 
+                and self.apex_comment.comment != comment):
+            self.apex_comment.comment = comment
+            changed = True
+        if self.apex_comment.tag != settings['apex_rr_tag']:
             self.apex_comment.tag = settings['apex_rr_tag']
+            changed = True
+        return changed
 
     def set_apex_comment_text(self, db_session, comment):
         """
@@ -279,6 +448,9 @@ class ZoneInstance(ZiUpdate, ZiCopy):
     def update_zone_ttls(self, zone_ttl=None, reset_rr_ttl=False):
         """
         Update the zone_ttl across the zi
+
+        For a ZI in the database, the RRs are updated by one SQL UPDATE
+        statement, rather than through the ORM.
         """
         if (zone_ttl 
                 and dns.ttl.from_text(str(zone_ttl)) 
@@ -286,8 +458,45 @@ class ZoneInstance(ZiUpdate, ZiCopy):
             # Only update zi.zone_ttl if it is different - don't
             # surprise people unless it is needed.
             self.zone_ttl = str(zone_ttl)
-        for rr in self.rrs:
-            rr.update_zone_ttl(self.zone_ttl, reset_rr_ttl)
+        db_session = object_session(self)
+        if reset_rr_ttl or db_session is None or self.id_ is None:
+            # RR TTLs are compared as numbers, done in Python
+            for rr in self.rrs:
+                rr.update_zone_ttl(self.zone_ttl, reset_rr_ttl)
+            return
+        self._update_zone_ttls_sql(db_session)
+
+    def _update_zone_ttls_sql(self, db_session):
+        """
+        Set the zone_ttl of all the ZI's RRs in the database in one go.
+
+        All RRs of the ZI in the session identity map, however they were
+        loaded, are given the new zone_ttl as if it was loaded from the
+        database, so that none are left stale or flushed again.  The ZI
+        mtime is updated if any RRs were changed.
+        """
+        zone_ttl = self.zone_ttl
+        # Flush so that pending RRs are in the database to be updated
+        db_session.flush()
+        result = db_session.execute(_update_zone_ttls_sql,
+                                    {'zi_id': self.id_, 'zone_ttl': zone_ttl})
+        if not result.rowcount:
+            return
+        # All RRs now have zone_ttl in the DB.  Bring this ZI's RRs in the
+        # identity map into line, without a reload query per RR
+        zi_id = self.id_
+        rr_type = sql_types['ResourceRecord']
+        for rr in list(db_session.identity_map.values()):
+            # Expired RRs are read fresh when used, so only look at
+            # loaded values
+            if (not isinstance(rr, rr_type) 
+                    or rr.__dict__.get('zi_id') != zi_id
+                    or 'zone_ttl' not in rr.__dict__):
+                continue
+            if rr.zone_ttl != zone_ttl:
+                set_committed_value(rr, 'zone_ttl', zone_ttl)
+                rr._update_dnspython_ttl()
+        self.mtime = func.now()
 
     def normalize_ttls(self):
         """
@@ -327,6 +536,36 @@ class ZoneInstance(ZiUpdate, ZiCopy):
                 continue
             yield(tuple(rr.dnspython_rr))
 
+    def diff_dnspython_rrs(self, other_zi):
+        """
+        Return the dnspython_rr tuples of this zone instance that are not
+        in other_zi, plus its SOA RR.  The set difference is done in SQL,
+        so only the differing RRs are loaded.  RRs are matched on rr_hash
+        if it is filled in for both ZIs, and on their text otherwise.
+
+        RRs only written differently in the two ZIs, ie a TTL of '1h' and
+        '3600', or a differently cased label when matched on text, are also
+        returned, so the result still has to be put through ZoneDiff.
+        Returns None if either ZI is not in the database.
+        """
+        db_session = object_session(self)
+        if (db_session is None or self.id_ is None 
+                or other_zi.id_ is None):
+            return None
+        db_session.flush()
+        rr_type = sql_types['ResourceRecord']
+        params = {'zi_id': self.id_, 'other_zi_id': other_zi.id_}
+        if (hasattr(rr_type, 'rr_hash')
+                and not db_session.execute(_zi_null_rr_hash_sql,
+                                            params).scalar()):
+            not_in_sql = _zi_rrs_not_in_hash_sql
+        else:
+            not_in_sql = _zi_rrs_not_in_sql
+        params['soa_type'] = RRTYPE_SOA
+        rrs = db_session.query(rr_type)\
+                .from_statement(not_in_sql).params(**params)
+        return [tuple(rr.dnspython_rr) for rr in rrs]
+
     def to_engine_brief(self, time_format=None):
         """
         Supply data output in brief as a dict.  
@@ -371,23 +610,61 @@ class ZoneInstance(ZiUpdate, ZiCopy):
                 'soa_ttl': self.soa_ttl,
                 'zone_ttl': self.zone_ttl}
 
+    def _load_data_rrs(self):
+        """
+        Load RRs for to_data() as dicts, with dicts of their group and RR
+        comments by comment id.
+
+        When the ZI is in a session, this is done in one query built for
+        the purpose, rather than by loading the rrs, rr_group_comments,
+        and rr_comments relationships, and each RR reference.
+        """
+        db_session = object_session(self)
+        rr_group_comments = {}
+        rr_comments = {}
+        if db_session is None or self.id_ is None:
+            rrs = [rr.to_engine() for rr in self.rrs]
+            # Get all the comments, and store them in dicts by id
+            for c in self.rr_group_comments:
+                # Don't emit comment IDs into JSON
+                rr_group_comments[c.id_] = {'comment': c.comment, 
+                                                'tag': c.tag}
+            for c in self.rr_comments:
+                # Don't emit comment IDs into JSON
+                rr_comments[c.id_] = {'comment': c.comment, 'tag': c.tag}
+            return (rrs, rr_group_comments, rr_comments)
+
+        # Flush so that any changes to this ZI are read back
+        db_session.flush()
+        rrs = []
+        zi_id = self.id_
+        for (rr_id, label, ttl, class_, type_, rdata, comment_group_id,
+                comment_rr_id, lock_ptr, disable, track_reverse, reference,
+                group_comment_id, group_comment, group_tag,
+                rr_comment_id, rr_comment, rr_tag) \
+                    in db_session.execute(_zi_data_sql, {'zi_id': zi_id}):
+            rrs.append({'rr_id': rr_id, 'zi_id': zi_id, 'label': label,
+                    'ttl': ttl, 'class': class_, 'type': type_,
+                    'rdata': rdata, 'comment_group_id': comment_group_id,
+                    'comment_rr_id': comment_rr_id, 'lock_ptr': lock_ptr,
+                    'disable': disable, 'track_reverse': track_reverse,
+                    'reference': reference})
+            if group_comment_id is not None:
+                rr_group_comments[group_comment_id] = {
+                                'comment': group_comment, 'tag': group_tag}
+            if rr_comment_id is not None:
+                rr_comments[rr_comment_id] = {'comment': rr_comment,
+                                                'tag': rr_tag}
+        return (rrs, rr_group_comments, rr_comments)
+
     def to_data(self, time_format=None, use_apex_ns=True, all_rrs=False):
         """
         A full zi output with RRs grouped by comment
         """
         # Get given zi as a dict
         result = self.to_engine(time_format=time_format)
-        # Get all resource records and group by RR_Group.
-        rrs = [rr.to_engine() for rr in self.rrs]
-        # Get all the comments, and store them in dicts by id for reference
-        rr_group_comments = {}
-        for c in self.rr_group_comments:
-            # Don't emit comment IDs into JSON
-            rr_group_comments[c.id_] = {'comment': c.comment, 'tag': c.tag}
-        rr_comments = {}
-        for c in self.rr_comments:
-            # Don't emit comment IDs into JSON
-            rr_comments[c.id_] = {'comment': c.comment, 'tag': c.tag}
+        # Get all resource records and comments, to group by RR_Group.
+        rrs, rr_group_comments, rr_comments = self._load_data_rrs()
 
         # Header records
         if not all_rrs:
@@ -409,8 +686,9 @@ class ZoneInstance(ZiUpdate, ZiCopy):
                     rr.update(comment_dict)
             del rr['comment_rr_id']
 
-        # Group records by comment_group_id
-        rr_groups = {}
+        # Group records by comment_group_id, in order of each group's first
+        # RR, as iter_rr_groups() does
+        rr_groups = OrderedDict()
         for rr in rrs:
             comment_id = rr['comment_group_id']
             if not comment_id in rr_groups:
@@ -428,6 +706,87 @@ class ZoneInstance(ZiUpdate, ZiCopy):
         result['rr_groups'] = list(rr_groups.values())
         return result
 
+    def rr_count(self):
+        """
+        Return the number of RRs in the ZI
+        """
+        db_session = object_session(self)
+        if db_session is None or self.id_ is None:
+            return len(self.rrs)
+        db_session.flush()
+        return db_session.execute(_zi_rr_count_sql,
+                                    {'zi_id': self.id_}).scalar()
+
+    def _iter_stream_rrs(self, db_session, use_apex_ns, all_rrs):
+        """
+        Generate (comment_group_id, group comment, group tag, rr) for each
+        RR of the ZI, grouped by comment group, from a server side cursor.
+        The group comment is False if the group has no comment.
+        """
+        zi_id = self.id_
+        params = {'zi_id': zi_id, 'all_rrs': all_rrs,
+                    'use_apex_ns': use_apex_ns, 'soa_type': RRTYPE_SOA,
+                    'ns_type': RRTYPE_NS}
+        for (rr_id, label, ttl, class_, type_, rdata, comment_group_id,
+                comment_rr_id, lock_ptr, disable, track_reverse, reference,
+                group_comment_id, group_comment, group_tag,
+                rr_comment_id, rr_comment, rr_tag) \
+                    in db_session.execute(_zi_stream_sql, params):
+            rr = {'rr_id': rr_id, 'zi_id': zi_id, 'label': label,
+                    'ttl': ttl, 'class': class_, 'type': type_,
+                    'rdata': rdata, 'lock_ptr': lock_ptr,
+                    'disable': disable, 'track_reverse': track_reverse,
+                    'reference': reference}
+            # RR level comments
+            if comment_rr_id and rr_comment_id is not None:
+                rr['comment'] = rr_comment
+                rr['tag'] = rr_tag
+            if group_comment_id is None:
+                group_comment = False
+            yield (comment_group_id, group_comment, group_tag, rr)
+
+    def iter_rr_groups(self, use_apex_ns=True, all_rrs=False):
+        """
+        Generate the rr_groups of to_data() one at a time, read from the DB
+        as they are needed.
+
+        The 'rrs' of each group is a JsonStream read from the same cursor,
+        so a big group, such as all the RRs of a zone without comments, is
+        not held in memory either.  Each group's RRs must be used before
+        the next group is taken.  Groups and their RRs are in the same order
+        as to_data().
+        """
+        db_session = object_session(self)
+        if db_session is None or self.id_ is None:
+            for rr_group in self.to_data(use_apex_ns=use_apex_ns,
+                                    all_rrs=all_rrs)['rr_groups']:
+                yield rr_group
+            return
+
+        # Flush so that any changes to this ZI are read back
+        db_session.flush()
+        rows = self._iter_stream_rrs(db_session, use_apex_ns, all_rrs)
+        for group_id, group_rows in groupby(rows, key=itemgetter(0)):
+            first_row = next(group_rows)
+            rr_group = {}
+            if first_row[1] is not False:
+                rr_group['comment'] = first_row[1]
+                rr_group['tag'] = first_row[2]
+            rr_group['rrs'] = JsonStream(map(itemgetter(3),
+                                        chain((first_row,), group_rows)))
+            yield rr_group
+
+    def to_stream_data(self, time_format=None, use_apex_ns=True,
+            all_rrs=False):
+        """
+        As to_data(), but with the rr_groups read from the DB as the result
+        is JSON encoded.
+        """
+        result = self.to_engine(time_format=time_format)
+        result['rr_groups'] = JsonStream(self.iter_rr_groups(
+                                    use_apex_ns=use_apex_ns, all_rrs=all_rrs))
+        return result
+
 
 def get_default_zi_data(db_session, sg_name=None):
     """
@@ -26,7 +26,6 @@ DNS Zone State Machine
 import glob
 import os.path
 from tempfile import mkstemp
-import io
 import os
 import errno
 import grp
@@ -68,6 +67,7 @@ from magcode.core.database.event import ESTATE_SUCCESS
 from magcode.core.database.event import eventregister
 from magcode.core.database.event import synceventregister
 from magcode.core.database.event import queue_event
+from magcode.core.utility import get_boolean_setting
 from dms.template_cache import read_template
 import dms.database.zone_cfg as zone_cfg
 from dms.zone_text_util import data_to_bind
@@ -882,11 +882,10 @@ class DynDNSZoneSM(ZoneSM):
             (fd, tmp_filename) = mkstemp(
                         dir=dynamic_zone_dir,
                         prefix=prefix)
-            tmp_file = io.open(fd, mode='wt')
             reference = self.reference.reference if self.reference else None
-            data_to_bind(zi_data, self.name, tmp_file, reference=reference,
+            data_to_bind(zi_data, self.name, fd, reference=reference,
                         for_bind=True)
-            tmp_file.close()
+            os.close(fd)
             # Rename tmp file into place so that replacement is atomic
             try:
                 uid = pwd.getpwnam(settings['run_as_user']).pw_uid
@@ -908,6 +907,9 @@ class DynDNSZoneSM(ZoneSM):
             except:
                 pass
             os.rename(tmp_filename, zone_file)
+            # Server zone contents replaced, cached zone image is stale
+            if update_engine.get('dyndns'):
+                update_engine['dyndns'].clear_zone_cache(self.name)
         except (IOError, OSError) as exc:
             err_string = exc.strerror
             err_filename = exc.filename
@@ -965,6 +967,7 @@ class DynDNSZoneSM(ZoneSM):
         """
         if not self.zone_files:
             event.db_session.delete(self)
+            dms.database.reverse_network.reverse_networks_changed()
             return (RCODE_OK, 
                     "Zone '%s' - destroying, zone files deleted"
                     % self.name)
@@ -1571,6 +1574,13 @@ class DynDNSZoneSM(ZoneSM):
         
         # Preprocessing for DNSSEC goes here
         dnssec_args = self._update_dnssec_preprocess()
+
+        # Published ZI can stand in for the server zone if it has not been
+        # altered in place by incremental updates
+        published_zi = None
+        if (get_boolean_setting('dyndns_fast_publish') and self.zi_id 
+                and zi.id_ != self.zi_id):
+            published_zi = self.zi
         
         # Run update engine
         (rcode, msg, soa_serial, update_info) = update_engine['dyndns']\
@@ -1579,6 +1589,7 @@ class DynDNSZoneSM(ZoneSM):
                                 candidate_soa_serial=candidate_soa_serial,
                                 force_soa_serial_update=do_soa_serial_update,
                                 wrap_serial_next_time=wrap_soa_serial,
+                                published_zi=published_zi,
                                 **dnssec_args)
 
         # Handle auto reset of Zone SM if DNS server is not configured
@@ -1909,6 +1920,7 @@ def del_zone(db_session, zone):
     # Delete it from the DB
     db_session.delete(zone)
     db_session.commit()
+    dms.database.reverse_network.reverse_networks_changed()
     # Delete the object
     del(zone)
 
@@ -22,17 +22,19 @@
 Module to contain DMS Zone editing engine
 """
 
-import json
 
 import sqlalchemy.exc
 
 from magcode.core import *
 from magcode.core.database import sql_data
+from magcode.core.utility import get_numeric_setting
 from magcode.core.wsgi.jsonrpc_server import *
 from dms.zone_engine import ZoneEngine
 from dms.exceptions import DMSError
 from dms.exceptions import DBReadOnlyError
 from dms.exceptions import ZoneHasNoSOARecord 
+from dms.json_stream import has_json_stream
+from dms.json_stream import iter_json_bytes
 
 
 class DMSEngine(ZoneEngine):
@@ -217,6 +219,10 @@ class DmsJsonRpcServer(object):
         rpc_container = self.rpc_container_class(
                                                 time_format=self.time_format, 
                                                 sectag=self.sectag)
+        # Results can be streamed if called from DmsWsgiJsonRpcServer
+        stream_response = environ.get(DMS_JSON_STREAM_RESPONSE)
+        if stream_response is not None:
+            rpc_container._engine.json_stream = True
         
         # Process requests
         response = []
@@ -271,5 +277,63 @@ class DmsJsonRpcServer(object):
                         'error': { 'code': JSONRPC_INVALID_PARAMS,
                         'message': jsonrpc_errors[JSONRPC_INVALID_PARAMS],
                         'data': data}})
+        if (stream_response is not None
+                and any(has_json_stream(r.get('result')) for r in response)):
+            # Hand the whole response to DmsWsgiJsonRpcServer to encode,
+            # and give WsgiJsonRpcServer one without the streamed results
+            stream_response[:] = response
+            response = [dict(r, result=None)
+                            if has_json_stream(r.get('result')) else r
+                            for r in response]
         return response
 
+
+# environ key for a response with streamed results in it
+DMS_JSON_STREAM_RESPONSE = 'dms.json_stream_response'
+
+class DmsWsgiJsonRpcServer(WsgiJsonRpcServer):
+    """
+    WSGI JSON RPC Server that streams out big results.
+
+    A response with a JsonStream in it, such as a big zone from show_zone,
+    is passed back by DmsJsonRpcServer, and is encoded as it is sent.
+    Other responses are sent as WsgiJsonRpcServer encoded them.
+    """
+    def __call__(self, environ, start_response):
+        stream_response = []
+        environ[DMS_JSON_STREAM_RESPONSE] = stream_response
+        response_start = []
+        def capture_start_response(status, response_headers, exc_info=None):
+            response_start[:] = [status, response_headers, exc_info]
+        output = super().__call__(environ, capture_start_response)
+        if not response_start:
+            return output
+        status, response_headers, exc_info = response_start
+        if not stream_response:
+            start_response(status, response_headers, exc_info)
+            return output
+        # WsgiJsonRpcServer only sends a JSON array for a batch request
+        if b''.join(output).startswith(b'['):
+            envelope = stream_response
+        else:
+            envelope = stream_response[0]
+        # Length not known until it is all sent
+        response_headers = [header for header in response_headers
+                                if header[0].lower() != 'content-length']
+        start_response(status, response_headers, exc_info)
+        return self._iter_output(envelope)
+
+    def _iter_output(self, envelope):
+        """
+        Encode the response envelope, a chunk at a time
+        """
+        chunk_size = get_numeric_setting('jsonrpc_stream_chunk_size', int)
+        try:
+            for chunk in iter_json_bytes(envelope, chunk_size):
+                yield chunk
+        except Exception:
+            # Headers are gone.  Only thing left is to drop the
+            # connection, leaving the client with truncated JSON
+            log_error("DmsWsgiJsonRpcServer - failed streaming "
+                      "response:\n%s" % format_exc())
+            raise
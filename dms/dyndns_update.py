@@ -28,20 +28,26 @@ import os
 import errno
 import re
 import socket
+import struct
+import copy
 import shlex
 import random
 from subprocess import Popen
 from subprocess import PIPE
 from subprocess import CalledProcessError
 from os.path import isfile
+from collections import OrderedDict
 
 import dns.query
 import dns.zone
 import dns.tsigkeyring
 import dns.update
 import dns.rcode
+import dns.message
+import dns.exception
 
 from magcode.core.globals_ import *
+from magcode.core.utility import get_numeric_setting
 from dms.dns import *
 from magcode.core.database import RCODE_OK
 from magcode.core.database import RCODE_ERROR
@@ -51,6 +57,7 @@ from magcode.core.database import RCODE_NOCHANGE
 from dms.globals_ import *
 from dms.parser import get_keys
 from dms.update_engine import UpdateEngine
+from dms.zone_diff_util import ZoneDiff
 from dms.exceptions import DynDNSCantReadKeyError
 from dms.exceptions import DynDNSCantReadKeyError
 from dms.exceptions import NoSuchZoneOnServerError
@@ -59,6 +66,13 @@ from dms.exceptions import SOASerialError
 
 # For settings initialisation see dms.globals_
 
+# Update batch operations
+UPDATE_ADD = 'add'
+UPDATE_DELETE = 'delete'
+# Maximum size of an update batch on the wire, leaving room for
+# the zone, prerequisite, SOA and TSIG RRs in a 64K DNS message
+UPDATE_BATCH_WIRE_LIMIT = 60000
+
 class DynDNSUpdate(UpdateEngine):
     """
     Implements the operations needed to update bind via Dyanmic DNS
@@ -96,21 +110,213 @@ class DynDNSUpdate(UpdateEngine):
                 for x in settings['dyndns_fatal_rcodes'].strip().split()]
         return
 
+    def _read_published_zone(self, zone_name, zi, published_zi, 
+            db_soa_serial):
+        """
+        Check the server SOA serial number against that last published. 
+        If they match, return the published ZI RRs to diff against, a
+        function returning the ZI RRs to diff, and the server DNSSEC flags,
+        so that a zone transfer is not needed.
+
+        Only the RRs that differ between the two ZIs are returned, as the
+        set difference is done in SQL.
+
+        Returns None if the zone has to be read from the server.
+        """
+        if db_soa_serial is None:
+            return None
+        rcode, msg, soa_serial = self.read_soa(zone_name)
+        if rcode != RCODE_OK or soa_serial != db_soa_serial:
+            return None
+        if published_zi.get_soa_serial() != soa_serial:
+            return None
+        dnssec_flags = self.read_dnssec_flags(zone_name)
+        if not dnssec_flags:
+            return None
+        published_rrs = published_zi.diff_dnspython_rrs(zi)
+        if published_rrs is None:
+            # ZIs not in DB, diff whole ZIs
+            return (published_zi.iterate_dnspython_rrs(), 
+                        zi.iterate_dnspython_rrs,
+                        dnssec_flags[0], dnssec_flags[1])
+        return (published_rrs, lambda: zi.diff_dnspython_rrs(published_zi),
+                    dnssec_flags[0], dnssec_flags[1])
+
+    def _rr_wire_size(self, origin, rr):
+        """
+        Estimate uncompressed wire size of an RR in an update message
+        """
+        # 10 bytes is type, class, TTL, and rdata length
+        return (len(rr[0].to_digestable(origin)) + 10
+                    + len(rr[2].to_digestable(origin)))
+
+    def _batch_update_rrs(self, origin, pre_add_rrs, del_rrs, add_rrs):
+        """
+        Split update RRs into a list of batches of (op, rr) tuples.
+
+        Updates that fit in one message are returned as one batch in the 
+        normal order.  Otherwise changes are grouped by owner name so that
+        a node is changed in the one batch where possible, with the
+        pre-added apex NS RRs in the first batch.
+        """
+        batch_size = get_numeric_setting('dyndns_update_batch_size', int)
+        ops = ([(UPDATE_ADD, rr) for rr in pre_add_rrs]
+                + [(UPDATE_DELETE, rr) for rr in del_rrs]
+                + [(UPDATE_ADD, rr) for rr in add_rrs])
+        sizes = [self._rr_wire_size(origin, op[1]) for op in ops]
+        if (not batch_size or batch_size <= 0 
+                or (len(ops) <= batch_size 
+                        and sum(sizes) <= UPDATE_BATCH_WIRE_LIMIT)):
+            return [ops]
+
+        # Group changes by owner name, deletes before adds
+        groups = OrderedDict()
+        groups[None] = []
+        for i, op in enumerate(ops):
+            key = None if i < len(pre_add_rrs) else op[1][0]
+            groups.setdefault(key, []).append((op, sizes[i]))
+
+        batches = []
+        batch = []
+        batch_wire = 0
+        for group in groups.values():
+            if (batch and (len(batch) + len(group) > batch_size
+                    or batch_wire + sum([x[1] for x in group]) 
+                            > UPDATE_BATCH_WIRE_LIMIT)):
+                batches.append(batch)
+                batch = []
+                batch_wire = 0
+            # Groups bigger than a batch have to be split
+            for op, size in group:
+                if (batch and (len(batch) >= batch_size
+                        or batch_wire + size > UPDATE_BATCH_WIRE_LIMIT)):
+                    batches.append(batch)
+                    batch = []
+                    batch_wire = 0
+                batch.append(op)
+                batch_wire += size
+        batches.append(batch)
+        return batches
+
+    def _tcp_connect(self):
+        """
+        Open a TCP connection to the server for sending updates
+        """
+        return socket.create_connection((self.server, self.port), 
+                    timeout=float(settings['dns_query_timeout']))
+
+    def _tcp_recv(self, sock, count):
+        """
+        Read count bytes from a TCP connection
+        """
+        data = b''
+        while len(data) < count:
+            chunk = sock.recv(count - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    def _tcp_query(self, sock, query):
+        """
+        Send a DNS message down an open TCP connection, and return the reply
+        """
+        wire = query.to_wire()
+        sock.sendall(struct.pack('!H', len(wire)) + wire)
+        (length,) = struct.unpack('!H', self._tcp_recv(sock, 2))
+        wire = self._tcp_recv(sock, length)
+        response = dns.message.from_wire(wire, keyring=query.keyring,
+                        request_mac=query.mac)
+        if not query.is_response(response):
+            raise dns.query.BadResponse
+        return response
+
+    def _batch_update_failed(self, zone_name, batches_done, 
+            interim_soa_rdatas, reason, update_info, last_attempt):
+        """
+        Handle a batched update failing after the first batch went through.
+
+        The server zone is left at the interim SOA serial of the last batch
+        that went through, with that much of the change made.  Returns
+        None so that update_zone() does the update once more from a fresh
+        diff, or an error for the update to be retried later.  Either way
+        the zone is read in from the server, as its serial no longer 
+        matches that published.
+        """
+        batch_count = len(interim_soa_rdatas) + 1
+        msg = ("Zone '%s' - update batch %s of %s failed: %s - server zone"
+                " left at interim SOA serial %s, with %s of %s batches"
+                " applied" % (zone_name, batches_done + 1, batch_count,
+                    reason, interim_soa_rdatas[batches_done - 1].serial, 
+                    batches_done, batch_count))
+        if not last_attempt:
+            log_info(msg + " - redoing update from server zone")
+            return None
+        return (RCODE_ERROR, msg + " - will retry", None, update_info)
+
     def update_zone(self, zone_name, zi, db_soa_serial=None, 
             candidate_soa_serial=None,
             force_soa_serial_update=False, wrap_serial_next_time=False,
             date_stamp=None, nsec3_seed=False, clear_dnskey=False,
-            clear_nsec3=False):
+            clear_nsec3=False, published_zi=None):
         """
         Use dnspython to update a Zone in the DNS server
 
         Use wrap_serial_next_time to 'fix' SOA serial numbers grossly not 
         in the operations format YYYYMMDDnn. date is a datetime object in 
         localtime.
+
+        If published_zi is given, and the server SOA serial shows that the
+        zone is as last published, the published ZI is compared against 
+        instead of the zone read in from the server.  If the update then
+        fails, it is done once more against the zone read in from the 
+        server.
+
+        An update split into batches that fails after the first batch has
+        gone through leaves the server zone at an interim SOA serial, with
+        part of the change made.  It is also done once more, from a fresh
+        diff against the zone read in from the server.
+        """
+        # Fast publish first, then the long way if the server zone turns
+        # out not to be as published, or is part way through a change.
+        for attempt, attempt_zi in enumerate((published_zi, None)):
+            result = self._update_zone(zone_name, zi, 
+                    db_soa_serial=db_soa_serial,
+                    candidate_soa_serial=candidate_soa_serial,
+                    force_soa_serial_update=force_soa_serial_update,
+                    wrap_serial_next_time=wrap_serial_next_time,
+                    date_stamp=date_stamp, nsec3_seed=nsec3_seed,
+                    clear_dnskey=clear_dnskey, clear_nsec3=clear_nsec3,
+                    published_zi=attempt_zi, 
+                    last_attempt=(attempt > 0))
+            if result is not None:
+                return result
+
+    def _update_zone(self, zone_name, zi, db_soa_serial, 
+            candidate_soa_serial, force_soa_serial_update, 
+            wrap_serial_next_time, date_stamp, nsec3_seed, clear_dnskey,
+            clear_nsec3, published_zi, last_attempt):
+        """
+        Do the work for update_zone().  Returns None if a fast publish
+        update against published_zi failed, or if the server zone was left
+        part way through a batched update and this is not the last attempt,
+        so that the update can be done against the zone read in from the
+        server.
         """
+        # Fast publish - use published ZI if server zone unchanged since
+        published_zone = None
+        if published_zi:
+            published_zone = self._read_published_zone(zone_name, zi,
+                                    published_zi, db_soa_serial)
         # Read in via AXFR zone for comparison purposes
         try:
-            zone, dnskey_flag, nsec3param_flag = self.read_zone(zone_name)
+            if published_zone:
+                (zone_rrs, zi_rrs, dnskey_flag, 
+                        nsec3param_flag) = published_zone
+            else:
+                zone, dnskey_flag, nsec3param_flag = self.read_zone(zone_name)
+                zone_rrs = zone.iterate_rdatas()
+                zi_rrs = zi.iterate_dnspython_rrs
             update_info = {'dnskey_flag': dnskey_flag, 
                             'nsec3param_flag': nsec3param_flag}
         except NoSuchZoneOnServerError as exc:
@@ -135,12 +341,21 @@ class DynDNSUpdate(UpdateEngine):
             return (RCODE_FATAL, msg, None, None)
 
 
+        # Compare server_zone with zi.rrs
+        # Find additions and deletions. Server side is indexed once, and
+        # ZI side rediffed against it after SOA serial increment below.
+        soa_rdtype = dns.rdatatype.from_text(RRTYPE_SOA)
+        zone_diff = ZoneDiff(zone_rrs)
+
         # Get current SOA record for zone to include as prerequiste in update
         # Makes update transaction idempotent
-        current_soa_rr = zone.find_rdataset(zone.origin, RRTYPE_SOA).items[0]
+        current_soa = [rr for rr in zone_diff.server_index 
+                            if rr[2].rdtype == soa_rdtype][0]
+        current_soa_rr = current_soa[2]
+        current_soa_ttl = current_soa[1]
         
         update_soa_serial_flag = False
-        curr_serial_no = self.get_serial_no(zone)
+        curr_serial_no = current_soa_rr.serial
         # In case of a DR failover, our DB can have a more recent serial number
         # than in name server
         try:
@@ -161,12 +376,7 @@ class DynDNSUpdate(UpdateEngine):
             # An increment should only be performed after difference
             update_soa_serial_flag = True
 
-        # Compare server_zone with zi.rrs
-        # Find additions and deletions
-        del_rrs = [rr for rr in zone.iterate_rdatas()
-                    if rr not in zi.iterate_dnspython_rrs()]
-        add_rrs = [rr for rr in zi.iterate_dnspython_rrs()
-                    if rr not in zone.iterate_rdatas()]
+        del_rrs, add_rrs, ttl_rrs = zone_diff.diff(zi_rrs())
         # Check if DNSSEC settings need to be changed 
         do_clear_nsec3 = clear_nsec3 and nsec3param_flag
         do_clear_dnskey = clear_dnskey and dnskey_flag
@@ -179,14 +389,12 @@ class DynDNSUpdate(UpdateEngine):
             return (RCODE_NOCHANGE, msg, curr_serial_no, update_info)
       
         # Incremental update of SOA serial number
-        soa_rdtype = dns.rdatatype.from_text(RRTYPE_SOA)
         if update_soa_serial_flag:
             # Apply serial number to SOA record.
             zi.update_soa_serial(new_serial_no)
             # recalculate add_rrs - got to be done or else updates will be
             # missed
-            add_rrs = [rr for rr in zi.iterate_dnspython_rrs()
-                        if rr not in zone.iterate_rdatas()]
+            del_rrs, add_rrs, ttl_rrs = zone_diff.diff(zi_rrs())
        
         # Groom updates for DynDNS update perculiarities
 
@@ -242,32 +450,117 @@ class DynDNSUpdate(UpdateEngine):
         # We have to use absolute FQDNs on LHS  and RHS to make sure updates
         # to NS etc happen
         # While doing this also handle wee things for DNSSEC processing
+        # Large change sets are split into batches, chained together by
+        # SOA serial prerequisites.  Each batch except the last sets an
+        # interim SOA serial which becomes the next batch's prerequisite.
         origin = dns.name.from_text(zone_name)
-        update = dns.update.Update(origin, keyring=keyring,
-                    keyname = self.key_name, keyalgorithm=key_algorithm)
-        update.present(origin, current_soa_rr)
-        for rr in pre_add_rrs:
-            update.add(rr[0], rr[1], rr[2])
-        for rr in del_rrs:
-            update.delete(rr[0], rr[2])
-        # Add DNSSEC clearance stuff to end of delete section of update
+        soa_add_rrs = [rr for rr in add_rrs if rr[2].rdtype == soa_rdtype]
+        batches = self._batch_update_rrs(origin, pre_add_rrs, del_rrs, 
+                [rr for rr in add_rrs if rr[2].rdtype != soa_rdtype])
+        # DNSSEC clearance stuff
+        dnssec_clear_ops = []
         if do_clear_nsec3:
-            update.delete(origin, RRTYPE_NSEC3PARAM)
+            dnssec_clear_ops.append((UPDATE_DELETE, 
+                                        (origin, None, RRTYPE_NSEC3PARAM)))
         if do_clear_dnskey:
-            update.delete(origin, RRTYPE_DNSKEY)
-        for rr in add_rrs:
-            update.add(rr[0], rr[1], rr[2])
-        # NSEC3PARAM seeding
-        if do_nsec3_seed:
-            update.add(origin, '0', RRTYPE_NSEC3PARAM, nsec3param_rdata)
+            dnssec_clear_ops.append((UPDATE_DELETE, 
+                                        (origin, None, RRTYPE_DNSKEY)))
+        interim_soa_rdatas = []
+        if len(batches) == 1:
+            # One message, in the usual order.  DNSSEC clearance stuff at
+            # end of delete section, and the SOA RR along with the other
+            # adds.
+            batches = [[(UPDATE_ADD, rr) for rr in pre_add_rrs]
+                        + [(UPDATE_DELETE, rr) for rr in del_rrs]
+                        + dnssec_clear_ops
+                        + [(UPDATE_ADD, rr) for rr in add_rrs]]
+            soa_add_rrs = []
+        else:
+            # DNSSEC clearance stuff and the SOA RR go at the end of the 
+            # last batch
+            batches[-1].extend(dnssec_clear_ops)
+            interim_serial_no = curr_serial_no
+            for i in range(len(batches) - 1):
+                interim_serial_no = (interim_serial_no + 1) % (2**32)
+                soa_rdata = copy.copy(current_soa_rr)
+                soa_rdata.serial = interim_serial_no
+                interim_soa_rdatas.append(soa_rdata)
+            # Final SOA serial has to follow on from interim ones
+            try:
+                final_serial_no = new_soa_serial_no(interim_serial_no, 
+                        zone_name, db_soa_serial=db_soa_serial,
+                        candidate=new_serial_no)
+            except SOASerialError as exc:
+                msg = str(exc)
+                if (not sys.stdin.isatty()):
+                    log_critical(msg)
+                return (RCODE_FATAL, msg, None, None)
+            if final_serial_no != new_serial_no:
+                new_serial_no = final_serial_no
+                zi.update_soa_serial(new_serial_no)
+                soa_add_rrs = [rr for rr in zi_rrs()
+                                if rr[2].rdtype == soa_rdtype]
 
         # Do dee TING!
-        response = dns.query.tcp(update, self.server, port=self.port)
+        # All batches are sent down the one TCP connection
+        prereq_soa_rdata = current_soa_rr
+        batches_done = 0
+        try:
+            sock = self._tcp_connect()
+            try:
+                for i, batch in enumerate(batches):
+                    update = dns.update.Update(origin, keyring=keyring,
+                            keyname = self.key_name, 
+                            keyalgorithm=key_algorithm)
+                    update.present(origin, prereq_soa_rdata)
+                    for op, rr in batch:
+                        if op == UPDATE_DELETE:
+                            update.delete(rr[0], rr[2])
+                        else:
+                            update.add(rr[0], rr[1], rr[2])
+                    if i < len(batches) - 1:
+                        prereq_soa_rdata = interim_soa_rdatas[i]
+                        update.add(origin, current_soa_ttl, prereq_soa_rdata)
+                    else:
+                        for rr in soa_add_rrs:
+                            update.add(rr[0], rr[1], rr[2])
+                        # NSEC3PARAM seeding
+                        if do_nsec3_seed:
+                            update.add(origin, '0', RRTYPE_NSEC3PARAM, 
+                                    nsec3param_rdata)
+                    response = self._tcp_query(sock, update)
+                    if (response.rcode() not in self.success_rcodes):
+                        break
+                    batches_done += 1
+                    if len(batches) > 1:
+                        log_info("Zone '%s' - update batch %s of %s sent,"
+                                " %s RRs" % (zone_name, i + 1, len(batches),
+                                    len(batch)))
+            finally:
+                sock.close()
+        except (socket.error, EOFError, dns.exception.DNSException) as exc:
+            if 0 < batches_done < len(batches):
+                return self._batch_update_failed(zone_name, batches_done,
+                        interim_soa_rdatas, str(exc), update_info, 
+                        last_attempt)
+            msg = ("Zone '%s' - server %s:%s, update failed - %s"
+                    % (zone_name, self.server, self.port, str(exc)))
+            return (RCODE_ERROR, msg, None, update_info)
 
         # Process reply
         rcode = response.rcode()
         rcode_text = dns.rcode.to_text(response.rcode())
         success_rcodes = (dns.rcode.NOERROR)
+        if (batches_done and rcode not in self.success_rcodes):
+            return self._batch_update_failed(zone_name, batches_done,
+                    interim_soa_rdatas, rcode_text, update_info, 
+                    last_attempt)
+        if (published_zone and rcode not in self.success_rcodes):
+            # SOA prerequisite failed, or server zone otherwise not as 
+            # published.  Do it the long way.
+            log_info("Zone '%s' - fast publish update failed: %s - "
+                        "reading zone from server" % (zone_name, rcode_text))
+            return None
         if (rcode in self.success_rcodes):
             msg = ("Update '%s' to domain '%s' succeeded" 
                             % (new_serial_no, zone_name))
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3.2
+#
+# Copyright (c) Net24 Limited, Christchurch, New Zealand 2011-2012
+#       and     Voyager Internet Ltd, New Zealand, 2012-2013
+#
+#    This file is part of py-magcode-core.
+#
+#    Py-magcode-core is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU  General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Py-magcode-core is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU  General Public License for more details.
+#
+#    You should have received a copy of the GNU  General Public License
+#    along with py-magcode-core.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Partitioned event queue for dmsdmd
+
+Events are partitioned across a pool of worker threads by the state
+machine they belong to, so that events for different zones are processed
+in parallel, while the events for any one zone are processed in order on
+the one worker.  The same zone is thus never processed by two workers at
+once.
+"""
+
+
+import threading
+from queue import Full
+from traceback import format_exc
+
+from sqlalchemy.sql.expression import func
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.exc import SQLAlchemyError
+
+from magcode.core.globals_ import *
+from magcode.core.database import *
+from magcode.core.utility import get_numeric_setting
+from magcode.core.database.event import Event
+from magcode.core.database.event import EventQueue
+from magcode.core.database.event import EventAlreadyProcessing
+from magcode.core.database.event import QueueReset
+from magcode.core.database.event import event_states
+# import to initialise settings
+import dms.globals_
+
+
+def event_partition(event, partitions):
+    """
+    Work out the worker partition for an event.
+
+    Zone events are partitioned by zone, server events by server.  All
+    MasterSM events go to the one partition so that hold processing stays
+    in order.
+    """
+    if partitions <= 1:
+        return 0
+    if event.zone_id:
+        return event.zone_id % partitions
+    if event.server_id:
+        return event.server_id % partitions
+    if event.master_id:
+        return 0
+    return event.id_ % partitions
+
+
+class _EventPartition(EventQueue):
+    """
+    One worker partition of the DmsEventQueue.  A magcode EventQueue with
+    the one worker thread, so that its events are processed in order.
+    """
+    def _thread_top_up(self):
+        """
+        Restart the worker thread if it has died.
+        """
+        self.event_queue_threads = 1
+        self._threads = [thread for thread in self._threads 
+                                    if thread.is_alive()]
+        if not self._threads:
+            log_debug("_thread_top_up() - topping up partition thread")
+            self._thread_start()
+
+    def put(self, event):
+        """
+        Queue an event for the worker, without waiting if the queue is
+        full.
+        """
+        self._queue.put(event, block=False)
+
+    def join(self):
+        """
+        Wait for all queued events to be processed
+        """
+        self._queue.join()
+
+    def clean_up(self):
+        """
+        Clean up after a queue reset
+        """
+        self._queue.clean_up()
+
+
+class DmsEventQueue(EventQueue):
+    """
+    Event queue with a pool of workers, with events partitioned by zone.
+
+    The number of workers is set by 'dmsdmd_event_queue_threads', unless
+    given.
+    """
+    def __init__(self, threads=None):
+        """
+        Sets up partitions and worker threads
+        """
+        self._partitions = []
+        self._threads_arg = threads
+        super().__init__()
+
+    def _new_partitions(self, count):
+        """
+        Create the worker partitions.  Done in parallel, as each magcode
+        EventQueue pauses on creation to let its threads get established.
+        """
+        partitions = [None] * count
+        def new_partition(i):
+            partitions[i] = _EventPartition()
+        threads = [threading.Thread(target=new_partition, args=(i,))
+                        for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return partitions
+
+    def _thread_top_up(self):
+        """
+        Start the worker pool, and restart any workers that have died.
+        """
+        if self._threads_arg:
+            self.event_queue_threads = self._threads_arg
+        elif (debug()):
+            self.event_queue_threads = 1
+        else:
+            self.event_queue_threads = get_numeric_setting(
+                                        'dmsdmd_event_queue_threads', int)
+        if len(self._partitions) != self.event_queue_threads:
+            # Only ever done at start up
+            self._partitions = self._new_partitions(self.event_queue_threads)
+            return
+        for partition in self._partitions:
+            partition._thread_top_up()
+
+    def get_partition(self, event):
+        """
+        Return the worker partition for an event
+        """
+        return self._partitions[event_partition(event, 
+                                                    len(self._partitions))]
+
+    def join(self):
+        """
+        Wait for all queued events to be processed
+        """
+        for partition in self._partitions:
+            partition.join()
+
+    def queue_empty(self):
+        """
+        check if all the worker queues are empty
+        """
+        for partition in self._partitions:
+            if not partition.queue_empty():
+                return False
+        return True
+
+    def process_queue(self):
+        """
+        Read events from database, and place on the worker queues
+        """
+        # top up processor threads if any have died...
+        self._thread_top_up()
+        partitions = len(self._partitions)
+        # Read from sm_event_queue
+        db_session = sql_data['scoped_session_class']()
+        # Use flags to unchain exception handling.
+        info_str = None
+        error_str = None
+        full_partitions = []
+        try:
+            # Query ze events... Order by id as well so that events
+            # for a zone are queued in the order they were created
+            query_limit = (get_numeric_setting('event_queue_maxsize', int)
+                                * partitions)
+            for event in  db_session.query(Event)\
+                    .filter(Event.processed == None)\
+                    .filter(Event.event_type.in_(sql_data['event_type_list']))\
+                    .filter(Event.state.in_(event_states))\
+                    .filter(Event.scheduled <= func.statement_timestamp())\
+                    .order_by(Event.scheduled.asc(), Event.id_.asc())\
+                    .limit(query_limit):
+                partition = self.get_partition(event)
+                # Keep order of events in a partition if its queue fills
+                if partition in full_partitions:
+                    continue
+                try:
+                    # Don't hold up other workers if this one is backed up
+                    partition.put(event)
+                    self._event_count += 1
+                except EventAlreadyProcessing:
+                    continue
+                except Full:
+                    full_partitions.append(partition)
+                    continue
+                except QueueReset:
+                    log_info("process_queue() - queue reset detected, cleaning up and returning to main loop.")
+                    db_session.close()
+                    sql_data['scoped_session_class'].remove()
+                    # go back to main_process() after queue is emptied
+                    partition.clean_up()
+                    return
+                log_debug("process_queue() - queueing event id:'%s', "
+                          "event_type: '%s', state: '%s', scheduled '%s',"
+                          " created: '%s'"
+                                % (event.id_, event.event_type, event.state,
+                                    event.scheduled, event.created))
+
+            db_session.commit()
+
+        except DBAPIError as exc:
+            if is_db_connection_exception(exc.orig):
+                info_str = ("process_queue() exiting - PostgresQL database connection probably closed.\n"
+                            "         %s"
+                            % str_exc(exc))
+            else:
+                error_str = ("process_queue() exiting - unexpected error\n"
+                             "%s"  % format_exc(chain=True))
+
+            # close off session
+            db_session.close()
+        except SQLAlchemyError as exc:
+            error_str = ("process_queue() exiting - unexpected error\n"
+                         "%s"  % format_exc(chain=False))
+            # close off session
+            db_session.rollback()
+        # Unchain exception handling - Print any log messages
+        if (info_str):
+            log_info(info_str)
+        if (error_str):
+            log_error(error_str)
+
+        # Every so often, close session
+        if (self.event_queue_session_transactions
+                and self._event_count > self.event_queue_session_transactions):
+            self._event_count = 0
+            db_session.close()
+            sql_data['scoped_session_class'].remove()
+        # go back to main_process()
+        return
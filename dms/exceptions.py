@@ -184,6 +184,12 @@ class ZoneParseError(DMSError):
         if self.rdata_pyparsing:
             s = self.rdata_pyparsing['s']
             loc = self.rdata_pyparsing['loc']
+            line_offset = self.rdata_pyparsing.get('line_offset')
+            if line_offset:
+                # Text from a streamed zone file, put it back at its line
+                # in the file
+                s = '\n' * line_offset + s
+                loc += line_offset
             if beginning_loc:
                 # Put cursor at top if zone is inconsistent
                 loc = 0
@@ -2221,5 +2227,18 @@ class CantFailEventById(DMSError):
         self.jsonrpc_error = -130
         self.data['event_id'] = event_id
 
-# Next JSONRPC Error -131
+class RRHashColumnMissing(DMSError):
+    """
+    The DB resource_records table does not have the rr_hash column.  Apply
+    sql/rr_hash.sql to add it.
+    
+    * JSONRPC Error:      -131
+    """
+    def __init__(self):
+        message = ("DB resource_records table has no rr_hash column"
+                    " - apply sql/rr_hash.sql")
+        super().__init__(message)
+        self.jsonrpc_error = -131
+
+# Next JSONRPC Error -132
 
@@ -44,6 +44,11 @@ settings['panic_log'] = settings['log_dir'] \
 # DB settings to help prevent RAM piggery
 settings['db_query_slice'] = 1000
 settings['preconvert_int_settings'] += 'db_query_slice'
+# Seconds between checks that the in memory reverse network trie is still
+# in step with the database, if the database does not have the
+# reverse_networks_generation table (sql/reverse_networks_generation.sql).
+# Changes made by this process are seen at once.
+settings['reverse_network_check_interval'] = 10 # seconds
 # DB event queue columns
 # DO NOT CHANGE THIS UNLESS YOU KNOW WHAT YOU ARE DOING!
 settings['event_queue_fkey_columns'] = 'zone_id server_id master_id'
@@ -55,6 +60,10 @@ settings['debug_mark'] = False
 settings['sleep_time'] = 3 # seconds
 settings['debug_sleep_time'] = 20 # seconds
 settings['memory_exec_threshold'] = 250 #MB
+# Number of dmsdmd event queue worker threads.  Events are partitioned
+# over these by zone, so events for one zone are processed in order.  Other
+# processes keep the magcode 'event_queue_threads' setting.
+settings['dmsdmd_event_queue_threads'] = 8
 
 # dyndns_update.py
 settings['dig_path'] = 'dig'
@@ -76,6 +85,8 @@ settings['dyndns_success_rcodes'] = 'NOERROR'
 settings['dyndns_retry_rcodes'] = 'SERVFAIL NOTAUTH NXRRSET'
 settings['dyndns_reset_rcodes'] = 'NXDOMAIN'
 settings['dyndns_fatal_rcodes'] = 'BADVERS NOTIMP NOTZONE YXRRSET YXDOMAIN FORMERR REFUSED'
+# Maximum RRs per update message, larger updates are split. 0 for no limit
+settings['dyndns_update_batch_size'] = 1000
 
 # update_engine.py
 settings['dns_server'] = 'localhost'
@@ -86,6 +97,17 @@ settings['nsec3_salt_bit_length'] = 64
 settings['nsec3_hash_algorithm'] = 1
 settings['nsec3_flags'] = 1
 settings['nsec3_iterations'] = 10
+# Zone images kept for IXFR reads, 0 to always use AXFR.  Each image is
+# a whole dnspython zone, roughly 0.5 - 1 kB per RR, kept in every dmsdmd
+# process.  The cache is bounded by zone count and by total RRs.  On top
+# of that, the last zone read that is bigger than the RR bound is kept on
+# its own, so memory use can reach the RR bound plus that zone.  Raising
+# these costs memory against memory_exec_threshold above, so dmsdmd
+# re-execs sooner.
+settings['ixfr_zone_cache_size'] = 8
+settings['ixfr_zone_cache_rrs'] = 50000
+# Skip zone transfer on publish if server SOA serial matches published ZI
+settings['dyndns_fast_publish'] = True
 # Place for Update engines fo be registered.
 update_engine = {}
 
@@ -103,6 +125,14 @@ settings['rr_flag_disable'] = 'DISABLE'
 settings['rr_flag_ref'] = 'REF:'
 settings['rr_flag_rrop'] = 'RROP:'
 settings['rr_flag_trackrev'] = 'TRACKREV'
+# Use fast line tokenizer for zone files, falling back to pyparsing
+settings['zone_parser_fast_path'] = True
+# Streamed zone files are parsed this many lines at a time, and their RRs
+# added to the ZI this many at a time
+settings['zone_stream_chunk_lines'] = 10000
+settings['zone_stream_batch_rrs'] = 5000
+# Zone file output is written out in chunks of about this many lines
+settings['data_to_bind_buffer_lines'] = 8192
 
 #zone_cfg.py
 settings['apex_ns_key'] = 'apex_ns'
@@ -194,6 +224,8 @@ settings['admin_sectag'] = 'Admin'
 # Accept GET Method for JSON RPC request(s)
 # Some old JSON RPC libraries might need this...
 settings['jsonrpc_accept_get'] = False
+# Streamed JSON RPC results are sent in chunks of about this many bytes
+settings['jsonrpc_stream_chunk_size'] = 64 * 1024
 
 # cmdline_engine
 settings['zone_del_off_age'] = 1000 * 366 # days
@@ -201,6 +233,15 @@ settings['preconvert_float_settings'] += 'zone_del_off_age'
 
 # zone_engine.py
 settings['list_events_last_limit'] = 25
+# ZIs with this many RRs or more are streamed out from the DB by show_zone
+# and edit_zone JSON RPC calls.  0 to turn off
+settings['show_zone_stream_min_rrs'] = 10000
+
+# zi_render_cache.py
+# Rendered ZI JSON and zone file text kept per process, in characters.  0
+# to turn off caching
+settings['zi_render_cache_size'] = 64 * 1024 * 1024
+settings['zi_render_cache_max_age'] = 600 # seconds
 
 # zone_tool.py
 # admin_group_list shifted to magcode.core.globals_
@@ -210,6 +251,10 @@ settings['wsgi_test_commands'] = 'create_zi_zone cancel_edit_zone rr_query_db se
 settings['commands_not_to_syslog'] = 'help show EOF list quit exit rr ls'
 settings['zone_tool_log_facility'] = 'local7'
 settings['zone_tool_log_level'] = 'info'
+# load_zones zone file parsing worker processes, 0 for one per CPU.  Files
+# bigger than the max size are streamed by zone_tool itself.
+settings['load_zones_workers'] = 0
+settings['load_zones_worker_max_size'] = 64 * 1024 * 1024
 # zone_tool rndc  and key file stuff
 settings['config_template_dir'] = settings['config_dir'] + '/config-templates'
 settings['rndc_header_template'] = settings['config_template_dir'] \
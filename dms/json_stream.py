@@ -0,0 +1,211 @@
+#!/usr/bin/env python3.2
+#
+# Copyright (c) Net24 Limited, Christchurch, New Zealand 2011-2012
+#       and     Voyager Internet Ltd, New Zealand, 2012-2013
+#
+#    This file is part of py-magcode-core.
+#
+#    Py-magcode-core is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU  General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Py-magcode-core is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU  General Public License for more details.
+#
+#    You should have received a copy of the GNU  General Public License
+#    along with py-magcode-core.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Incremental JSON encoding of RPC results
+
+A result can hold a JsonStream in place of a list.  Its items are only
+read from the underlying iterator as the result is encoded, so that a
+large zone can be sent on without building the whole of it in memory.
+"""
+
+
+import json
+import time
+
+
+class JsonStream(object):
+    """
+    JSON array whose items are produced by an iterator as it is encoded.
+
+    Can only be encoded once.
+    """
+    def __init__(self, iterator):
+        self._iterator = iterator
+
+    def __iter__(self):
+        return iter(self._iterator)
+
+
+def has_json_stream(obj):
+    """
+    Check if a result has a JsonStream in it
+    """
+    if isinstance(obj, JsonStream):
+        return True
+    if isinstance(obj, dict):
+        obj = obj.values()
+    elif not isinstance(obj, (list, tuple)):
+        return False
+    for value in obj:
+        if has_json_stream(value):
+            return True
+    return False
+
+
+def iter_json(obj):
+    """
+    Encode obj as JSON a piece at a time, giving the same text as
+    json.dumps().  Only the parts of obj with a JsonStream in them are
+    encoded piece by piece, so JsonStreams can be nested.
+    """
+    if isinstance(obj, JsonStream):
+        yield '['
+        first = True
+        for item in obj:
+            if first:
+                first = False
+            else:
+                yield ', '
+            if isinstance(item, (dict, list, tuple, JsonStream)):
+                for chunk in iter_json(item):
+                    yield chunk
+            else:
+                yield json.dumps(item)
+        yield ']'
+    elif not has_json_stream(obj):
+        yield json.dumps(obj)
+    elif isinstance(obj, dict):
+        yield '{'
+        first = True
+        for key, value in obj.items():
+            # Encode key as json.dumps() does, as it may not be a str
+            key = json.dumps({key: None})[1:-len(': null}')]
+            if first:
+                first = False
+                yield key + ': '
+            else:
+                yield ', ' + key + ': '
+            for chunk in iter_json(value):
+                yield chunk
+        yield '}'
+    else:
+        yield '['
+        first = True
+        for value in obj:
+            if first:
+                first = False
+            else:
+                yield ', '
+            for chunk in iter_json(value):
+                yield chunk
+        yield ']'
+
+
+def iter_json_bytes(obj, chunk_size, encoding='iso-8859-1'):
+    """
+    Encode obj as JSON, in byte chunks of about chunk_size
+    """
+    chunks = []
+    size = 0
+    for chunk in iter_json(obj):
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= chunk_size:
+            yield ''.join(chunks).encode(encoding)
+            chunks = []
+            size = 0
+    if chunks:
+        yield ''.join(chunks).encode(encoding)
+
+
+# Test by using:    from dms.json_stream import *
+#                   test_iter_json()
+_test_json_data = {
+        'name': 'example.org.',
+        'zone_id': 23,
+        'use_apex_ns': True,
+        'deleted': None,
+        'sectags': ['Admin', 'HelpDesk'],
+        'edit': ({'a': 1.5}, 'token'),
+        7: 'int key',
+        'text': 'café "quoted" \\ \n',
+        'empty': {},
+        'empty_list': [],
+        }
+
+def _test_rr_groups(groups, rrs):
+    for g in range(groups):
+        yield {'comment': 'Group %s' % g, 'tag': None,
+            'rrs': [{'label': 'host%s' % r, 'type': 'A', 'ttl': None,
+                    'rdata': '192.0.2.%s' % (r % 256), 'disable': False}
+                    for r in range(rrs)]}
+
+def test_iter_json():
+    """
+    Check iter_json() output against json.dumps()
+    """
+    result = _test_json_data.copy()
+    result['rr_groups'] = list(_test_rr_groups(3, 4))
+    result['nested'] = {'empty_groups': []}
+    expected = json.dumps(result)
+    result['rr_groups'] = JsonStream(_test_rr_groups(3, 4))
+    result['nested'] = {'empty_groups': JsonStream(iter(()))}
+    if not has_json_stream(result):
+        raise AssertionError('has_json_stream() did not find JsonStream')
+    if has_json_stream(_test_json_data):
+        raise AssertionError('has_json_stream() found JsonStream')
+    output = b''.join(iter_json_bytes(result, 100)).decode('iso-8859-1')
+    if output != expected:
+        raise AssertionError('iter_json() output differs from json.dumps()')
+
+    # One big group, as in a zone with no comments, should have its RRs
+    # encoded as they are read
+    rrs_read = []
+    def iter_rrs(rr_group):
+        for rr in rr_group['rrs']:
+            rrs_read.append(rr)
+            yield rr
+    rr_group = list(_test_rr_groups(1, 1000))[0]
+    expected = json.dumps({'rr_groups': [rr_group]})
+    result = {'rr_groups': JsonStream(iter([{'comment': rr_group['comment'],
+                    'tag': rr_group['tag'],
+                    'rrs': JsonStream(iter_rrs(rr_group))}]))}
+    output = []
+    for chunk in iter_json_bytes(result, 100):
+        if not output and len(rrs_read) >= len(rr_group['rrs']):
+            raise AssertionError('iter_json() read whole group before '
+                                    'encoding it')
+        output.append(chunk)
+    if b''.join(output).decode('iso-8859-1') != expected:
+        raise AssertionError('iter_json() nested output differs from '
+                                'json.dumps()')
+    print('iter_json() test passed')
+
+# Benchmark by using:   from dms.json_stream import *
+#                       benchmark_iter_json()
+def benchmark_iter_json(groups=1000, rrs=100, chunk_size=65536):
+    """
+    Print time to encode a zone sized result with json.dumps() and
+    iter_json_bytes()
+    """
+    start = time.time()
+    output = json.dumps({'zi': {'rr_groups':
+                list(_test_rr_groups(groups, rrs))}}).encode('iso-8859-1')
+    elapsed = time.time() - start
+    print('json.dumps():       %8.3f s, %s bytes' % (elapsed, len(output)))
+    start = time.time()
+    size = 0
+    for chunk in iter_json_bytes({'zi': {'rr_groups':
+                JsonStream(_test_rr_groups(groups, rrs))}}, chunk_size):
+        size += len(chunk)
+    elapsed = time.time() - start
+    print('iter_json_bytes():  %8.3f s, %s bytes' % (elapsed, size))
+
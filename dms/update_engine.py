@@ -23,7 +23,11 @@ Base Update Engine class.  Contains common code.
 """
 
 import socket
+import errno
+import threading
 from datetime import datetime
+from collections import OrderedDict
+from itertools import chain
 
 import dns.query
 import dns.resolver
@@ -34,10 +38,12 @@ import dns.name
 import dns.message
 import dns.rdataclass
 import dns.flags
+import dns.rcode
 
 from dms.exceptions import SOASerialArithmeticError
 from dms.exceptions import NoSuchZoneOnServerError
 from magcode.core.globals_ import settings
+from magcode.core.utility import get_numeric_setting
 from magcode.core.database import RCODE_FATAL
 from magcode.core.database import RCODE_RESET
 from magcode.core.database import RCODE_OK
@@ -75,6 +81,214 @@ class UpdateEngine(object):
         self.port_name = dest_port
         self.server = sockaddr[0]
         self.port = sockaddr[1]
+        # Cache of last transferred zone images, for IXFR. Locked as
+        # the update engine is shared by the event queue threads
+        self._zone_cache = OrderedDict()
+        self._zone_cache_rrs = 0
+        # One zone bigger than the RR bound, kept outside of it
+        self._zone_cache_big = None
+        self._zone_cache_lock = threading.Lock()
+
+    def _get_dnssec_rdtypes(self):
+        """
+        Return DNSSEC filter rdtypes, and the DNSKEY and NSEC3PARAM rdtypes
+        """
+        dnssec_types = settings['dnssec_filter'].split()
+        dnssec_rdtypes = [dns.rdatatype.from_text(x) for x in dnssec_types]
+        dnskey_rdtype = dns.rdatatype.from_text(RRTYPE_DNSKEY)
+        nsec3param_rdtype = dns.rdatatype.from_text(RRTYPE_NSEC3PARAM)
+        return (dnssec_rdtypes, dnskey_rdtype, nsec3param_rdtype)
+
+    def _cache_zone(self, zone_name, zone, dnssec_rrs):
+        """
+        Save a zone image and its SOA serial for the next IXFR.
+
+        The cache is bounded by zone count and by total RR count, least
+        recently used images going first.  The last zone read that is
+        bigger than the RR bound is kept on its own outside of the bound,
+        as the biggest zones are where IXFR saves the most.
+        """
+        cache_size = get_numeric_setting('ixfr_zone_cache_size', int)
+        cache_rrs = get_numeric_setting('ixfr_zone_cache_rrs', int)
+        if (not cache_size or cache_size <= 0
+                or not cache_rrs or cache_rrs <= 0):
+            return
+        key = zone_name.lower()
+        zone_rrs = sum(len(rdataset) for node in zone.nodes.values()
+                                        for rdataset in node)
+        cached = {'serial': self.get_serial_no(zone), 'zone': zone,
+                    'dnssec_rrs': dnssec_rrs, 'rrs': zone_rrs}
+        with self._zone_cache_lock:
+            self._uncache_zone(key)
+            if zone_rrs > cache_rrs:
+                self._zone_cache_big = (key, cached)
+                return
+            self._zone_cache[key] = cached
+            self._zone_cache_rrs += zone_rrs
+            while (len(self._zone_cache) > cache_size
+                    or self._zone_cache_rrs > cache_rrs):
+                old_key, old_cached = self._zone_cache.popitem(last=False)
+                self._zone_cache_rrs -= old_cached['rrs']
+
+    def _uncache_zone(self, key):
+        """
+        Take a zone image out of the cache, returning it.  Call with
+        cache lock held.
+        """
+        if self._zone_cache_big and self._zone_cache_big[0] == key:
+            cached = self._zone_cache_big[1]
+            self._zone_cache_big = None
+            return cached
+        cached = self._zone_cache.pop(key, None)
+        if cached:
+            self._zone_cache_rrs -= cached['rrs']
+        return cached
+
+    def clear_zone_cache(self, zone_name=None):
+        """
+        Forget cached zone image(s), so that next read is an AXFR.
+
+        Needed when the zone file on the server is replaced.
+        """
+        with self._zone_cache_lock:
+            if not zone_name:
+                self._zone_cache.clear()
+                self._zone_cache_rrs = 0
+                self._zone_cache_big = None
+                return
+            self._uncache_zone(zone_name.lower())
+
+    def _xfr_rrs(self, xfr_generator):
+        """
+        Flatten XFR messages into a stream of (name, ttl, rdata) tuples
+        """
+        for message in xfr_generator:
+            for rrset in message.answer:
+                for rdata in rrset:
+                    yield (rrset.name, rrset.ttl, rdata)
+
+    def _zone_add_rr(self, zone, rr):
+        """
+        Add a (name, ttl, rdata) tuple to a dnspython zone
+        """
+        name, ttl, rdata = rr
+        rdataset = zone.find_rdataset(name, rdata.rdtype, rdata.covers(),
+                                        create=True)
+        rdataset.add(rdata, ttl)
+
+    def _zone_delete_rr(self, zone, rr):
+        """
+        Delete a (name, ttl, rdata) tuple from a dnspython zone
+        """
+        name, ttl, rdata = rr
+        rdataset = zone.get_rdataset(name, rdata.rdtype, rdata.covers())
+        if rdataset is None:
+            return
+        rdataset.discard(rdata)
+        if not len(rdataset):
+            zone.delete_rdataset(name, rdata.rdtype, rdata.covers())
+
+    def _read_zone_ixfr(self, zone_name):
+        """
+        Bring the cached zone image up to date via IXFR.
+
+        Returns None if the IXFR could not be done, so that caller falls
+        back to AXFR.
+        """
+        # Take zone image out of cache while updating it, so that a failure
+        # part way through does not leave a corrupted image cached
+        with self._zone_cache_lock:
+            cached = self._uncache_zone(zone_name.lower())
+        if not cached:
+            return None
+        zone = cached['zone']
+        dnssec_rrs = cached['dnssec_rrs']
+        dnssec_rdtypes, dnskey_rdtype, nsec3param_rdtype \
+                = self._get_dnssec_rdtypes()
+        soa_rdtype = dns.rdatatype.from_text(RRTYPE_SOA)
+
+        def apply_rr(rr, delete_mode):
+            rdtype = rr[2].rdtype
+            if rdtype in (dnskey_rdtype, nsec3param_rdtype):
+                if delete_mode:
+                    dnssec_rrs[rdtype].discard((rr[0], rr[2]))
+                else:
+                    dnssec_rrs[rdtype].add((rr[0], rr[2]))
+            if rdtype in dnssec_rdtypes:
+                return
+            if delete_mode:
+                self._zone_delete_rr(zone, rr)
+            else:
+                self._zone_add_rr(zone, rr)
+
+        xfr_generator = dns.query.xfr(self.server, zone_name, port=self.port,
+                            rdtype=dns.rdatatype.IXFR,
+                            serial=cached['serial'])
+        try:
+            rrs = self._xfr_rrs(xfr_generator)
+            first_rr = next(rrs, None)
+            if not first_rr or first_rr[2].rdtype != soa_rdtype:
+                return None
+            new_serial = first_rr[2].serial
+            second_rr = next(rrs, None)
+            if not second_rr:
+                # Single SOA reply - zone is up to date.  Don't trust server
+                # if its serial number has gone backwards
+                if new_serial != cached['serial']:
+                    return None
+            elif second_rr[2].rdtype != soa_rdtype:
+                # AXFR style reply, as IXFR journal is gone. Rebuild zone
+                # from what has been sent.
+                zone, dnssec_rrs = self._zone_from_rrs(zone.origin,
+                                        chain((first_rr, second_rr), rrs))
+            elif second_rr[2].serial != cached['serial']:
+                return None
+            else:
+                # IXFR difference sequences.  Each sequence is old SOA,
+                # deleted RRs, new SOA, added RRs.  Last RR is the final SOA
+                delete_mode = True
+                for rr in rrs:
+                    if (rr[2].rdtype == soa_rdtype
+                            and rr[0] == first_rr[0]):
+                        delete_mode = not delete_mode
+                        if not delete_mode:
+                            zone.delete_rdataset(rr[0], soa_rdtype)
+                            self._zone_add_rr(zone, rr)
+                        continue
+                    apply_rr(rr, delete_mode)
+        except (dns.exception.DNSException, EOFError, IOError, OSError) \
+                as exc:
+            return None
+        finally:
+            del xfr_generator
+        if self.get_serial_no(zone) != new_serial:
+            return None
+        self._cache_zone(zone_name, zone, dnssec_rrs)
+        return (zone, bool(dnssec_rrs[dnskey_rdtype]), 
+                    bool(dnssec_rrs[nsec3param_rdtype]))
+
+    def _zone_from_rrs(self, origin, rrs, filter_dnssec=True):
+        """
+        Build a dnspython zone from a stream of (name, ttl, rdata) tuples
+        as they arrive from a zone transfer.
+
+        DNSSEC RRs are dropped as they are seen if filter_dnssec is set,
+        so a signed zone is never held in memory.  The DNSKEY and
+        NSEC3PARAM RRs are recorded for setting the DNSSEC flags.  
+        Returns a tuple of the zone, and the dnssec_rrs dict.
+        """
+        dnssec_rdtypes, dnskey_rdtype, nsec3param_rdtype \
+                = self._get_dnssec_rdtypes()
+        zone = dns.zone.Zone(origin, rdclass=dns.rdataclass.IN)
+        dnssec_rrs = {dnskey_rdtype: set(), nsec3param_rdtype: set()}
+        for rr in rrs:
+            rdtype = rr[2].rdtype
+            if rdtype in dnssec_rrs:
+                dnssec_rrs[rdtype].add((rr[0], rr[2]))
+            if filter_dnssec and rdtype in dnssec_rdtypes:
+                continue
+            self._zone_add_rr(zone, rr)
+        return (zone, dnssec_rrs)
 
     def read_zone(self, zone_name, filter_dnssec=True):
         """
@@ -82,11 +296,23 @@ class UpdateEngine(object):
         
         Returns a Zone Instance based on the read in data.
         NOTE: This is not from the DB!
+
+        The filtered zone image is kept so that the next read can be done 
+        by IXFR, falling back to AXFR if the IXFR fails.
         """
+        if filter_dnssec:
+            result = self._read_zone_ixfr(zone_name)
+            if result:
+                return result
+        # Filter out dnssec if requested, as the transfer streams in.
         xfr_generator = dns.query.xfr(self.server, zone_name, port=self.port)
         try:
-            zone = dns.zone.from_xfr(xfr_generator)
-        except dns.exception.FormError as exc:
+            zone, dnssec_rrs = self._zone_from_rrs(
+                                    dns.name.from_text(zone_name),
+                                    self._xfr_rrs(xfr_generator),
+                                    filter_dnssec)
+            zone.check_origin()
+        except (dns.exception.FormError, dns.zone.BadZone) as exc:
             zone = None
         finally:
             del xfr_generator
@@ -95,28 +321,12 @@ class UpdateEngine(object):
             raise NoSuchZoneOnServerError(zone_name, self.server_name, 
                                             self.port)
 
-        # Filter out dnssec if requested.
-        dnssec_types = settings['dnssec_filter'].split()
-        dnssec_rdtypes = [dns.rdatatype.from_text(x) for x in dnssec_types]
-        nsec3param_rdtype = dns.rdatatype.from_text(RRTYPE_NSEC3PARAM)
-        dnskey_rdtype = dns.rdatatype.from_text(RRTYPE_DNSKEY)
-        # Need to find items to delete before deleting them, or
-        # else zone data structure is corrupted.
-        rr_delete_list = []
-        dnskey_flag = False
-        nsec3param_flag = False
-        for rdata in zone.iterate_rdatas():
-            if not dnskey_flag:
-                dnskey_flag = (rdata[2].rdtype == dnskey_rdtype)
-            if not nsec3param_flag:
-                nsec3param_flag = (rdata[2].rdtype == nsec3param_rdtype)
-            if rdata[2].rdtype in dnssec_rdtypes:
-                rr_delete_list.append((rdata[0], rdata[2].rdtype, 
-                        rdata[2].covers(),))
-        # Finally delete all unwanted records
+        dnssec_rdtypes, dnskey_rdtype, nsec3param_rdtype \
+                = self._get_dnssec_rdtypes()
+        dnskey_flag = bool(dnssec_rrs[dnskey_rdtype])
+        nsec3param_flag = bool(dnssec_rrs[nsec3param_rdtype])
         if filter_dnssec:
-            for (name, rdtype, covers) in rr_delete_list:
-                zone.delete_rdataset(name, rdtype, covers)
+            self._cache_zone(zone_name, zone, dnssec_rrs)
         # Finally, an unclutered zone without DNSSEC
         return (zone, dnskey_flag, nsec3param_flag)
 
@@ -155,8 +365,8 @@ class UpdateEngine(object):
         #                % (zone_name, server.server_name))
         #    return (RCODE_FATAL, msg, None)
         except socket.error as exc:
-            if errno in (errno.EACCESS, errno.EPERM, errno.ECONNREFUSED, 
-                    errno.ENETUNREACHABLE, errno.ETIMEDOUT):
+            if exc.errno in (errno.EACCES, errno.EPERM, errno.ECONNREFUSED, 
+                    errno.ENETUNREACH, errno.ETIMEDOUT):
                 msg = ("Zone '%s' - can't reach server %s:%s yet - %s"
                         % (zone_name, self.server, self.port, exc.strerror))
                 return (RCODE_ERROR, msg, None)
@@ -187,6 +397,34 @@ class UpdateEngine(object):
             # clean up memory
             del answer
 
+    def read_dnssec_flags(self, zone_name):
+        """
+        Use dnspython to query the apex DNSKEY and NSEC3PARAM RRsets of a 
+        zone.
+
+        Returns a (dnskey_flag, nsec3param_flag) tuple, or None if the
+        zone could not be queried.  Used instead of the flags found when
+        reading in the whole zone.
+        """
+        zone = dns.name.from_text(zone_name)
+        flags = []
+        for rdtype_text in (RRTYPE_DNSKEY, RRTYPE_NSEC3PARAM):
+            rdtype = dns.rdatatype.from_text(rdtype_text)
+            query = dns.message.make_query(zone, rdtype, dns.rdataclass.IN)
+            try:
+                answer = dns.query.tcp(query, self.server, port=self.port,
+                        timeout=float(settings['dns_query_timeout']))
+            except (dns.exception.DNSException, socket.error) as exc:
+                return None
+            finally:
+                del query
+            if (answer.rcode() != dns.rcode.NOERROR 
+                    or answer.flags & dns.flags.AA != dns.flags.AA):
+                return None
+            flags.append(bool([rrset for rrset in answer.answer
+                                if rrset.rdtype == rdtype and len(rrset)]))
+        return tuple(flags)
+
     def get_serial_no(self, zone):
         """
         Obtain the serial number from the SOA of a zone
@@ -199,7 +437,7 @@ class UpdateEngine(object):
             candidate_soa_serial=None,
             force_soa_serial_update=False, wrap_serial_next_time=False,
             date_stamp=None, nsec3_seed=False, clear_dnskey=False,
-            clear_nsec3=False):
+            clear_nsec3=False, published_zi=None):
         """
         Stub method for updating a zone.
 
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3.2
+#
+# Copyright (c) Net24 Limited, Christchurch, New Zealand 2011-2012
+#       and     Voyager Internet Ltd, New Zealand, 2012-2013
+#
+#    This file is part of py-magcode-core.
+#
+#    Py-magcode-core is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU  General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Py-magcode-core is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU  General Public License for more details.
+#
+#    You should have received a copy of the GNU  General Public License
+#    along with py-magcode-core.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Render cache for zone instance data and zone file text
+
+A ZI is not changed once published, apart from apex and TTL maintenance
+which updates the ZI mtime.  ZI data rendered as JSON and as zone file
+text can thus be cached against the ZI id and mtime, and reused by the
+zone engine until the ZI changes.
+"""
+
+
+import json
+import time
+import threading
+from collections import OrderedDict
+
+from magcode.core.globals_ import settings
+from magcode.core.utility import get_numeric_setting
+# initialise settings keys
+import dms.globals_
+
+
+class ZiRenderCache(object):
+    """
+    Size bounded LRU cache of rendered ZI text, by key.
+
+    Size is counted in characters of cached text.  Entries also expire
+    after 'zi_render_cache_max_age' seconds, to bound the life of any
+    entry left stale by a change not reflected in the ZI mtime.  Locked
+    as the cache is shared by WSGI threads.
+    """
+    def __init__(self):
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Return cached text for key, or None if not cached
+        """
+        max_age = get_numeric_setting('zi_render_cache_max_age', int)
+        with self._cache_lock:
+            entry = self._cache.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            text, cache_time = entry
+            if max_age and time.time() - cache_time > max_age:
+                self._size -= len(text)
+                self.misses += 1
+                return None
+            # Move to most recently used end
+            self._cache[key] = entry
+            self.hits += 1
+            return text
+
+    def put(self, key, text):
+        """
+        Cache text for key, evicting least recently used entries to keep
+        within 'zi_render_cache_size'
+        """
+        cache_size = get_numeric_setting('zi_render_cache_size', int)
+        if not cache_size or cache_size <= 0 or len(text) > cache_size:
+            return
+        with self._cache_lock:
+            entry = self._cache.pop(key, None)
+            if entry is not None:
+                self._size -= len(entry[0])
+            self._cache[key] = (text, time.time())
+            self._size += len(text)
+            while self._size > cache_size:
+                old_key, old_entry = self._cache.popitem(last=False)
+                self._size -= len(old_entry[0])
+
+    def clear(self):
+        """
+        Forget all cached text
+        """
+        with self._cache_lock:
+            self._cache.clear()
+            self._size = 0
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get_zi_data(self, zi, time_format, use_apex_ns, all_rrs):
+        """
+        Return zi.to_data() output, via the cache.  A fresh copy of the
+        data is returned on each call, so callers may change it.
+        """
+        if zi.id_ is None or zi.mtime is None:
+            return zi.to_data(time_format, use_apex_ns, all_rrs)
+        key = ('json', zi.id_, zi.mtime, time_format, all_rrs, use_apex_ns)
+        json_text = self.get(key)
+        if json_text is not None:
+            return json.loads(json_text)
+        zi_data = zi.to_data(time_format, use_apex_ns, all_rrs)
+        self.put(key, json.dumps(zi_data, separators=(',', ':')))
+        return zi_data
+
+    def get_zi_text(self, zi, time_format, use_apex_ns, all_rrs, name,
+            reference, render):
+        """
+        Return zone file text for a ZI, via the cache.  render is called
+        with the ZI data to produce the text if it is not cached.
+        """
+        if zi.id_ is None or zi.mtime is None:
+            return render(zi.to_data(time_format, use_apex_ns, all_rrs))
+        key = ('text', zi.id_, zi.mtime, time_format, all_rrs, use_apex_ns,
+                name, reference)
+        zi_text = self.get(key)
+        if zi_text is not None:
+            return zi_text
+        zi_text = render(self.get_zi_data(zi, time_format, use_apex_ns,
+                                            all_rrs))
+        self.put(key, zi_text)
+        return zi_text
+
+
+# Shared by all zone engines in a process
+zi_render_cache = ZiRenderCache()
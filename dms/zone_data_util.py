@@ -26,14 +26,17 @@ Split out so that changes can be seen more easily
 
 
 import re
+import time
 from copy import copy
 
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy import text
+from sqlalchemy import func
 
 from magcode.core.globals_ import *
 from magcode.core.database import sql_types
+from magcode.core.utility import get_numeric_setting
 from dms.globals_ import *
 from dms.exceptions import *
 from dms.auto_ptr_util import check_auto_ptr_privilege
@@ -59,17 +62,192 @@ import dms.database.zone_cfg as zone_cfg
 from dms.database.zone_sm import exec_zonesm
 from dms.database.zone_sm import ZoneSMDoRefresh
 from dms.database.zone_sm import ZoneSM
+from dms.database.zone_sm import ZSTATE_DELETED
 from dms.database.reverse_network import ReverseNetwork
+from dms.database.reverse_network import find_reverse_zone_ids
 from dms.database.zone_instance import ZoneInstance
 from dms.database.rr_comment import RRComment
 from dms.database.resource_record import data_to_rr
 from dms.database.resource_record import RR_PTR
+from dms.database.resource_record import RR_SOA
+from dms.database.resource_record import RR_NS
+from dms.database.resource_record import RR_A
+from dms.database.resource_record import RR_CNAME
+from dms.database.resource_record import RR_MX
 from dms.database.resource_record import ResourceRecord
 from dms.database.reference import find_reference
 from dms.database.zi_update import ZiUpdate
 from dms.database.update_group import new_update_group
 
 
+# Reserve blocks of ids from the RR and comment sequences in one round trip,
+# so that new rows can be inserted in batches by SQLAlchemy at flush time 
+# instead of one INSERT ... RETURNING id each.
+_reserve_comment_ids_sql = text("""
+SELECT nextval('rr_comments_id_seq') FROM generate_series(1, :count)""")
+_reserve_rr_ids_sql = text("""
+SELECT nextval('resource_records_id_seq') FROM generate_series(1, :count)""")
+
+
+def _rr_group_batches(rr_groups, batch_rrs):
+    """
+    Batch up an iterator of RR groups into lists of RR groups with about
+    batch_rrs RRs in each.
+    """
+    batch = []
+    rr_count = 0
+    for rr_group in rr_groups:
+        batch.append(rr_group)
+        rr_count += len(rr_group['rrs'])
+        if rr_count >= batch_rrs:
+            yield batch
+            batch = []
+            rr_count = 0
+    if batch:
+        yield batch
+
+
+class ZiConsistencyIndex(object):
+    """
+    Label, type and rdata index of a list of RRs, for consistency checking.
+
+    Built once, and then kept in step with the RR list as RRs are added
+    and removed, so that each consistency check is a hash look up rather
+    than a scan of the whole zone.  Labels are compared as strings, as
+    the original list scans did.
+    """
+
+    def __init__(self, rrs=None):
+        """
+        Initialise index, loading any given RRs
+        """
+        self._rrs = None
+        self._count = 0
+        self._rr_ids = {}
+        self._rr_buckets = {}
+        self._label_types = {}
+        self._soa_count = 0
+        self.cname_count = 0
+        if rrs is not None:
+            self.rebuild(rrs)
+
+    def rebuild(self, rrs):
+        """
+        Index a list of RRs from scratch
+        """
+        self.__init__()
+        for rr in rrs:
+            self.add_rr(rr)
+        self._rrs = rrs
+
+    @staticmethod
+    def _bucket_key(rr):
+        """
+        Key for duplicate RR checks.  Only RRs in the same bucket are
+        compared, as per ResourceRecord.__eq__(), so that the dnspython
+        rdata of the rest of the zone does not have to be built.
+        """
+        return (rr.label.lower(), rr.type_)
+
+    def _count_key(self, dict_, key, delta):
+        count = dict_.get(key, 0) + delta
+        if count > 0:
+            dict_[key] = count
+        else:
+            dict_.pop(key, None)
+
+    def add_rr(self, rr):
+        """
+        Add an RR to the index
+        """
+        self._rr_ids[id(rr)] = rr
+        self._count += 1
+        self._rr_buckets.setdefault(self._bucket_key(rr), []).append(rr)
+        self._count_key(self._label_types.setdefault(rr.label, {}), 
+                        rr.type_, 1)
+        if rr.type_ == RRTYPE_SOA:
+            self._soa_count += 1
+        elif rr.type_ == RRTYPE_CNAME:
+            self.cname_count += 1
+
+    def remove_rr(self, rr):
+        """
+        Remove an RR from the index
+        """
+        if self._rr_ids.pop(id(rr), None) is None:
+            return
+        self._count -= 1
+        bucket_key = self._bucket_key(rr)
+        bucket = self._rr_buckets.get(bucket_key, [])
+        for i in range(len(bucket)):
+            if bucket[i] is rr:
+                del bucket[i]
+                break
+        if not bucket:
+            self._rr_buckets.pop(bucket_key, None)
+        types = self._label_types.get(rr.label, {})
+        self._count_key(types, rr.type_, -1)
+        if not types:
+            self._label_types.pop(rr.label, None)
+        if rr.type_ == RRTYPE_SOA:
+            self._soa_count -= 1
+        elif rr.type_ == RRTYPE_CNAME:
+            self.cname_count -= 1
+
+    def sync(self, rrs, removed_rrs=None):
+        """
+        Bring index into step with the RR list, given the RRs removed from
+        it since last time.  RRs are only ever appended to the list, so
+        anything beyond the indexed count is new.  Anything unexpected
+        causes a rebuild.
+        """
+        if rrs is not self._rrs:
+            self.rebuild(rrs)
+            return
+        if removed_rrs:
+            for rr in removed_rrs:
+                self.remove_rr(rr)
+        if len(rrs) < self._count:
+            self.rebuild(rrs)
+            return
+        for rr in rrs[self._count:]:
+            self.add_rr(rr)
+
+    def has_rr(self, rr):
+        """
+        Check if a matching RR is in the index
+        """
+        for r in self._rr_buckets.get(self._bucket_key(rr), []):
+            if r == rr:
+                return True
+        return False
+
+    def has_label(self, label):
+        """
+        Check if there are any RRs for a label
+        """
+        return label in self._label_types
+
+    def type_count(self, label, type_):
+        """
+        Number of RRs of type for label
+        """
+        return self._label_types.get(label, {}).get(type_, 0)
+
+    def other_type_count(self, label, type_):
+        """
+        Number of RRs not of type for label
+        """
+        types = self._label_types.get(label, {})
+        return sum(types.values()) - types.get(type_, 0)
+
+    def soa_count(self):
+        """
+        Number of SOA RRs
+        """
+        return self._soa_count
+
+
 class DataTools(object):
     """
     Container class for methods and runtime data for consistency 
@@ -87,11 +265,28 @@ class DataTools(object):
         self.zi_rr_data = {}
         self.auto_ptr_data = []
         self.apex_comment = None
+        self.rr_index = ZiConsistencyIndex()
+        # Ids reserved from database sequences for bulk ingestion
+        self._comment_ids = []
+        self._rr_ids = []
+        # References looked up so far, by lower case reference string
+        self._references = {}
+        # RRs removed from zone by last add_rr_func() call in add_rrs()
+        self._removed_rrs = None
+
+    def _get_rr_index(self, rrs):
+        """
+        Return consistency index, brought up to date with rrs
+        """
+        self.rr_index.sync(rrs, self._removed_rrs)
+        self._removed_rrs = None
+        return self.rr_index
 
     def check_rr_consistency(self, rrs, rr, rr_data, update_group):
         """
         Check that RR can be consistently added to zone
         """
+        rr_index = self._get_rr_index(rrs)
         # Skip for any RROP_DELETE
         if update_group and rr.update_op and rr.update_op == RROP_DELETE:
             return
@@ -99,13 +294,12 @@ class DataTools(object):
         if (not update_group or not rr.update_op 
                 or rr.update_op != RROP_UPDATE_RRTYPE): 
             # Duplicate Record check
-            if rr in rrs:
+            if rr_index.has_rr(rr):
                 raise DuplicateRecordInZone(self.name, rr_data)
             
             # Can't add another SOA if there is one there already
             if rr.type_ == RRTYPE_SOA:
-                num_soa = len([r for r in rrs if r.type_ == RRTYPE_SOA])
-                if num_soa:
+                if rr_index.soa_count():
                     raise ZoneAlreadyHasSOARecord(self.name, rr_data)
 
         # CNAME addition check
@@ -115,9 +309,7 @@ class DataTools(object):
         # anti-CNAME addition check
         if self.zi_cname_flag:
             # Find any cnames with rr label and barf
-            num_lbls = len([ r for r in rrs 
-                            if (r.type_ == RRTYPE_CNAME 
-                                and r.label == rr.label)])
+            num_lbls = rr_index.type_count(rr.label, RRTYPE_CNAME)
             # Check that we are not updating an existing CNAME
             if (num_lbls and update_group and rr.update_op 
                     and rr.update_op == RROP_UPDATE_RRTYPE
@@ -130,13 +322,16 @@ class DataTools(object):
         """
         Check consistency of zone instance
         """
+        # Index whole zone once
+        rr_index = ZiConsistencyIndex(rrs)
         # CNAME check
-        rr_cnames = [r for r in rrs if r.type_ == RRTYPE_CNAME]
-        for rr in rr_cnames:
-            clash = len([ r for r in rrs 
-                    if (r.label == rr.label and r.type_ != RRTYPE_CNAME)])
-            if clash:
-                raise ZoneCNAMELabelExists(self.name, self.zi_rr_data[str(rr)])
+        if rr_index.cname_count:
+            for rr in rrs:
+                if rr.type_ != RRTYPE_CNAME:
+                    continue
+                if rr_index.other_type_count(rr.label, RRTYPE_CNAME):
+                    raise ZoneCNAMELabelExists(self.name, 
+                                                self.zi_rr_data[str(rr)])
         # Check NS MX and SRV records point to actual A 
         # and AAAA records if they are in zone 
         # (Bind Option check-integrity)
@@ -145,8 +340,7 @@ class DataTools(object):
                                                 and r.label != '@']
         for rr in rr_nss:
             if not rr.rdata.endswith('.'):
-                target_hosts = [r for r in rrs if r.label == rr.rdata]
-                if not len(target_hosts):
+                if not rr_index.has_label(rr.rdata):
                     raise ZoneCheckIntegrityNoGlue(self.name, 
                             self.zi_rr_data[str(rr)], rr.rdata)
         # MX
@@ -154,8 +348,7 @@ class DataTools(object):
         for rr in rr_mxs:
             if not rr.rdata.endswith('.'):
                 rdata = rr.rdata.split()
-                target_hosts = [r for r in rrs if r.label == rdata[1]]
-                if not len(target_hosts):
+                if not rr_index.has_label(rdata[1]):
                     raise ZoneCheckIntegrityNoGlue(self.name, 
                             self.zi_rr_data[str(rr)], rdata[1])
 
@@ -164,9 +357,7 @@ class DataTools(object):
         for rr in rr_srvs:
             if not rr.rdata.endswith('.'):
                 rdata = rr.rdata.split()
-
-                target_hosts = [r for r in rrs if r.label == rdata[3]]
-                if not len(target_hosts):
+                if not rr_index.has_label(rdata[3]):
                     raise ZoneCheckIntegrityNoGlue(self.name, 
                             self.zi_rr_data[str(rr)], rdata[3])
 
@@ -185,9 +376,72 @@ class DataTools(object):
             raise ZoneSOARecordNotAtApex(self.name, 
                                 self.zi_rr_data[str(rr_soas[0])])
         # Check that apex has at least 1 NS record
-        rr_nss = [r for r in rrs if r.type_ == RRTYPE_NS 
-                and r.label == '@']
-        if not rr_nss:
+        if not rr_index.type_count('@', RRTYPE_NS):
+            raise ZoneHasNoNSRecord(self.name, 
+                                        self.zi_rr_data[str(rr_soas[0])])
+
+    def check_pzi_consistency(self, pzi):
+        """
+        Check consistency of an incremental update, trial run on a
+        PseudoZi.  Only the labels touched by the update are checked, along
+        with the apex, using the index kept in step by add_rrs().
+        """
+        rr_index = self._get_rr_index(pzi.rrs)
+        touched_labels = set([l.lower() for l in pzi.touched_labels])
+        rrs = [r for r in pzi.rrs if r.label.lower() in touched_labels]
+        # CNAME check
+        if rr_index.cname_count:
+            for rr in rrs:
+                if rr.type_ != RRTYPE_CNAME:
+                    continue
+                if rr_index.other_type_count(rr.label, RRTYPE_CNAME):
+                    raise ZoneCNAMELabelExists(self.name, 
+                                                self.zi_rr_data[str(rr)])
+        # Check NS MX and SRV records point to actual A 
+        # and AAAA records if they are in zone 
+        # (Bind Option check-integrity)
+        for rr in rrs:
+            if rr.type_ == RRTYPE_NS and rr.label != '@':
+                glue = rr.rdata
+            elif rr.type_ == RRTYPE_MX:
+                glue = rr.rdata.split()[1]
+            elif rr.type_ == RRTYPE_SRV:
+                glue = rr.rdata.split()[3]
+            else:
+                continue
+            if rr.rdata.endswith('.'):
+                continue
+            pzi.load_label(glue)
+            rr_index = self._get_rr_index(pzi.rrs)
+            if not rr_index.has_label(glue):
+                raise ZoneCheckIntegrityNoGlue(self.name, 
+                        self.zi_rr_data[str(rr)], glue)
+        # Touched labels left empty can't be glue for the rest of the zone
+        for label, op_rr in pzi.touched_labels.items():
+            if rr_index.has_label(label):
+                continue
+            if pzi.find_glue_users(label):
+                raise ZoneCheckIntegrityNoGlue(self.name,
+                        self.zi_rr_data[str(op_rr)], label)
+        rr_index = self._get_rr_index(pzi.rrs)
+
+        # If NS records are part of the zone, no point in doing
+        # sanity checks as client will not be sending any SOAs
+        if self.zone_sm.use_apex_ns:
+            return
+        # Check that zi has 1 SOA, and that its for the apex '@'. Any SOA
+        # added elsewhere is on a touched label.
+        rr_soas = [r for r in pzi.rrs if r.type_ == RRTYPE_SOA]
+        if not rr_soas:
+            raise ZoneHasNoSOARecord(self.name)
+        if len(rr_soas) > 1:
+            raise ZoneAlreadyHasSOARecord(self.name, 
+                                self.zi_rr_data[str(rr_soas[1])])
+        if rr_soas[0].label != '@':
+            raise ZoneSOARecordNotAtApex(self.name, 
+                                self.zi_rr_data[str(rr_soas[0])])
+        # Check that apex has at least 1 NS record
+        if not rr_index.type_count('@', RRTYPE_NS):
             raise ZoneHasNoNSRecord(self.name, 
                                         self.zi_rr_data[str(rr_soas[0])])
 
@@ -271,6 +525,25 @@ class DataTools(object):
                                         'reference')
                 rr_data.pop('reference', None)
 
+    def _reserve_ids(self, reserve_sql, count):
+        """
+        Reserve count ids from a database sequence.  Returned in
+        descending order, so that pop() hands them out in ascending order.
+        """
+        if not count:
+            return []
+        result = self.db_session.execute(reserve_sql, {'count': count})
+        return sorted([row[0] for row in result], reverse=True)
+
+    def find_reference(self, ref_str):
+        """
+        Find a reference, looking each distinct reference up only once
+        """
+        key = ref_str.lower()
+        if key not in self._references:
+            self._references[key] = find_reference(self.db_session, ref_str)
+        return self._references[key]
+
     def add_comment(self, top_comment, comment=None, tag=None, **kwargs):
         """
         Add a new comment or apex_comment
@@ -293,9 +566,15 @@ class DataTools(object):
 
         # Create a new comment
         rr_comment = RRComment(comment=comment, tag=tag)
-        db_session.add(rr_comment)
-        # Need to flush to get a new id from database
-        db_session.flush()
+        if self._comment_ids:
+            # Use id reserved by rr_data_create_comments(), row will be 
+            # inserted in a batch with the rest at next flush
+            rr_comment.id_ = self._comment_ids.pop()
+            db_session.add(rr_comment)
+        else:
+            db_session.add(rr_comment)
+            # Need to flush to get a new id from database
+            db_session.flush()
         if (rr_comment.tag == settings['apex_rr_tag']):
             self.apex_comment = rr_comment
         return rr_comment.id_
@@ -307,20 +586,31 @@ class DataTools(object):
         return self.apex_comment
     
     def rr_data_create_comments(self, zi_data, zone_ttl, 
-            creating_real_zi=True):
+            creating_real_zi=True, rr_groups_offset=0):
         """
         Common code for creating comments, and creating comment IDs
+
+        rr_groups_offset is the index of the first RR group, when RR groups
+        are being handled in batches.
         """
         # Get comment IDs created and established.
         rr_group_data = zi_data.get('rr_groups')
-        for rr_group in rr_group_data:
-            rr_groups_index = rr_group_data.index(rr_group)
+        # Reserve enough comment ids for all the comments in one go. Any
+        # not used just leave a gap in the sequence.
+        num_comments = (len(rr_group_data) 
+                + len([rr_data for rr_group in rr_group_data 
+                                for rr_data in rr_group['rrs'] 
+                                if rr_data.get('comment')]))
+        self._comment_ids = self._reserve_ids(_reserve_comment_ids_sql,
+                                                num_comments)
+        for rr_groups_index, rr_group in enumerate(rr_group_data,
+                                                    rr_groups_offset):
             top_comment = creating_real_zi and rr_groups_index == 0
             comment_group_id =  self.add_comment(top_comment, **rr_group)
             rr_group['comment_group_id'] = comment_group_id
-            for rr_data in rr_group['rrs']:
+            for rrs_index, rr_data in enumerate(rr_group['rrs']):
                 # get rr_groups_index and rrs_index for error handling
-                rr_data['rrs_index'] = rr_group['rrs'].index(rr_data)
+                rr_data['rrs_index'] = rrs_index
                 rr_data['rr_groups_index'] = rr_groups_index
                 # Handle comment IDs
                 rr_data['comment_rr_id'] = self.add_comment(False, **rr_data)
@@ -333,7 +623,7 @@ class DataTools(object):
 
     def add_rrs(self, rrs_func, add_rr_func, 
                 admin_privilege, helpdesk_privilege,
-                update_group=None):
+                update_group=None, touch_rr_func=None):
         """
         Add RR to data base
         
@@ -343,8 +633,14 @@ class DataTools(object):
         which is different to the case of incremental updates, where the 
         list of RRs is constructed, and the rrs just added directly to the
         resource records table.
+
+        touch_rr_func, if given, is called with each RR before it is
+        checked, so that the RRs it is checked against can be read in.
         """
         db_session = self.db_session
+        # Reserve RR ids in one go so RRs are inserted in batches at flush
+        self._rr_ids = self._reserve_ids(_reserve_rr_ids_sql,
+                sum([len(rr_group['rrs']) for rr_group in self.rr_group_data]))
         for rr_group in self.rr_group_data:
             for rr_data in rr_group['rrs']:
                 # Remove unneeded keys from rr_data
@@ -354,55 +650,136 @@ class DataTools(object):
                 self.check_extra_data_privilege(rr_data, admin_privilege,
                         helpdesk_privilege)
                 rr = data_to_rr(self.name, rr_data)
+                if touch_rr_func:
+                    touch_rr_func(rr)
                 self.check_rr_consistency(rrs_func(), rr, rr_data, update_group)
                 # Store rr_data for zi consistency checks
                 self.put_zi_rr_data(str(rr), rr_data)
                 # Add rr to SQLAlchemy data structures
+                if self._rr_ids:
+                    rr.id_ = self._rr_ids.pop()
                 db_session.add(rr)
                 # Sort out RR reference part of the data structure
                 rr_ref_str = rr_data.get('reference')
                 if rr_ref_str: 
                     self.check_reference_string(rr_ref_str)
-                    rr_ref = find_reference(db_session, rr_ref_str)
+                    rr_ref = self.find_reference(rr_ref_str)
                     rr.ref_id = rr_ref.id_ if rr_ref else None
                     rr.reference = rr_ref
                 # Sort out update_group if given
                 if update_group:
                     update_group.update_ops.append(rr)
-                add_rr_func(rr)
+                # add_rr_func() may return RRs it removes from the zone
+                self._removed_rrs = add_rr_func(rr)
                 self.handle_auto_ptr_data(rr, rr_data)
 
 class PseudoZi(ZiUpdate):
     """
     Dummy ZI class so that ZiUpdate operations can do a trial run, so that 
     incremental updates can be consistency checked by zi checking code.
+
+    Copy on write overlay of the ZI, read in lazily.  Only the RRs of the
+    apex and of the labels the update touches, or that they refer to, are
+    read in, a label at a time.  The RR list is a plain list of the ZI's
+    own RR objects, so that changes to it do not trigger SQLAlchemy, and
+    RRs are only created for the update operations.  The ZI's RRs are
+    never modified by trial operations, only removed from the list.
     """
 
     def __init__(self, db_session, zi):
         # make sure ZiUpdate runs in trial mode
         ZiUpdate.__init__(self, db_session=db_session, trial_run=True)
-        # Copy rrs list so that changes do not trigger SQAlchemy
+        self.zi_id = zi.id_
         self.rrs = []
-        for rr in zi.rrs:
-            rr_type = sql_types[type(rr).__name__]
-            new_rr = rr_type(label=rr.label, domain=zi.zone.name, 
-                    ttl=rr.ttl, zone_ttl=rr.zone_ttl,
-                    rdata=rr.rdata, lock_ptr=rr.lock_ptr, disable=rr.disable,
-                    track_reverse=rr.track_reverse)
-            self.rrs.append(new_rr)
+        # Labels touched by the update, with the first update RR for each
+        self.touched_labels = {}
+        # Labels are read in case insensitively, so kept in lower case
+        self._loaded_labels = set()
+        # Apex is always needed for the SOA and NS checks
+        self.load_label('@')
 
+    def _query_rrs(self):
+        """
+        Query for the ZI's RRs.  Pending update RRs are not flushed by it.
+        """
+        return self.db_session.query(ResourceRecord)\
+                .filter(ResourceRecord.zi_id == self.zi_id)\
+                .autoflush(False)
+
+    def load_label(self, label):
+        """
+        Read in the RRs for a label from the ZI, if not already done.
+        Labels are matched case insensitively, as in DNS.
+        """
+        label = label.lower()
+        if label in self._loaded_labels:
+            return
+        self._loaded_labels.add(label)
+        for rr in self._query_rrs()\
+                .filter(func.lower(ResourceRecord.label) == label):
+            self.rrs.append(rr)
+            self._rr_index_add(rr)
+
+    def touch_rr(self, rr):
+        """
+        Read in the RRs for the label of an update RR, before it is checked
+        and trial run
+        """
+        self.touched_labels.setdefault(rr.label, rr)
+        self.load_label(rr.label)
+
+    def has_type(self, type_):
+        """
+        Check if the ZI has any RRs of a type, without reading them in
+        """
+        return self.db_session.query(ResourceRecord.id_)\
+                .filter(ResourceRecord.zi_id == self.zi_id)\
+                .filter(ResourceRecord.type_ == type_)\
+                .autoflush(False).first() is not None
+
+    @staticmethod
+    def _uses_glue(rr, label):
+        """
+        Check if an RR uses label as glue, as checked by 
+        DataTools.check_zi_consistency()
+        """
+        if rr.type_ == RRTYPE_NS:
+            if rr.label == '@':
+                return False
+        elif rr.type_ not in (RRTYPE_MX, RRTYPE_SRV):
+            return False
+        return rr.rdata.split()[-1] == label
+
+    def find_glue_users(self, label):
+        """
+        Read in the labels of the NS, MX and SRV RRs in the ZI that use
+        label as glue, and return those RRs still in the RR list
+        """
+        like_label = (label.replace('\\', '\\\\').replace('%', '\\%')
+                        .replace('_', '\\_'))
+        query = self._query_rrs()\
+                .filter(ResourceRecord.type_.in_(
+                            [RRTYPE_NS, RRTYPE_MX, RRTYPE_SRV]))\
+                .filter(ResourceRecord.rdata.like('%' + like_label, 
+                                                            escape='\\'))
+        for rr in query:
+            if self._uses_glue(rr, label):
+                self.load_label(rr.label)
+        return [rr for rr in self.rrs if self._uses_glue(rr, label)]
 
     def add_rr(self, rr):
         """
         Add RR to rrs list
         """
         self.rrs.append(rr)
+        self._rr_index_add(rr)
 
     def remove_rr(self, rr):
         """
         Remove rr from rrs list
         """
         self.rrs.remove(rr)
+        self._rr_index_remove(rr)
 
 class ZoneDataUtil(object):
     """
@@ -414,6 +791,10 @@ class ZoneDataUtil(object):
                 admin_privilege=False, helpdesk_privilege=False):
         """
         Construct a new ZI, RRS and comments, from zone_data.
+
+        zi_data['rr_groups'] can be an iterator, as from
+        dms.zone_text_util.bind_to_data_stream(), in which case the RR
+        groups are added to the ZI in batches as they are read.
         """
             
         def set_missing_zi_data():
@@ -477,6 +858,14 @@ class ZoneDataUtil(object):
                 zone_cfg.get_row_exc(db_session, 'zone_ttl', sg=zone_sm.sg))
         zone_ttl_supplied = 'zone_ttl' in zi_data
 
+        # Streamed RR groups are handled in batches.  $TTL has to come 
+        # before any RRs, so zone_ttl is already known.
+        rr_group_batches = None
+        if not isinstance(zi_data.get('rr_groups', []), list):
+            rr_group_batches = _rr_group_batches(zi_data.pop('rr_groups'),
+                    get_numeric_setting('zone_stream_batch_rrs', int))
+            zi_data['rr_groups'] = next(rr_group_batches, [])
+
         # Create comments, and set up comment IDs, and stuff for handlng
         # RR Groups zi_data structures
         data_tools.rr_data_create_comments(zi_data, zone_ttl)
@@ -498,6 +887,24 @@ class ZoneDataUtil(object):
         # function
         data_tools.add_rrs(lambda :zi.rrs, zi.add_rr,
                 admin_privilege, helpdesk_privilege)
+        if rr_group_batches is not None:
+            rr_groups_index = len(data_tools.rr_group_data)
+            for rr_group_batch in rr_group_batches:
+                # Write out previous batch
+                db_session.flush()
+                data_tools.rr_data_create_comments(
+                        {'rr_groups': rr_group_batch}, zone_ttl,
+                        rr_groups_offset=rr_groups_index)
+                data_tools.add_rrs(lambda :zi.rrs, zi.add_rr,
+                        admin_privilege, helpdesk_privilege)
+                rr_groups_index += len(rr_group_batch)
+            # SOA fields can turn up later on in a streamed zone file
+            set_missing_zi_data()
+            check_zi_data()
+            for field in ('soa_serial', 'soa_refresh', 'soa_retry',
+                    'soa_expire', 'soa_minimum', 'soa_mname', 'soa_rname',
+                    'soa_ttl'):
+                setattr(zi, field, zi_data.get(field))
 
         # tie zi into data_structures
         zone_sm.all_zis.append(zi)
@@ -552,13 +959,11 @@ class ZoneDataUtil(object):
         # Get value of zone_ttl so that RRs can be created
         zone_ttl = zi.zone_ttl
 
-        # Create RRs list from published ZI
+        # Overlay of candidate ZI, read in as the update touches it
         pzi = PseudoZi(db_session, zi)
 
         # initialise data and zone consistency checking
-        zi_cname_flag = False
-        if len([r for r in pzi.rrs if r.type_ == RRTYPE_CNAME]):
-            zi_cname_flag = True
+        zi_cname_flag = pzi.has_type(RRTYPE_CNAME)
         data_tools = DataTools(db_session, zone_sm, zi_cname_flag)
 
         # Create comments, and set up comment IDs, and stuff for handlng
@@ -574,9 +979,10 @@ class ZoneDataUtil(object):
 
         # Add RRs to DB and operate on Pseudo ZI
         data_tools.add_rrs(lambda :pzi.rrs, pzi.trial_op_rr,
-            admin_privilege, helpdesk_privilege, update_group=update_group)
+            admin_privilege, helpdesk_privilege, update_group=update_group,
+            touch_rr_func=pzi.touch_rr)
 
-        data_tools.check_zi_consistency(pzi.rrs)
+        data_tools.check_pzi_consistency(pzi)
 
         # Get all data out to DB, and ids etc established.
         db_session.flush()
@@ -598,22 +1004,46 @@ class ZoneDataUtil(object):
         if not settings['auto_reverse']:
             return
         db_session = self.db_session
+        # Find reverse zones for all addresses in one go.  Ignore addresses
+        # we don't have reverse zone for
+        zone_ids = find_reverse_zone_ids(db_session, 
+                        [ptr_data['address'] for ptr_data in auto_ptr_data],
+                        exclude_state=ZSTATE_DELETED, inc_updates_only=True)
+        zone_sms = {}
+        if zone_ids:
+            for zone_sm in db_session.query(ZoneSM)\
+                    .filter(ZoneSM.id_.in_(list(set(zone_ids.values())))):
+                zone_sms[zone_sm.id_] = zone_sm
+        # Group PTR labels by reverse zone, for old PTR queries below
+        zone_labels = {}
+        for ptr_data in auto_ptr_data:
+            zone_sm = zone_sms.get(zone_ids.get(ptr_data['address']))
+            if not zone_sm:
+                continue
+            label = label_from_address(ptr_data['address'])
+            qlabel = label[:label.rfind(zone_sm.name)-1]
+            zone_labels.setdefault(zone_sm, set()).add(qlabel)
+        # Candidate ZI zone_ttls for reverse zones, in one query.
+        # Use candidate ZI as it always is available.  zi is published zi
+        zone_ttls = {}
+        zi_ids = [zone_sm.zi_candidate_id for zone_sm in zone_labels 
+                        if zone_sm.zi_candidate_id]
+        if zi_ids:
+            for zi in db_session.query(ZoneInstance)\
+                    .filter(ZoneInstance.id_.in_(zi_ids)):
+                zone_ttls[zi.id_] = zi.zone_ttl
+        # Old PTR records, read per reverse zone when first needed
+        zone_old_rrs = {}
+        # References, looked up once each
+        references = {}
+
         # Create new update_group
         ug_dict = {}
         auto_ptr_privilege_flag = False
         for ptr_data in auto_ptr_data:
             # Ignore addresses we don't have reverse zone for
-            query = db_session.query(ZoneSM)\
-                    .join(ReverseNetwork)\
-                    .filter(text(":address  <<= reverse_networks.network"))\
-                    .params(address = ptr_data['address'])
-            query = ZoneSM.query_is_not_deleted(query)
-            query = ZoneSM.query_inc_updates(query)
-            query = query.order_by(ReverseNetwork.network.desc())\
-                    .limit(1)
-            try:
-                zone_sm = query.one()
-            except NoResultFound:
+            zone_sm = zone_sms.get(zone_ids.get(ptr_data['address']))
+            if not zone_sm:
                 continue
 
             # Ignore invalid host names
@@ -633,20 +1063,28 @@ class ZoneDataUtil(object):
             #1 See if old PTR exists to retrieve any RR reference
             # Both following also used lower down when generating RR_PTR
             label = label_from_address(ptr_data['address'])
-            rr_ref = find_reference(db_session, ptr_data['reference'],
-                                        raise_exc=False)
-            # query for old record - this generates one select
+            if ptr_data['reference'] not in references:
+                references[ptr_data['reference']] = find_reference(db_session,
+                                    ptr_data['reference'], raise_exc=False)
+            rr_ref = references[ptr_data['reference']]
+            # query for old records - this generates one select per zone
             # Optimization  - if check has previously suceeded, don't check
             # again as this is all checked further in
             if not auto_ptr_privilege_flag:
                 qlabel= label[:label.rfind(zone_sm.name)-1]
-                query = db_session.query(ResourceRecord)\
-                    .filter(ResourceRecord.label == qlabel)\
-                    .filter(ResourceRecord.zi_id == zone_sm.zi_candidate_id)\
-                    .filter(ResourceRecord.disable == False)\
-                    .filter(ResourceRecord.type_ == RRTYPE_PTR)
-                old_rrs = query.all()
-                old_rr = old_rrs[0] if len(old_rrs) else None
+                if zone_sm not in zone_old_rrs:
+                    old_rrs = {}
+                    query = db_session.query(ResourceRecord)\
+                        .filter(ResourceRecord.label.in_(list(
+                                                    zone_labels[zone_sm])))\
+                        .filter(ResourceRecord.zi_id 
+                                            == zone_sm.zi_candidate_id)\
+                        .filter(ResourceRecord.disable == False)\
+                        .filter(ResourceRecord.type_ == RRTYPE_PTR)
+                    for rr in query:
+                        old_rrs.setdefault(rr.label, rr)
+                    zone_old_rrs[zone_sm] = old_rrs
+                old_rr = zone_old_rrs[zone_sm].get(qlabel)
                 
             # Check that we can proceed, only if check has not succeded yet
                 if not check_auto_ptr_privilege(rr_ref, self.sectag, zone_sm,
@@ -677,14 +1115,11 @@ class ZoneDataUtil(object):
                 update_group, zone_ttl = ug_dict.get(zone_sm)
             except (ValueError, TypeError):
                 # Obtain reverse zone_ttl so PTR rrs can be created
-                # Use candidate ZI as it always is available.
-                # zi is published zi
-                zi = self._get_zi(zone_sm.zi_candidate_id)
-                if not zi:
+                zone_ttl = zone_ttls.get(zone_sm.zi_candidate_id)
+                if not zone_ttl:
                     log_error("Zone '%s': does not have candidate zi." 
                                 % zone_sm.name)
                     continue
-                zone_ttl = zi.zone_ttl
                 update_group = new_update_group(db_session, None, 
                                         zone_sm, None, ptr_only=True, 
                                         sectag=self.sectag.sectag)
@@ -709,3 +1144,56 @@ class ZoneDataUtil(object):
             exec_zonesm(zone_sm, ZoneSMDoRefresh)
         # Make sure everything is committed
         db_session.commit()
+
+
+# Benchmark by using:   from dms.zone_data_util import *
+#                       benchmark_consistency_check()
+class _BenchmarkZoneSM(object):
+    """
+    Fake zone_sm, for benchmarking
+    """
+    def __init__(self, name):
+        self.name = name
+        self.use_apex_ns = False
+
+
+def _benchmark_zone_rrs(name, size):
+    """
+    Generate synthetic zone RRs for benchmarking
+    """
+    yield RR_SOA(label='@', zone_ttl=3600, domain=name, 
+            rdata='ns1 hostmaster 1 600 600 86400 600')
+    yield RR_NS(label='@', zone_ttl=3600, domain=name, rdata='ns1')
+    yield RR_A(label='ns1', zone_ttl=3600, domain=name, rdata='192.0.2.1')
+    yield RR_MX(label='@', zone_ttl=3600, domain=name, rdata='10 ns1')
+    for i in range(size):
+        label = 'host%s' % i
+        if i % 10:
+            yield RR_A(label=label, zone_ttl=3600, domain=name,
+                    rdata='10.%s.%s.%s' % (i // 65536 % 256, i // 256 % 256, 
+                                            i % 256))
+        else:
+            yield RR_CNAME(label=label, zone_ttl=3600, domain=name,
+                    rdata='ns1')
+
+def benchmark_consistency_check(sizes=(10000, 100000)):
+    """
+    Print consistency check time against zone size, for RR by RR checks
+    while loading a zone, and the whole zone check at the end.
+    """
+    name = 'benchmark.example.'
+    for size in sizes:
+        rrs_in = list(_benchmark_zone_rrs(name, size))
+        data_tools = DataTools(None, _BenchmarkZoneSM(name))
+        rrs = []
+        start = time.time()
+        for rr in rrs_in:
+            data_tools.check_rr_consistency(rrs, rr, {}, None)
+            data_tools.put_zi_rr_data(str(rr), {})
+            rrs.append(rr)
+        rr_elapsed = time.time() - start
+        start = time.time()
+        data_tools.check_zi_consistency(rrs)
+        zi_elapsed = time.time() - start
+        print('%8s RRs: %8.3f s RR checks, %8.3f s ZI check' 
+                % (len(rrs), rr_elapsed, zi_elapsed))
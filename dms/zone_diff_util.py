@@ -0,0 +1,163 @@
+#!/usr/bin/env python3.2
+#
+# Copyright (c) Net24 Limited, Christchurch, New Zealand 2011-2012
+#       and     Voyager Internet Ltd, New Zealand, 2012-2013
+#
+#    This file is part of py-magcode-core.
+#
+#    Py-magcode-core is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU  General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Py-magcode-core is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU  General Public License for more details.
+#
+#    You should have received a copy of the GNU  General Public License
+#    along with py-magcode-core.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Module for working out the differences between zone data sets
+
+Used by the update engines to compare what is on the DNS server with a
+ZI.  Both sides are indexed into hash tables so that the comparison is
+linear in the size of the zone.
+"""
+
+
+import time
+
+import dns.name
+import dns.rdata
+import dns.rdataclass
+import dns.rdatatype
+
+
+class RRIndex(object):
+    """
+    Hashed index of dnspython (name, ttl, rdata) RR tuples.
+
+    dnspython Name objects hash and compare case insensitively, and Rdata
+    objects hash and compare on their canonical wire format, so the RR
+    tuples themselves serve as canonical keys.
+    """
+
+    def __init__(self, rrs=None):
+        """
+        Initialise index, loading any given RR tuples
+        """
+        self.rrs = []
+        self._rr_set = set()
+        self._ttl_dict = {}
+        if rrs is not None:
+            for rr in rrs:
+                self.add(rr)
+
+    def add(self, rr):
+        """
+        Add a dnspython RR tuple to the index
+        """
+        rr = tuple(rr)
+        self.rrs.append(rr)
+        self._rr_set.add(rr)
+        self._ttl_dict[(rr[0], rr[2])] = rr[1]
+
+    def get_ttl(self, name, rdata):
+        """
+        Return the TTL for the given name and rdata, or None if not indexed
+        """
+        return self._ttl_dict.get((name, rdata))
+
+    def __contains__(self, rr):
+        return tuple(rr) in self._rr_set
+
+    def __iter__(self):
+        return iter(self.rrs)
+
+    def __len__(self):
+        return len(self.rrs)
+
+
+class ZoneDiff(object):
+    """
+    Work out the differences between server zone data and a ZI.
+
+    The server side index is built once, and the ZI side can be diffed
+    against it as many times as needed, ie after an SOA serial number
+    increment.  dnspython rdata can be changed in place (SOA serial), so
+    the ZI side is always re-indexed on each diff.
+    """
+
+    def __init__(self, server_rrs):
+        """
+        Index server side RRs
+        """
+        self.server_index = RRIndex(server_rrs)
+        self.del_rrs = []
+        self.add_rrs = []
+        self.ttl_rrs = []
+
+    def diff(self, zi_rrs):
+        """
+        Diff ZI RRs against the server RRs.
+
+        Returns a tuple of RRs to delete, RRs to add, and the subset of
+        RRs to add that only differ from the server by TTL.  Ordering
+        follows that of the input RRs.
+        """
+        server_index = self.server_index
+        zi_index = RRIndex(zi_rrs)
+        self.del_rrs = [rr for rr in server_index if rr not in zi_index]
+        self.add_rrs = [rr for rr in zi_index if rr not in server_index]
+        self.ttl_rrs = [rr for rr in self.add_rrs
+                    if server_index.get_ttl(rr[0], rr[2]) is not None]
+        return (self.del_rrs, self.add_rrs, self.ttl_rrs)
+
+    def is_empty(self):
+        """
+        Check if last diff found no differences
+        """
+        return (not self.del_rrs and not self.add_rrs)
+
+
+def diff_zone_rrs(server_rrs, zi_rrs):
+    """
+    One shot diff of server RRs against ZI RRs
+
+    Returns a tuple of RRs to delete, RRs to add, and TTL only changes
+    """
+    return ZoneDiff(server_rrs).diff(zi_rrs)
+
+
+# Benchmark by using:   from dms.zone_diff_util import *
+#                       benchmark_zone_diff()
+def _benchmark_rrs(size, ttl=3600, offset=0):
+    """
+    Generate synthetic PTR RR tuples for benchmarking
+    """
+    rdclass = dns.rdataclass.IN
+    rdtype = dns.rdatatype.PTR
+    for i in range(size):
+        label = dns.name.from_text('%s.%s' % (i % 256, i // 256), None)
+        rdata = dns.rdata.from_text(rdclass, rdtype,
+                            'host%s.example.net.' % (i + offset))
+        yield (label, ttl, rdata)
+
+def benchmark_zone_diff(sizes=(1000, 10000, 50000, 100000), change=100):
+    """
+    Print diff time against zone size, with 'change' RRs added, 'change'
+    deleted, and 'change' TTL only changes.
+    """
+    for size in sizes:
+        server_rrs = list(_benchmark_rrs(size))
+        zi_rrs = server_rrs[change:]
+        zi_rrs[:change] = [(rr[0], rr[1] + 1, rr[2])
+                                for rr in zi_rrs[:change]]
+        zi_rrs.extend(_benchmark_rrs(change, offset=size))
+        start = time.time()
+        del_rrs, add_rrs, ttl_rrs = diff_zone_rrs(server_rrs, zi_rrs)
+        elapsed = time.time() - start
+        print('%8s RRs: %8.3f s - %s deletes, %s adds, %s TTL changes'
+                % (size, elapsed, len(del_rrs), len(add_rrs), len(ttl_rrs)))
@@ -98,6 +98,7 @@ from magcode.core.wsgi.jsonrpc_server import InvalidParamsJsonRpcError
 from dms.exceptions import *
 from dms.database.zone_query import rr_query_db_raw
 from dms.zone_data_util import ZoneDataUtil
+from dms.zi_render_cache import zi_render_cache
 from dms.dns import is_inet_domain
 from dms.dns import is_network_address
 from dms.dns import wellformed_cidr_network
@@ -105,6 +106,7 @@ from dms.dns import zone_name_from_network
 from dms.dns import new_soa_serial_no
 from dms.database.reverse_network import new_reverse_network
 from dms.database.reverse_network import ReverseNetwork
+from dms.database.reverse_network import get_reverse_network_trie
 from dms.zone_text_util import data_to_bind
 from dms.zone_text_util import bind_to_data
 
@@ -120,6 +122,8 @@ class ZoneEngine(ZoneDataUtil):
         Initialise engine. Get a scoped DB session.
         """
         self.time_format = time_format
+        # Set by the JSON RPC server if it can stream results
+        self.json_stream = False
         self.sectag = ZoneSecTag(sectag_label=sectag_label)
         self.refresh_db_session()
         if self.sectag not in list_all_sectags(self.db_session):
@@ -235,16 +239,17 @@ class ZoneEngine(ZoneDataUtil):
             network_address_flag = is_network_address(name)
             network = wellformed_cidr_network(name, filter_mask_size=False)
             query = self.db_session.query(ZoneSM)
-            if network_address_flag:
-                query = query.join(ReverseNetwork)\
-                        .filter( text(':name <<= reverse_networks.network'))\
-                        .params(name=name)\
-                        .order_by(ReverseNetwork.network)
-            elif network:
-                query = query.join(ReverseNetwork)\
-                        .filter( text(':network >>= reverse_networks.network'))\
-                        .params(network=network)\
-                        .order_by(ReverseNetwork.network)
+            if network_address_flag or network:
+                # Look up reverse networks in memory
+                trie = get_reverse_network_trie(self.db_session)
+                if network_address_flag:
+                    rev_networks = trie.find_containing(name)
+                else:
+                    rev_networks = trie.find_within(network)
+                if not rev_networks:
+                    continue
+                query = query.filter(ZoneSM.id_.in_(
+                    [zone_id for rev_network, zone_id in rev_networks]))
             else:
                 if not name.endswith('.') and not name.endswith('%'):
                     name += '.'
@@ -294,23 +299,25 @@ class ZoneEngine(ZoneDataUtil):
         network = wellformed_cidr_network(name)
         try:
             query = db_session.query(ZoneSM)
+            # Reverse networks are looked up in memory, most specific first
+            rev_zone_ids = []
             if network_address_flag and not exact_network:
-                query = query.join(ReverseNetwork)\
-                        .filter( text(':inet <<= reverse_networks.network'))\
-                        .params(inet=name)\
-                        .order_by(ReverseNetwork.network.desc())
+                rev_networks = get_reverse_network_trie(db_session)\
+                                    .find_containing(name)
             elif network_address_flag and exact_network:
                 raise ZoneNotFound(name)
             elif network and not exact_network:
-                query = query.join(ReverseNetwork)\
-                        .filter( text(':inet <<= reverse_networks.network'))\
-                        .params(inet=network)\
-                        .order_by(ReverseNetwork.network.desc())
+                rev_networks = get_reverse_network_trie(db_session)\
+                                    .find_containing(network)
             elif network and exact_network:
-                query = query.join(ReverseNetwork)\
-                        .filter( text(':inet = reverse_networks.network'))\
-                        .params(inet=network)\
-                        .order_by(ReverseNetwork.network.desc())
+                rev_networks = get_reverse_network_trie(db_session)\
+                                    .find_exact(network)
+            if network or network_address_flag:
+                rev_zone_ids = [zone_id for rev_network, zone_id 
+                                    in rev_networks]
+                if not rev_zone_ids:
+                    raise NoResultFound()
+                query = query.filter(ZoneSM.id_.in_(rev_zone_ids))
             else:
                 query = query.filter(ZoneSM.name == name)
             if zone_id:
@@ -322,8 +329,13 @@ class ZoneEngine(ZoneDataUtil):
             else:
                 query = query.filter(ZoneSM.state != ZSTATE_DELETED)
             if network or network_address_flag:
-                query = query.limit(1)
-            zone_sm = query.one()
+                zone_sms = query.all()
+                if not zone_sms:
+                    raise NoResultFound()
+                zone_sm = min(zone_sms, 
+                            key=lambda z: rev_zone_ids.index(z.id_))
+            else:
+                zone_sm = query.one()
         except NoResultFound:
             zone_sm = None
         except MultipleResultsFound:
@@ -715,7 +727,14 @@ class ZoneEngine(ZoneDataUtil):
         zi = self._resolv_zi_id(zone_sm, zi_id)
         if not zi:
             raise ZiNotFound(zone_sm.name, zi_id)
-        result['zi'] = zi.to_data(self.time_format,
+        stream_min_rrs = get_numeric_setting('show_zone_stream_min_rrs', int)
+        if (self.json_stream and stream_min_rrs
+                and zi.rr_count() >= stream_min_rrs):
+            # Big ZI, have RR groups read from DB as they are sent
+            result['zi'] = zi.to_stream_data(self.time_format,
+                                        zone_sm.use_apex_ns, all_rrs)
+        else:
+            result['zi'] = zi_render_cache.get_zi_data(zi, self.time_format,
                                         zone_sm.use_apex_ns, all_rrs)
         # Note alternative code up in list_zi() for different relN loading
         # strategy
@@ -751,17 +770,27 @@ class ZoneEngine(ZoneDataUtil):
         self._begin_op()
         result = {}
         zone_sm = self._get_zone_sm(name)
-        data_result = self._show_zone(zone_sm, zi_id, all_rrs=all_rrs)
-        result['zi_text'] = data_to_bind(data_result['zi'], 
-                                name=data_result['name'], 
-                                reference=data_result.get('reference'))
-        result['name'] = data_result['name']
-        result['zi_id'] = data_result['zi']['zi_id']
-        result['zi_ctime'] = data_result['zi']['ctime']
-        result['zi_mtime'] = data_result['zi']['mtime']
-        result['zi_ptime'] = data_result['zi']['ptime']
-        result['soa_serial'] = data_result['zi']['soa_serial']
-        result['zone_id'] = data_result['zone_id']
+        zi = self._resolv_zi_id(zone_sm, zi_id)
+        if not zi:
+            raise ZiNotFound(zone_sm.name, zi_id)
+        zone_result = zone_sm.to_engine_brief(time_format=self.time_format)
+        zi_result = zi.to_engine_brief(time_format=self.time_format)
+
+        def render(zi_data):
+            return data_to_bind(zi_data, name=zone_result['name'],
+                                reference=zone_result['reference'])
+
+        result['zi_text'] = zi_render_cache.get_zi_text(zi, self.time_format,
+                                zone_sm.use_apex_ns, all_rrs,
+                                zone_result['name'], zone_result['reference'],
+                                render)
+        result['name'] = zone_result['name']
+        result['zi_id'] = zi_result['zi_id']
+        result['zi_ctime'] = zi_result['ctime']
+        result['zi_mtime'] = zi_result['mtime']
+        result['zi_ptime'] = zi_result['ptime']
+        result['soa_serial'] = zi_result['soa_serial']
+        result['zone_id'] = zone_result['zone_id']
         return result
 
     def show_zi(self, name, zi_id=None):
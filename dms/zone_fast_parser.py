@@ -0,0 +1,478 @@
+#!/usr/bin/env python3.2
+#
+# Copyright (c) Net24 Limited, Christchurch, New Zealand 2011-2012
+#       and     Voyager Internet Ltd, New Zealand, 2012-2013
+#
+#    This file is part of py-magcode-core.
+#
+#    Py-magcode-core is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU  General Public License as published
+#    by the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Py-magcode-core is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU  General Public License for more details.
+#
+#    You should have received a copy of the GNU  General Public License
+#    along with py-magcode-core.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Fast line oriented zone file tokenizer.
+
+Produces the same stream of things as the pyparsing zone_parser grammar in
+dms.zone_parser, for the common cases of zone file input: $ORIGIN, $TTL,
+$UPDATE_TYPE, DMS ;| ;# and ;! comments, blank lines, and RR lines including
+parenthesised multi-line RDATA.  Anything it is not sure about raises
+FastParseFallback, and the caller then parses the input with the pyparsing
+grammar, which also does all the error reporting.
+
+See the test section at the end of this file for comparing output with
+that of the pyparsing grammar.
+"""
+
+import re
+
+import dns.name
+
+from magcode.core.globals_ import *
+from dms.globals_ import *
+from dms.database.resource_record import rrtype_map
+
+
+# Comment leader settings
+comment_group_leader = settings['comment_group_leader']
+comment_rr_leader = settings['comment_rr_leader']
+comment_rrflags_leader = settings['comment_rrflags_leader']
+rr_flag_lockptr = settings['rr_flag_lockptr']
+rr_flag_forcerev = settings['rr_flag_forcerev']
+rr_flag_disable = settings['rr_flag_disable']
+rr_flag_ref = settings['rr_flag_ref']
+rr_flag_rrop = settings['rr_flag_rrop']
+rr_flag_trackrev = settings['rr_flag_trackrev']
+comment_leader_chars = (comment_group_leader[1:] + comment_rr_leader[1:]
+                            + comment_rrflags_leader[1:])
+
+# Character sets as per dms.zone_parser
+_rdatachars = r"a-zA-Z0-9/+=.:@\-$\\!#%^&*_|{}\[\]',?"
+_re_rdata_word = re.compile(r'[' + _rdatachars + r']+')
+# As per pyparsing dblQuotedString
+_re_dbl_quoted = re.compile(
+                r'"(?:[^"\n\r\\]|(?:"")|(?:\\(?:[^x]|x[0-9a-fA-F]+)))*"')
+_re_label = re.compile(r'[a-zA-Z0-9.\-_*@]+')
+_re_ttl = re.compile(r'([0-9]+[wWdDhHmMsS]?){1,7}$')
+_re_type = re.compile(r'[a-zA-Z0-9]+$')
+_re_zone = re.compile(r'[a-zA-Z0-9.\-_]+$')
+_re_dollar_ttl = re.compile(r'[0-9wWdDhHmMsS]+$')
+_re_update_type = re.compile(r'[a-zA-Z0-9_.\-]+$')
+_re_ref = re.compile(re.escape(rr_flag_ref) + r'[a-zA-Z0-9.\-_@]+$')
+_re_rrop = re.compile(re.escape(rr_flag_rrop) + r'[a-zA-Z0-9_]+$')
+_rr_flags = (rr_flag_lockptr, rr_flag_forcerev, rr_flag_trackrev,
+                rr_flag_disable)
+_classes = ('IN', 'HS', 'CH')
+
+
+class FastParseFallback(Exception):
+    """
+    Input needs the pyparsing grammar
+    """
+    pass
+
+
+class FastParseRR(object):
+    """
+    RR line, looking like the pyparsing RR Group it stands in for
+    """
+    __slots__ = ('_data',)
+
+    def __init__(self, data):
+        self._data = data
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __repr__(self):
+        return 'FastParseRR(%r)' % self._data
+
+
+def _check_label(label):
+    """
+    Label checks as per rr_label_parse_action() in dms.zone_parser
+    """
+    try:
+        dns.name.from_text(label, None)
+    except Exception:
+        raise FastParseFallback()
+    if (label.find('@') >= 0 and len(label) != 1):
+        raise FastParseFallback()
+    if (label.find('-') == 0):
+        raise FastParseFallback()
+    if (label.find('.-') >= 0):
+        raise FastParseFallback()
+
+def _directive_value(line, directive, value_re):
+    """
+    Return the value of a single valued directive line
+    """
+    rest = line[len(directive):]
+    if not rest.startswith(' ') or rest.find(';') >= 0:
+        raise FastParseFallback()
+    words = rest.split()
+    if len(words) != 1 or not value_re.match(words[0]):
+        raise FastParseFallback()
+    return words[0]
+
+def _comment_text(line, leader):
+    """
+    Return text of a ;| or ;# comment line
+    """
+    rest = line[len(leader):]
+    if rest.lstrip(' ').startswith(';'):
+        # pyparsing takes this as a plain comment
+        raise FastParseFallback()
+    if rest.startswith(' ') and len(rest) > 1:
+        return rest[1:]
+    if not rest.strip(' '):
+        return ''
+    raise FastParseFallback()
+
+
+class FastZoneTokenizer(object):
+    """
+    Tokenize zone file text, into the same things as the pyparsing
+    zone_parser.  Call tokenize() to get a list of them.
+    """
+
+    def __init__(self, s):
+        """
+        s is the zone file text, with tabs expanded as pyparsing does.
+        Locations given to rdata_pyparsing are offsets into s.
+        """
+        self.s = s
+        self.things = []
+        self.previous_label = None
+        # Start of next line to be processed
+        self.loc = 0
+
+    def _lines(self):
+        """
+        Iterate over lines as (start, end) offsets, end being at the '\\n'
+        """
+        s = self.s
+        size = len(s)
+        while self.loc < size:
+            start = self.loc
+            end = s.find('\n', start)
+            if end < 0:
+                end = size
+            self.loc = end + 1
+            yield start, end
+
+    def tokenize(self):
+        """
+        Tokenize s, returning list of things
+        """
+        s = self.s
+        if s.find('\r') >= 0:
+            raise FastParseFallback()
+        comment_thing = None
+        for start, end in self._lines():
+            line = s[start:end]
+            first = line[:1]
+            if first == ';':
+                second = line[1:2]
+                if not second or second not in comment_leader_chars:
+                    # Plain comment, ignored
+                    continue
+                if line.startswith(comment_group_leader):
+                    comment_thing = self._comment(comment_thing,
+                            'comment_group',
+                            _comment_text(line, comment_group_leader))
+                    continue
+                if line.startswith(comment_rr_leader):
+                    comment_thing = self._comment(comment_thing,
+                            'comment_rr',
+                            _comment_text(line, comment_rr_leader))
+                    continue
+                comment_thing = None
+                self.things.append(self._rrflags(line, start))
+                continue
+            if not line.strip(' '):
+                comment_thing = None
+                if end < len(s):
+                    self.things.append('\n')
+                continue
+            if first == ' ':
+                stripped = line.lstrip(' ')
+                if stripped[0] == ';':
+                    if stripped[1:2] and stripped[1:2] in comment_leader_chars:
+                        raise FastParseFallback()
+                    # Plain comment, ignored
+                    continue
+                if stripped[0] == '$':
+                    raise FastParseFallback()
+                comment_thing = None
+                self.things.append(self._rr(start, end, continuation=True))
+                continue
+            comment_thing = None
+            if first == '$':
+                self.things.append(self._directive(line, start))
+                continue
+            self.things.append(self._rr(start, end))
+        if not self.things:
+            # pyparsing grammar needs at least one thing
+            raise FastParseFallback()
+        return self.things
+
+    def _comment(self, comment_thing, type_, text):
+        """
+        Add a line to a ;| or ;# comment block, starting a new block if
+        needed.
+        """
+        if comment_thing and comment_thing['type'] == type_:
+            comment_thing['lines'].append(text)
+            return comment_thing
+        comment_thing = {'comment': None, 'type': type_, 'lines': [text]}
+        self.things.append(comment_thing)
+        return comment_thing
+
+    def _rrflags(self, line, start):
+        """
+        Process a ;! rr_flags line
+        """
+        flags = line[len(comment_rrflags_leader):].split()
+        if not flags:
+            raise FastParseFallback()
+        for flag in flags:
+            if flag in _rr_flags:
+                continue
+            if _re_ref.match(flag) or _re_rrop.match(flag):
+                continue
+            raise FastParseFallback()
+        return {'rr_flags': ' '.join(flags), 'type': 'comment_rrflags',
+                    'rdata_pyparsing': {'s': self.s, 'loc': start}}
+
+    def _directive(self, line, start):
+        """
+        Process a $ directive line
+        """
+        if line.startswith('$ORIGIN'):
+            origin = _directive_value(line, '$ORIGIN', _re_zone)
+            return {'origin': origin, 'type': '$ORIGIN',
+                    'directive': '$ORIGIN',
+                    'rdata_pyparsing': {'s': self.s, 'loc': start}}
+        if line.startswith('$TTL'):
+            ttl = _directive_value(line, '$TTL', _re_dollar_ttl)
+            return {'ttl': ttl, 'type': '$TTL', 'directive': '$TTL',
+                    'rdata_pyparsing': {'s': self.s, 'loc': start}}
+        if line.startswith('$UPDATE_TYPE'):
+            update_type = _directive_value(line, '$UPDATE_TYPE',
+                                            _re_update_type)
+            return {'update_type': update_type, 'type': '$UPDATE_TYPE',
+                    'directive': '$UPDATE_TYPE',
+                    'rdata_pyparsing': {'s': self.s, 'loc': start}}
+        # $INCLUDE, $GENERATE and anything else
+        raise FastParseFallback()
+
+    def _rr(self, start, end, continuation=False):
+        """
+        Process an RR line, and any following lines of parenthesised rdata
+        """
+        s = self.s
+        rr = {}
+        loc = start
+        if not continuation:
+            match = _re_label.match(s, loc, end)
+            if not match:
+                raise FastParseFallback()
+            label = match.group()
+            loc = match.end()
+            if loc >= end or s[loc] != ' ':
+                raise FastParseFallback()
+            _check_label(label)
+            rr['label'] = label
+            self.previous_label = label
+        elif not self.previous_label:
+            raise FastParseFallback()
+        # TTL, class and type
+        while True:
+            while loc < end and s[loc] == ' ':
+                loc += 1
+            word_end = s.find(' ', loc, end)
+            if word_end < 0:
+                # Type has to be followed by blank and RDATA
+                raise FastParseFallback()
+            word = s[loc:word_end]
+            if not rr.get('ttl') and _re_ttl.match(word):
+                rr['ttl'] = word
+            elif not rr.get('class') and word.upper() in _classes:
+                if word.upper() != 'IN':
+                    raise FastParseFallback()
+                rr['class'] = 'IN'
+            else:
+                if (not _re_type.match(word)
+                        or word.upper() not in rrtype_map.keys()):
+                    raise FastParseFallback()
+                rr['type'] = word
+                loc = word_end
+                break
+            loc = word_end
+        rr['rdata'] = self._rdata(loc, end)
+        return FastParseRR(rr)
+
+    def _rdata(self, loc, end):
+        """
+        Process rdata, from loc on the current line.  As with pyparsing,
+        loc is given as the location of the rdata.
+        """
+        s = self.s
+        size = len(s)
+        words = []
+        rdata_loc = loc
+        in_parens = False
+        seen_parens = False
+        while True:
+            # Skip white space, and comments to end of line
+            while loc < end and s[loc] == ' ':
+                loc += 1
+            if loc < end and s[loc] == ';':
+                loc = end
+            if loc >= end:
+                if not in_parens:
+                    break
+                # Next line of parenthesised rdata
+                if end >= size:
+                    raise FastParseFallback()
+                loc = end + 1
+                end = s.find('\n', loc)
+                if end < 0:
+                    end = size
+                self.loc = end + 1
+                continue
+            char = s[loc]
+            if char == '(':
+                if seen_parens:
+                    raise FastParseFallback()
+                in_parens = seen_parens = True
+                paren_words = len(words)
+                loc += 1
+                continue
+            if char == ')':
+                if not in_parens or len(words) == paren_words:
+                    raise FastParseFallback()
+                in_parens = False
+                loc += 1
+                continue
+            if char == '"':
+                match = _re_dbl_quoted.match(s, loc, end)
+            else:
+                match = _re_rdata_word.match(s, loc, end)
+            if not match:
+                raise FastParseFallback()
+            words.append(match.group())
+            loc = match.end()
+        if not words:
+            raise FastParseFallback()
+        return {'rdata': ' '.join(words),
+                'pyparsing': {'s': s, 'loc': rdata_loc}}
+
+
+def fast_zone_parse(s):
+    """
+    Tokenize zone file text, returning list of things as per the
+    pyparsing zone_parser.  Tabs in s must already be expanded.
+
+    Raises FastParseFallback if the pyparsing grammar is needed.
+    """
+    things = FastZoneTokenizer(s).tokenize()
+    for thing in things:
+        if isinstance(thing, dict) and 'lines' in thing:
+            thing['comment'] = '\n'.join(thing.pop('lines')) + '\n'
+    return things
+
+
+# Test by using:    from dms.zone_fast_parser import *
+#                   compare_parsers()
+# Compares bind_to_data() output using both tokenizers over the test corpus
+# below and the tests in dms.zone_parser
+test = {}
+test[1] = """$TTL 600
+$ORIGIN example.org.
+;|
+;| Apex records
+;|
+@       IN  SOA  ( ns1.example.org. ;Master NS
+                   hostmaster.example.org. ;RP email
+                   2013010100   ;Serial yyyymmddnn
+                   600          ;Refresh
+                   600          ;Retry
+                   604800       ;Expire
+                   600          ;Minimum/Ncache
+                   )
+        IN  NS   ns1
+        IN  NS   ns2.example.net.
+
+; A plain comment, ignored
+;| Hosts
+;# The web server
+www     600 IN A  192.0.2.1
+;!  LOCKPTR REF:customer-1
+mail    IN  600 A 192.0.2.2 ; trailing comment
+        IN  MX   10 mail
+  ; indented comment
+txt     TXT  "quoted ; not a comment" "and \\"escaped\\" too"
+ns1     A    192.0.2.3
+
+;|
+;#
+host1   A 192.0.2.4
+host2   A 192.0.2.5"""
+test[2] = """$UPDATE_TYPE update_1
+$ORIGIN 2.0.192.in-addr.arpa.
+;!RROP:ADD
+1 PTR www.example.org.
+;! RROP:DELETE TRACKREV
+2 PTR mail.example.org.
+"""
+test[3] = "host IN A 192.168.23.4\n\n\n   \nhost2\tIN\tA\t192.168.34.56\n"
+test[4] = "host HS A 192.168.23.4\n"
+test[5] = "$INCLUDE some.file\n"
+
+def compare_parsers(name='example.org.', update_mode=True):
+    """
+    Check that the fast tokenizer and the pyparsing grammar give the same
+    results.  Prints results, and returns number of differences.
+    """
+    from io import StringIO
+    from dms.zone_parser import test as pyparsing_test
+    from dms.zone_text_util import bind_to_data
+    corpus = {}
+    corpus.update(('zone_parser[%s]' % k, v)
+                        for k, v in pyparsing_test.items())
+    corpus.update(('zone_fast_parser[%s]' % k, v) for k, v in test.items())
+    differences = 0
+    for k in sorted(corpus):
+        results = []
+        for fast_parse in (True, False):
+            try:
+                result = bind_to_data(StringIO(corpus[k]), name,
+                        update_mode=update_mode, fast_parse=fast_parse)
+            except Exception as exc:
+                result = (exc.__class__.__name__, str(exc))
+            results.append(result)
+        try:
+            fast_parse_used = True
+            fast_zone_parse(corpus[k].expandtabs())
+        except FastParseFallback:
+            fast_parse_used = False
+        if results[0] != results[1]:
+            differences += 1
+            print('%s: DIFFERENT' % k)
+        else:
+            print('%s: same%s'
+                    % (k, '' if fast_parse_used else ' (fallback)'))
+    return differences
@@ -22,15 +22,23 @@
 Module for Zone text manipuation utilities
 """
 
+import os
+import time
+import locale
+import tempfile
 from io import StringIO
 from textwrap import TextWrapper
+from operator import itemgetter
 import re
 
 from pyparsing import ParseResults
+from pyparsing import ParseBaseException
 import dns.name
 import dns.ttl
 
 from magcode.core.globals_ import *
+from magcode.core.utility import get_boolean_setting
+from magcode.core.utility import get_numeric_setting
 from dms.globals_ import *
 from dms.dns import RRTYPE_SOA
 from dms.dns import RROP_DELETE
@@ -52,14 +60,28 @@ from dms.exceptions import BadInitialZoneName
 # Zone file parser is in a seperate module to contain symbol mess, and
 # to aid in debugging from python3.2 command line.
 from dms.zone_parser import zone_parser
+from dms.zone_fast_parser import fast_zone_parse
+from dms.zone_fast_parser import FastParseFallback
+from dms.zone_fast_parser import FastParseRR
 
 
 rdata_re_null = re.compile(r'^""$|^\\#[ 	]+0$')
+# For finding parentheses outside of quoted strings and comments
+_re_paren_scan = re.compile(r'"(?:[^"\\\n]|\\.)*"|;.*|[()]')
+# Zone file lines that a streamed zone file is not split before
+_chunk_no_split_chars = ('', ' ', '\t', '\r', '\n', ';')
+# White space that TextWrapper changes in a comment
+_re_wrap_whitespace = re.compile(r'[\t\n\x0b\x0c\r]')
+# Sort key for RRs in an RR group
+_sort_rr = itemgetter('label', 'type', 'rdata')
 
 class DataToBind(object):
     """
     Objects of this class implement the transform from data to bind file
     output
+
+    Output lines are gathered in a buffer, which is written out in large
+    chunks to the file, or an open file descriptor.
     """
     
     def __init__(self, file=sys.stdout):
@@ -77,6 +99,42 @@ class DataToBind(object):
                             subsequent_indent=self.comment_rrflags_leader)
         self.for_bind = False
         self.file = file
+        self._out = []
+        # '%-7s %-15s' formatted class and type, by (class, type)
+        self._class_type_strs = {}
+
+    def _write(self, text):
+        """
+        Write text to file, or open file descriptor
+        """
+        if not isinstance(self.file, int):
+            self.file.write(text)
+            return
+        data = text.encode(locale.getpreferredencoding(False))
+        while data:
+            written = os.write(self.file, data)
+            data = data[written:]
+
+    def flush(self):
+        """
+        Write out buffered output
+        """
+        if not self._out:
+            return
+        self._write(''.join(self._out))
+        self._out = []
+
+    def _fill(self, textwrapper, text):
+        """
+        Wrap a comment.  Short comments that TextWrapper would leave as
+        they are skip it.
+        """
+        indent = textwrapper.initial_indent
+        if (len(indent) + len(text) <= textwrapper.width
+                and not _re_wrap_whitespace.search(text)
+                and text[-1:] == text[-1:].rstrip()):
+            return indent + text
+        return textwrapper.fill(text)
 
     def print_group_comment(self, rr_group):
         if not rr_group.get('comment'):
@@ -84,14 +142,13 @@ class DataToBind(object):
         comment = rr_group['comment']
         if (comment.find('\n') < 0):
             # If comment does not have any linefeeds, wrap it.
-            print(self.group_textwrapper.fill(rr_group['comment']),
-                    file=self.file)
+            self._out.append(self._fill(self.group_textwrapper, comment) 
+                                + '\n')
             return
         # Print out
-        comment = comment.split('\n')[:-1]
-        for line in comment:
-            print(self.comment_group_leader + ' ' + line, file=self.file)
-
+        leader = self.comment_group_leader + ' '
+        for line in comment.split('\n')[:-1]:
+            self._out.append(leader + line + '\n')
 
     def print_rr_comment(self, rr):
         if not rr.get('comment'):
@@ -99,13 +156,12 @@ class DataToBind(object):
         comment = rr['comment']
         if (comment.find('\n') < 0):
             # If comment does not have any linefeeds, wrap it.
-            print(self.rr_textwrapper.fill(comment),
-                    file=self.file)
+            self._out.append(self._fill(self.rr_textwrapper, comment) + '\n')
             return
         # Print out
-        comment = comment.split('\n')[:-1]
-        for line in comment:
-            print(self.comment_rr_leader + ' ' + line, file=self.file)
+        leader = self.comment_rr_leader + ' '
+        for line in comment.split('\n')[:-1]:
+            self._out.append(leader + line + '\n')
 
     def print_rrflags_comment(self, rr):
         if (not rr.get('lock_ptr') and not rr.get('disable')
@@ -121,28 +177,32 @@ class DataToBind(object):
         if rr['reference']:
             rr_flags_strs.append(settings['rr_flag_ref'] + rr['reference'])
         rr_flags_str = ' '.join(rr_flags_strs)
-        print(self.rrflags_textwrapper.fill(rr_flags_str), file=self.file)
+        self._out.append(self._fill(self.rrflags_textwrapper, rr_flags_str)
+                            + '\n')
 
     def print_rr(self, rr, label, ttl):
         if (self.for_bind and rr.get('disable') != None and rr['disable']):
             label = ';' + label
-        print ('%-15s %-7s %-7s %-15s %s' 
-                % (label, ttl, rr['class'], rr['type'], rr['rdata']),
-                file=self.file)
+        class_type_key = (rr['class'], rr['type'])
+        class_type_str = self._class_type_strs.get(class_type_key)
+        if class_type_str is None:
+            class_type_str = '%-7s %-15s' % class_type_key
+            self._class_type_strs[class_type_key] = class_type_str
+        self._out.append('%-15s %-7s %s %s\n' 
+                % (label, ttl, class_type_str, rr['rdata']))
     
     def print_soa(self, rr, label, ttl):
         rdata = rr['rdata'].split()
-        print ('%-15s %-7s %-7s %-15s ( %-12s ;Master NS' 
-                % (label, ttl, rr['class'], rr['type'], rdata[0]),
-                file=self.file)
-        print ('%-47s %-12s ;RP email' % (' ', rdata[1]), file=self.file)
-        print ('%-47s %-12s ;Serial yyyymmddnn' % (' ', rdata[2]),
-                file=self.file)
-        print ('%-47s %-12s ;Refresh' % (' ', rdata[3]), file=self.file)
-        print ('%-47s %-12s ;Retry' % (' ', rdata[4]), file=self.file)
-        print ('%-47s %-12s ;Expire' % (' ', rdata[5]), file=self.file)
-        print ('%-47s %-12s ;Minimum/Ncache' % (' ', rdata[6]), file=self.file)
-        print ('%-47s %-12s' % (' ', ')'), file=self.file)
+        self._out.append(
+            '%-15s %-7s %-7s %-15s ( %-12s ;Master NS\n' 
+                % (label, ttl, rr['class'], rr['type'], rdata[0])
+            + '%-47s %-12s ;RP email\n' % (' ', rdata[1])
+            + '%-47s %-12s ;Serial yyyymmddnn\n' % (' ', rdata[2])
+            + '%-47s %-12s ;Refresh\n' % (' ', rdata[3])
+            + '%-47s %-12s ;Retry\n' % (' ', rdata[4])
+            + '%-47s %-12s ;Expire\n' % (' ', rdata[5])
+            + '%-47s %-12s ;Minimum/Ncache\n' % (' ', rdata[6])
+            + '%-47s %-12s\n' % (' ', ')'))
 
     def print_rr_group(self, rr_group, sort_reverse=False, reference=None):
         """
@@ -150,15 +210,12 @@ class DataToBind(object):
 
         This is a bit of a mess, but it gets the job done.
         """
-        
-        def sort_rr(rr):
-            return(rr['label'], rr['type'], rr['rdata'])
-       
         if rr_group.get('comment'):
             self.print_group_comment(rr_group)
         previous_label = ''
-        for rr in sorted(rr_group['rrs'], key=sort_rr, reverse=sort_reverse):
-            self.print_rr_comment(rr)
+        for rr in sorted(rr_group['rrs'], key=_sort_rr, reverse=sort_reverse):
+            if rr.get('comment'):
+                self.print_rr_comment(rr)
             if reference and rr['type'] == RRTYPE_SOA:
                 rr['reference'] = reference
             self.print_rrflags_comment(rr)
@@ -170,33 +227,39 @@ class DataToBind(object):
             else:
                 self.print_rr(rr, label, ttl)
             previous_label = rr['label']
-        print('\n\n', file=self.file, end='')
+        self._out.append('\n\n')
+        if (self.return_string 
+                or len(self._out) < self._buffer_lines):
+            return
+        self.flush()
 
     def __call__(self, zi_data, name=None, reference=None, for_bind=False,
             file=None, no_info_header=False):
         """
         Construct a bind file as a multi-line string, from
-        zi_data
+        zi_data.  file can be a file object, or an open file descriptor.
         """
         # if zi_data is blank, get out of here...
         if not zi_data:
             return ''
         # Do file/IO house keeping first
-        if not file:
-            self.file = StringIO()
-            return_string = True
+        self._out = []
+        self._buffer_lines = get_numeric_setting('data_to_bind_buffer_lines',
+                                                    int)
+        if file is None:
+            self.return_string = True
         else:
             self.file = file
-            return_string = False
+            self.return_string = False
         
         # Save bind_p
         self.for_bind = for_bind
 
         # Set $TTL and $ORIGIN if given
-        print ('$TTL %s' % zi_data['zone_ttl'], file=self.file)
+        self._out.append('$TTL %s\n' % zi_data['zone_ttl'])
         if name:
-            print ('$ORIGIN %s' % name, file=self.file)
-        print(file=self.file)
+            self._out.append('$ORIGIN %s\n' % name)
+        self._out.append('\n')
 
         # Add reference comment if reference given
         zi_id = zi_data.get('zi_id')
@@ -222,7 +285,7 @@ class DataToBind(object):
             if zi_ptime:
                 out += "; zi_ptime:   %s\n" % zi_ptime
             out += ";\n\n"
-            print(out, file=self.file)
+            self._out.append(out + '\n')
 
         # Index rr_groups, for printing
         rr_groups = {}
@@ -258,10 +321,11 @@ class DataToBind(object):
             self.print_rr_group(default_group)
 
         # clean up
-        if return_string:
-            result = self.file.getvalue()
-            self.file.close()
+        if self.return_string:
+            result = ''.join(self._out)
+            self._out = []
             return result
+        self.flush()
 
 def data_to_bind(zi_data, name=None, file=None, 
         for_bind=False, reference=None, no_info_header=False):
@@ -294,21 +358,141 @@ def _validate_pyparsing_ttl(name, data, text):
     except Exception as exc:
         raise TtlParseError(name, data, text, str(exc))
 
-def bind_to_data(bind_file, name=None, use_origin_as_name=False, 
-                    update_mode=False):
+def parse_zone_text(text, fast_parse=None, line_offset=0):
     """
-    Construct zi_data, taking a bind file as input.  Can be a string, 
-    or file handle.
+    Tokenize zone file text.  The fast line oriented tokenizer is tried
+    first, falling back to the pyparsing grammar for anything it does not
+    handle, and for error reporting.
+
+    line_offset is the number of lines in the file before text, when text
+    is a chunk of a streamed zone file.
+    """
+    if fast_parse is None:
+        fast_parse = get_boolean_setting('zone_parser_fast_path')
+    if fast_parse:
+        try:
+            return fast_zone_parse(text.expandtabs())
+        except FastParseFallback:
+            pass
+    try:
+        return zone_parser.parseString(text, parseAll=True)
+    except ParseBaseException:
+        if not line_offset:
+            raise
+        # Parse again with the chunk at its place in the file, so that the
+        # error has the right line number
+        zone_parser.parseString('\n' * line_offset + text, parseAll=True)
+        raise
+
+def _zone_text_chunks(bind_file, chunk_lines):
+    """
+    Read zone file text in chunks of about chunk_lines lines, yielding
+    (text, line_offset) for each.  Chunks are only split before an RR or
+    directive line outside of any parentheses, so that each chunk can be
+    parsed on its own.
+    """
+    lines = []
+    line_offset = 0
+    paren_depth = 0
+    has_thing = False
+    for line in bind_file:
+        if (len(lines) >= chunk_lines and has_thing and not paren_depth
+                and line[:1] not in _chunk_no_split_chars):
+            yield (''.join(lines), line_offset)
+            line_offset += len(lines)
+            lines = []
+            has_thing = False
+        lines.append(line)
+        if not has_thing:
+            stripped = line.strip()
+            has_thing = not stripped or stripped[0] != ';'
+        if line.find('(') >= 0 or line.find(')') >= 0:
+            for token in _re_paren_scan.findall(line):
+                if token == '(':
+                    paren_depth += 1
+                elif token == ')' and paren_depth:
+                    paren_depth -= 1
+    if lines:
+        yield (''.join(lines), line_offset)
+
+
+class BindDataParser(object):
+    """
+    Turn a bind zone file into zi_data.  Used by bind_to_data() and
+    bind_to_data_stream() below.
+
+    RR groups are produced by the rr_groups() generator as the zone file
+    is parsed, and finish() fills in the rest of zi_data from the SOA
+    record.
     """
-    def validate_initial_name():
+    def __init__(self, bind_file, name=None, use_origin_as_name=False,
+            update_mode=False, fast_parse=None, stream=False):
+        """
+        Open zone file, and check initial zone name.
+
+        If stream is set, the zone file is read and parsed in chunks,
+        and RR data only keeps the line of zone file text it came from
+        for error reporting.
+        """
+        self.bind_file = bind_file
+        self.name = name
+        self.use_origin_as_name = use_origin_as_name
+        self.update_mode = update_mode
+        self.fast_parse = fast_parse
+        self.stream = stream
+        self.zi_data = {}
+        self.update_type = None
+        self.zone_reference = None
+        self.rr_soa = None
+        self.soa_done = False
+        # For trimming rdata_pyparsing when streaming
+        self._chunk_s = None
+        self._chunk_pos = 0
+        self._chunk_lineno = 0
+        self._line_offset = 0
+
+        self.file_name = None
+        if isinstance(bind_file, str):
+            self.file_name = bind_file
+            # Open file
+            # Check that file is not 'binary'
+            bfile = open(self.file_name, mode='rb')
+            bs = bfile.read(256)
+            bfile.close()
+            try:
+                if not bs.decode().replace('\n', ' ')\
+                        .replace('\t', ' ').isprintable():
+                    raise BinaryFileError(bind_file) 
+            except UnicodeError:
+                    raise BinaryFileError(bind_file) 
+
+            self.bind_file = open(self.file_name, mode='rt')
+
+        # Check Initial name and if it is garbage do something appropriate
+        try:
+            self.validate_initial_name()
+        except BadInitialZoneName as exc:
+            if not use_origin_as_name:
+                self.close()
+                raise exc
+            self.name = None
+
+    def _input_thing(self):
+        """
+        Describe zone file input for error messages
+        """
+        if isinstance(self.bind_file, StringIO):
+            return 'StringIO object'
+        elif self.file_name:
+            return self.file_name
+        else:
+            return ('FD %s' % str(self.bind_file.fileno()))
+
+    def validate_initial_name(self):
+        name = self.name
         if not name:
             return
-        if isinstance(bind_file, StringIO):
-            input_thing = 'StringIO object'
-        elif file_name:
-            input_thing = file_name
-        else:
-            input_thing = ('FD %s' % str(bind_file.fileno()))
+        input_thing = self._input_thing()
         try:
             thing = dns.name.from_text(name)
         except Exception as exc:
@@ -318,296 +502,490 @@ def bind_to_data(bind_file, name=None, use_origin_as_name=False,
         if not name.endswith('.'):
             raise BadInitialZoneName(input_thing, name, "must end with '.'.")
 
-    def check_name_defined():
-        if not name:
-            if isinstance(bind_file, StringIO):
-                raise ZoneNameUndefined('StringIO object')
-            elif file_name:
-                raise ZoneNameUndefined(file_name)
-            else:
-                raise ZoneNameUndefined('FD %s' % str(bind_file.fileno()))
-
-    file_name = None
-    if isinstance(bind_file, str):
-        file_name = bind_file
-        # Open file
-        # Check that file is not 'binary'
-        bfile = open(file_name, mode='rb')
-        bs = bfile.read(256)
-        bfile.close()
-        try:
-            if not bs.decode().replace('\n', ' ')\
-                    .replace('\t', ' ').isprintable():
-                raise BinaryFileError(bind_file) 
-        except UnicodeError:
-                raise BinaryFileError(bind_file) 
-
-        bind_file = open(file_name, mode='rt')
-
-    # Check Initial name and if it is garbage do something appropriate
-    try:
-        validate_initial_name()
-    except BadInitialZoneName as exc:
-        if not use_origin_as_name:
-            if file_name:
-                bind_file.close()
-            raise exc
-        name = None
-
-    # Feed through pyparsing to get back a parse result we can traverse
-    # Error Exceptions handled at higher level for error processing
-    try:
-        zone_parse = zone_parser.parseFile(bind_file, parseAll=True)
-    finally:
-        if file_name:
-            bind_file.close()
-
-    # Turn parse result into a JSON zi data structure
-    zi_data = {'rr_groups':[], }
-    # List of all rrs for sorting out Apex and SOA data at end
-    # of loop
-    rr_list = []
-    # Loop data variables
-    in_rr_group = False
-    comment_rr = None
-    comment_rrflags = None
-    update_type = None
-    zone_reference = None
-    comment_group = None
-    previous_label = None
-    origin = name if name else None
-    ttl_seen = False
-    ttl = None
-    in_rr_prologue = True
-    rr_group = {'rrs':[]}
-    for thing in zone_parse:
-        if (isinstance(thing, dict)
-                and thing['type'] == '$ORIGIN'):
-            _validate_pyparsing_hostname(name, thing, thing['origin'])
-            origin = thing['origin']
-            continue
-
-        if (isinstance(thing, dict)
-                and thing['type'] == '$TTL'):
-            if ttl_seen:
-                raise TtlInWrongPlace(name, thing, file_name)
-            _validate_pyparsing_ttl(name, thing, thing['ttl'])
-            ttl_seen = True
-            zi_data['zone_ttl'] = thing['ttl']
-            continue
-
-        if (isinstance(thing, dict)
-                and thing['type'] == '$INCLUDE'):
-            raise IncludeNotSupported(name, thing)
-
-        if (isinstance(thing, dict)
-                and thing['type'] == '$GENERATE'):
-            raise GenerateNotSupported(name, thing)
-
-        if (isinstance(thing, dict)
-                and thing['type'] == '$UPDATE_TYPE'):
-            if not update_mode:
-                raise UpdateTypeNotSupported(name, thing)
-            update_type = thing['update_type']
-
-        if (isinstance(thing, dict) 
-                and thing['type'] == 'comment_rr'):
-            #Process an  RR comment
-            comment_rr = thing
-            comment_rr.pop('comment_type', None)
-            continue
-        
-        if (isinstance(thing, dict) 
-                and thing['type'] == 'comment_rrflags'):
-            #Process rr_flags
-            comment_rrflags = thing
-            comment_rrflags.pop('comment_type', None)
-            continue
-
-        if (isinstance(thing, dict)
-                and thing['type'] == 'comment_group'):
-            #Process a group comment
-            comment_group = thing
-            comment_group.pop('comment_type', None)
-            if not in_rr_group:
-                # Start New RR Group from previous blank lines
-                in_rr_group = True
-                rr_group.update(comment_group)
-            else:
-                # Start new RR_Group
-                zi_data['rr_groups'].append(rr_group)
-                rr_group = {'rrs':[]}
-                rr_group.update(comment_group)
-            continue
+    def check_name_defined(self):
+        if not self.name:
+            raise ZoneNameUndefined(self._input_thing())
 
-        if isinstance(thing, ParseResults):
-            # $TTL should have happened by now
-            ttl_seen = True
-            if in_rr_prologue:
-                in_rr_prologue = False
-                # if no name, should have seen $ORIGIN by now
-                if origin and use_origin_as_name:
-                    name = origin
-                check_name_defined()
-
-            # Start process RRs
-            if not in_rr_group:
-                in_rr_group = True
-            # Process an RR
-            rr = {}
-            # Have to break down to keys we accept  - security
-            # Sort out RR label - if none, use last seen value of label
-            rr['label'] = thing.get('label')
-            if not rr['label']:
-                if not previous_label:
-                    # This should not happen!
-                    # This error is feature specific to the parser design,
-                    # and should be raised here
-                    raise NoPreviousLabelParseError(domain=name)
-                rr['label'] = previous_label
-            else:
-                previous_label = rr['label']
+    def close(self):
+        """
+        Close zone file if we opened it
+        """
+        if self.file_name:
+            self.bind_file.close()
 
-            # Apply $ORIGIN to label.  This will be relativized when 
-            # actual RR object is created.
-            if origin and not rr['label'].endswith('.'):
-                if rr['label'] == '@':
-                    rr['label'] = origin
-                else:
-                    rr['label'] = '.'.join((rr['label'],origin))
-
-            # Add preceding rr_flags and comment_rr to RR
-            if comment_rr:
-                rr.update(comment_rr)
-                comment_rr = None
-
-            # Decode rr_flags
-            rr['lock_ptr'] = False
-            rr['disable'] = False 
-            rr['force_reverse'] = False 
-            rr['track_reverse'] = False 
-            rr['reference'] = None 
-            rr['update_op'] = None
-            if comment_rrflags:
-                rr_flags = comment_rrflags['rr_flags'].strip()
-                if rr_flags.find(settings['rr_flag_forcerev']) >= 0:
-                    rr['force_reverse'] = True 
-                if rr_flags.find(settings['rr_flag_trackrev']) >= 0:
-                    rr['track_reverse'] = True 
-                if rr_flags.find(settings['rr_flag_lockptr']) >= 0 :
-                    rr['lock_ptr'] = True 
-                if rr_flags.find(settings['rr_flag_disable']) >= 0 :
-                    rr['disable'] = True 
-                rr_flags = rr_flags.split()
-                for rr_flag in rr_flags:
-                    if not (rr_flag.find(settings['rr_flag_ref']) >= 0):
-                        continue
-                    reference = rr_flag[len(settings['rr_flag_ref']):]
-                    if (thing.get('type') and thing['type'] == RRTYPE_SOA
-                            and not rr['disable']):
-                        zone_reference = reference
-                        break
-                    rr['reference'] = reference
-                    break
-                for rr_flag in rr_flags:
-                    if not (rr_flag.find(settings['rr_flag_rrop']) >= 0):
-                        continue
-                    update_op = rr_flag[len(settings['rr_flag_rrop']):]
-                    if not update_mode:
-                        raise RropNotSupported(name, comment_rrflags)
-                    rr['update_op'] = update_op
-                    break
-                comment_rrflags = None
+    def _zone_things(self):
+        """
+        Feed zone file through the parser, giving the things it finds.
+        Error Exceptions handled at higher level for error processing
+        """
+        try:
+            if not self.stream:
+                for thing in parse_zone_text(self.bind_file.read(),
+                                            self.fast_parse):
+                    yield thing
+                return
+            chunk_lines = get_numeric_setting('zone_stream_chunk_lines', int)
+            for text, line_offset in _zone_text_chunks(self.bind_file,
+                                                        chunk_lines):
+                self._line_offset = line_offset
+                things = parse_zone_text(text, self.fast_parse, line_offset)
+                for thing in things:
+                    if (line_offset and isinstance(thing, dict)
+                            and thing.get('rdata_pyparsing')):
+                        thing['rdata_pyparsing']['line_offset'] = line_offset
+                    yield thing
+                del things
+        finally:
+            self.close()
+
+    def _stream_pyparsing(self, pyparsing):
+        """
+        Cut rdata_pyparsing down to the line of zone file text it refers
+        to, so that chunks of a streamed zone file are not kept around for
+        error reporting.
+        """
+        s = pyparsing['s']
+        loc = pyparsing['loc']
+        start = s.rfind('\n', 0, loc) + 1
+        if s is not self._chunk_s or start < self._chunk_pos:
+            self._chunk_s = s
+            self._chunk_pos = 0
+            self._chunk_lineno = self._line_offset
+        self._chunk_lineno += s.count('\n', self._chunk_pos, start)
+        self._chunk_pos = start
+        end = s.find('\n', loc)
+        end = len(s) if end < 0 else end + 1
+        return {'s': s[start:end], 'loc': loc - start,
+                'line_offset': self._chunk_lineno}
+
+    def rr_groups(self):
+        """
+        Generator giving RR groups as they are parsed from the zone file
+        """
+        name = self.name
+        # Loop data variables
+        in_rr_group = False
+        comment_rr = None
+        comment_rrflags = None
+        comment_group = None
+        previous_label = None
+        origin = name if name else None
+        ttl_seen = False
+        ttl = None
+        in_rr_prologue = True
+        rr_group = {'rrs':[]}
+        for thing in self._zone_things():
+            if (isinstance(thing, dict)
+                    and thing['type'] == '$ORIGIN'):
+                _validate_pyparsing_hostname(name, thing, thing['origin'])
+                origin = thing['origin']
+                continue
+
+            if (isinstance(thing, dict)
+                    and thing['type'] == '$TTL'):
+                if ttl_seen:
+                    raise TtlInWrongPlace(name, thing, self.file_name)
+                _validate_pyparsing_ttl(name, thing, thing['ttl'])
+                ttl_seen = True
+                self.zi_data['zone_ttl'] = thing['ttl']
+                continue
+
+            if (isinstance(thing, dict)
+                    and thing['type'] == '$INCLUDE'):
+                raise IncludeNotSupported(name, thing)
+
+            if (isinstance(thing, dict)
+                    and thing['type'] == '$GENERATE'):
+                raise GenerateNotSupported(name, thing)
+
+            if (isinstance(thing, dict)
+                    and thing['type'] == '$UPDATE_TYPE'):
+                if not self.update_mode:
+                    raise UpdateTypeNotSupported(name, thing)
+                self.update_type = thing['update_type']
+
+            if (isinstance(thing, dict) 
+                    and thing['type'] == 'comment_rr'):
+                #Process an  RR comment
+                comment_rr = thing
+                comment_rr.pop('comment_type', None)
+                continue
             
-            # Unpack and decode rdata from pyparsing
-            # This gives us the file location and output line showing position
-            # for any rdata exceptions we throw later in 
-            # dms.database.resource_record.data_to_rr()
-            if thing.get('rdata'):
-                rdata = thing['rdata']
-                if isinstance(rdata, dict):
-                    rr['rdata'] = rdata.get('rdata')
-                    rr['rdata_pyparsing'] = rdata.get('pyparsing')
+            if (isinstance(thing, dict) 
+                    and thing['type'] == 'comment_rrflags'):
+                #Process rr_flags
+                comment_rrflags = thing
+                comment_rrflags.pop('comment_type', None)
+                continue
+
+            if (isinstance(thing, dict)
+                    and thing['type'] == 'comment_group'):
+                #Process a group comment
+                comment_group = thing
+                comment_group.pop('comment_type', None)
+                if not in_rr_group:
+                    # Start New RR Group from previous blank lines
+                    in_rr_group = True
+                    rr_group.update(comment_group)
                 else:
-                    rr[rdata] = rdata
-                if rr['update_op'] == RROP_DELETE:
-                    # For delete update_op, transliterate rdata strings
-                    if rdata_re_null.search(rr['rdata']):
-                        rr['rdata'] = None
-                        
-
-            # Do type, class, and ttl
-            for key in ('type', 'class', 'ttl'):
-                if thing.get(key):
-                    rr[key] = thing[key]
-            # Add rr to rr_group and rr_list
-            rr_group['rrs'].append(rr)
-            rr_list.append(rr) 
+                    # Start new RR_Group
+                    yield rr_group
+                    rr_group = {'rrs':[]}
+                    rr_group.update(comment_group)
+                continue
+
+            if isinstance(thing, (ParseResults, FastParseRR)):
+                # $TTL should have happened by now
+                ttl_seen = True
+                if in_rr_prologue:
+                    in_rr_prologue = False
+                    # if no name, should have seen $ORIGIN by now
+                    if origin and self.use_origin_as_name:
+                        self.name = name = origin
+                    self.check_name_defined()
+
+                # Start process RRs
+                if not in_rr_group:
+                    in_rr_group = True
+                # Process an RR
+                rr = {}
+                # Have to break down to keys we accept  - security
+                # Sort out RR label - if none, use last seen value of label
+                rr['label'] = thing.get('label')
+                if not rr['label']:
+                    if not previous_label:
+                        # This should not happen!
+                        # This error is feature specific to the parser
+                        # design, and should be raised here
+                        raise NoPreviousLabelParseError(domain=name)
+                    rr['label'] = previous_label
+                else:
+                    previous_label = rr['label']
+
+                # Apply $ORIGIN to label.  This will be relativized when 
+                # actual RR object is created.
+                if origin and not rr['label'].endswith('.'):
+                    if rr['label'] == '@':
+                        rr['label'] = origin
+                    else:
+                        rr['label'] = '.'.join((rr['label'],origin))
+
+                # Add preceding rr_flags and comment_rr to RR
+                if comment_rr:
+                    rr.update(comment_rr)
+                    comment_rr = None
+
+                # Decode rr_flags
+                rr['lock_ptr'] = False
+                rr['disable'] = False 
+                rr['force_reverse'] = False 
+                rr['track_reverse'] = False 
+                rr['reference'] = None 
+                rr['update_op'] = None
+                if comment_rrflags:
+                    rr_flags = comment_rrflags['rr_flags'].strip()
+                    if rr_flags.find(settings['rr_flag_forcerev']) >= 0:
+                        rr['force_reverse'] = True 
+                    if rr_flags.find(settings['rr_flag_trackrev']) >= 0:
+                        rr['track_reverse'] = True 
+                    if rr_flags.find(settings['rr_flag_lockptr']) >= 0 :
+                        rr['lock_ptr'] = True 
+                    if rr_flags.find(settings['rr_flag_disable']) >= 0 :
+                        rr['disable'] = True 
+                    rr_flags = rr_flags.split()
+                    for rr_flag in rr_flags:
+                        if not (rr_flag.find(settings['rr_flag_ref']) >= 0):
+                            continue
+                        reference = rr_flag[len(settings['rr_flag_ref']):]
+                        if (thing.get('type') 
+                                and thing['type'] == RRTYPE_SOA
+                                and not rr['disable']):
+                            self.zone_reference = reference
+                            break
+                        rr['reference'] = reference
+                        break
+                    for rr_flag in rr_flags:
+                        if not (rr_flag.find(settings['rr_flag_rrop']) >= 0):
+                            continue
+                        update_op = rr_flag[len(settings['rr_flag_rrop']):]
+                        if not self.update_mode:
+                            raise RropNotSupported(name, comment_rrflags)
+                        rr['update_op'] = update_op
+                        break
+                    comment_rrflags = None
+                
+                # Unpack and decode rdata from pyparsing
+                # This gives us the file location and output line showing
+                # position for any rdata exceptions we throw later in 
+                # dms.database.resource_record.data_to_rr()
+                if thing.get('rdata'):
+                    rdata = thing['rdata']
+                    if isinstance(rdata, dict):
+                        rr['rdata'] = rdata.get('rdata')
+                        rr['rdata_pyparsing'] = rdata.get('pyparsing')
+                        if self.stream and rr['rdata_pyparsing']:
+                            rr['rdata_pyparsing'] = self._stream_pyparsing(
+                                                    rr['rdata_pyparsing'])
+                    else:
+                        rr[rdata] = rdata
+                    if rr['update_op'] == RROP_DELETE:
+                        # For delete update_op, transliterate rdata strings
+                        if rdata_re_null.search(rr['rdata']):
+                            rr['rdata'] = None
+                            
+
+                # Do type, class, and ttl
+                for key in ('type', 'class', 'ttl'):
+                    if thing.get(key):
+                        rr[key] = thing[key]
+                # Add rr to rr_group, and note first SOA for sorting out
+                # zi_data SOA fields
+                rr_group['rrs'].append(rr)
+                if not self.rr_soa and rr['type'] == RRTYPE_SOA:
+                    self.rr_soa = rr
+                continue
+
+            if thing == '\n':
+                # Process a blank line
+                if in_rr_group:
+                    in_rr_group = False
+                    # Give rr_group to caller
+                    yield rr_group
+                    rr_group = {'rrs':[]}
+                continue
+
+            # We don't care bout this 'thing'
             continue
-
-        if thing == '\n':
-            # Process a blank line
+        else:
+            # clean up - if this is not done, not ending in a blank line
+            # will lose records....
             if in_rr_group:
-                in_rr_group = False
-                # Add rr_group to list of rr_groups
-                zi_data['rr_groups'].append(rr_group)
-                rr_group = {'rrs':[]}
-            continue
-
-        # We don't care bout this 'thing'
-        continue
-    else:
-        # clean up - if this is not done, not ending in a blank line will
-        # lose records....
-        if in_rr_group:
-             # Add rr_group to list of rr_groups
-             zi_data['rr_groups'].append(rr_group)
+                 # Give rr_group to caller
+                 yield rr_group
         
-    # Fill in zi_data fields from SOA. Use first SOA found.  Will check
-    # for duplicate SOA further in, as that may be recieved from DMI/DMS
-    rr_soas = [rr for rr in rr_list if rr['type'] == RRTYPE_SOA]
-    if not rr_soas:
-        # Leave early as this might just be a zone file being loaded for
-        # a use_apex_ns zone, in which case this does not matter
-        check_name_defined()
-        return (zi_data, name, update_type, zone_reference)
-    rr_soa = rr_soas.pop(0)
-    # Determine zone name if use_origin_as_name is set, by looking at SOA
-    # record label
-    if use_origin_as_name:
-        if rr_soa['label'][-1] == '.':
-            name = rr_soa['label']
-
-    check_name_defined()
-    
-    zi_data['soa_ttl'] = rr_soa.get('ttl')
-    # Parse SOA Rdata
-    soa_rdata = rr_soa['rdata'].split()
-    num_values = len(soa_rdata)
-    if (num_values != 7):
-        raise Not7ValuesSOAParseError(name,
-                rr_soa)
-    error_info = ''
-    try:
-        zi_data['soa_serial'] = int(soa_rdata[2])
-    except ValueError as exc:
-        error_info = str(exc)
-    if error_info:
-        raise SOASerialMustBeInteger(name,
-                rr_soa)
-    zi_data['soa_mname'] = soa_rdata[0]
-    zi_data['soa_rname'] = soa_rdata[1]
-    zi_data['soa_refresh'] = soa_rdata[3]
-    zi_data['soa_retry'] = soa_rdata[4]
-    zi_data['soa_expire'] = soa_rdata[5]
-    zi_data['soa_minimum'] = soa_rdata[6]
-
-    return (zi_data, name, update_type, zone_reference)
-
-
-
-
+    def finish(self, set_name=True):
+        """
+        Fill in zi_data fields from SOA. Use first SOA found.  Will check
+        for duplicate SOA further in, as that may be recieved from DMI/DMS
 
+        Returns (zi_data, name, update_type, zone_reference)
+        """
+        zi_data = self.zi_data
+        rr_soa = self.rr_soa
+        if not rr_soa or self.soa_done:
+            # Leave early as this might just be a zone file being loaded for
+            # a use_apex_ns zone, in which case this does not matter
+            self.check_name_defined()
+            return (zi_data, self.name, self.update_type, self.zone_reference)
+        # Determine zone name if use_origin_as_name is set, by looking at SOA
+        # record label
+        if self.use_origin_as_name and set_name:
+            if rr_soa['label'][-1] == '.':
+                self.name = rr_soa['label']
+        name = self.name
+
+        self.check_name_defined()
+        
+        zi_data['soa_ttl'] = rr_soa.get('ttl')
+        # Parse SOA Rdata
+        soa_rdata = rr_soa['rdata'].split()
+        num_values = len(soa_rdata)
+        if (num_values != 7):
+            raise Not7ValuesSOAParseError(name,
+                    rr_soa)
+        error_info = ''
+        try:
+            zi_data['soa_serial'] = int(soa_rdata[2])
+        except ValueError as exc:
+            error_info = str(exc)
+        if error_info:
+            raise SOASerialMustBeInteger(name,
+                    rr_soa)
+        zi_data['soa_mname'] = soa_rdata[0]
+        zi_data['soa_rname'] = soa_rdata[1]
+        zi_data['soa_refresh'] = soa_rdata[3]
+        zi_data['soa_retry'] = soa_rdata[4]
+        zi_data['soa_expire'] = soa_rdata[5]
+        zi_data['soa_minimum'] = soa_rdata[6]
+        self.soa_done = True
+
+        return (zi_data, name, self.update_type, self.zone_reference)
 
+def bind_to_data(bind_file, name=None, use_origin_as_name=False, 
+                    update_mode=False, fast_parse=None):
+    """
+    Construct zi_data, taking a bind file as input.  Can be a string, 
+    or file handle.
+    """
+    parser = BindDataParser(bind_file, name, use_origin_as_name, update_mode,
+                            fast_parse)
+    # Turn parse result into a JSON zi data structure
+    parser.zi_data['rr_groups'] = list(parser.rr_groups())
+    return parser.finish()
 
+def bind_to_data_stream(bind_file, name=None, use_origin_as_name=False,
+                    fast_parse=None):
+    """
+    Streaming version of bind_to_data(), for very large zone files.
+
+    zi_data['rr_groups'] is an iterator giving RR groups as the zone file
+    is read and parsed, so that the whole file, its parse results and the
+    zi_data RR groups are never all held in memory at once.  RR groups are
+    read ahead until the SOA record is found, or 'zone_stream_batch_rrs'
+    RRs have been read, to fill in the returned zone name and reference,
+    and the zi_data SOA fields.  A later SOA record fills in the zi_data
+    SOA fields when the iterator gets to it, but does not change the name.
+    """
+    parser = BindDataParser(bind_file, name, use_origin_as_name,
+                            fast_parse=fast_parse, stream=True)
+    lookahead_rrs = get_numeric_setting('zone_stream_batch_rrs', int)
+    rr_groups = parser.rr_groups()
+    lookahead = []
+    rr_count = 0
+    for rr_group in rr_groups:
+        lookahead.append(rr_group)
+        rr_count += len(rr_group['rrs'])
+        if parser.rr_soa or rr_count >= lookahead_rrs:
+            break
+    result = parser.finish()
+
+    def stream_rr_groups():
+        while lookahead:
+            yield lookahead.pop(0)
+        for rr_group in rr_groups:
+            yield rr_group
+        parser.finish(set_name=False)
+
+    parser.zi_data['rr_groups'] = stream_rr_groups()
+    return result
+
+
+# Test/Benchmark by using:  from dms.zone_text_util import *
+#                           test_data_to_bind()
+#                           benchmark_data_to_bind()
+def _test_rr(label, type_, rdata, ttl=None, comment=None, **flags):
+    """
+    RR data for testing data_to_bind()
+    """
+    rr = {'label': label, 'type': type_, 'class': 'IN', 'ttl': ttl,
+            'rdata': rdata, 'comment': comment, 'lock_ptr': False,
+            'disable': False, 'track_reverse': False, 'reference': None}
+    rr.update(flags)
+    return rr
 
+def _test_data_to_bind_data():
+    """
+    zi_data for testing data_to_bind()
+    """
+    return {'zone_ttl': '24h', 'zi_id': 42, 'rr_groups': [
+        {'tag': settings['apex_rr_tag'], 'comment': None, 'rrs': [
+            _test_rr('@', 'SOA', 'ns1.example.org. hostmaster.example.org.'
+                                ' 2013010100 600 600 604800 600'),
+            _test_rr('@', 'NS', 'ns1.example.org.', 
+                                comment='Master name server'),
+            _test_rr('@', 'MX', '10 mail.example.org.', ttl='1h')]},
+        {'comment': 'Web servers, with a comment long enough to need'
+                    ' wrapping by TextWrapper', 'rrs': [
+            _test_rr('www', 'A', '192.0.2.1', lock_ptr=True,
+                                track_reverse=True),
+            _test_rr('www', 'AAAA', '2001:db8::1', disable=True,
+                                reference='ACME'),
+            _test_rr('ftp', 'CNAME', 'www', comment='Line one\nLine two\n')]},
+        {'rrs': [_test_rr('mail', 'A', '192.0.2.25', 
+                                comment='\ttabbed  comment ')]}]}
+
+_test_data_to_bind_text = (
+    "$TTL 24h\n"
+    "$ORIGIN example.org.\n"
+    "\n"
+    ";\n"
+    "; Zone:       example.org.\n"
+    "; Reference:  ACME\n"
+    "; zi_id:      42\n"
+    ";\n"
+    "\n"
+    "\n"
+    ";!REF:ACME\n"
+    "@                       IN      SOA             ( ns1.example.org. ;Master NS\n"
+    "                                                hostmaster.example.org. ;RP email\n"
+    "                                                2013010100   ;Serial yyyymmddnn\n"
+    "                                                600          ;Refresh\n"
+    "                                                600          ;Retry\n"
+    "                                                604800       ;Expire\n"
+    "                                                600          ;Minimum/Ncache\n"
+    "                                                )           \n"
+    ";# Master name server\n"
+    "                        IN      NS              ns1.example.org.\n"
+    "                1h      IN      MX              10 mail.example.org.\n"
+    "\n"
+    "\n"
+    ";| Web servers, with a comment long enough to need wrapping by\n"
+    ";| TextWrapper\n"
+    ";# Line one\n"
+    ";# Line two\n"
+    "ftp                     IN      CNAME           www\n"
+    ";!LOCKPTR TRACKREV\n"
+    "www                     IN      A               192.0.2.1\n"
+    ";!DISABLE REF:ACME\n"
+    ";                       IN      AAAA            2001:db8::1\n"
+    "\n"
+    "\n"
+    ";#         tabbed  comment\n"
+    "mail                    IN      A               192.0.2.25\n"
+    "\n"
+    "\n"
+    )
+
+def test_data_to_bind():
+    """
+    Check data_to_bind() output against known zone file text, written to
+    a string, a file and a file descriptor.
+    """
+    def render(file=None):
+        return data_to_bind(_test_data_to_bind_data(), name='example.org.',
+                reference='ACME', for_bind=True, file=file)
+
+    results = {'string': render()}
+    file_ = StringIO()
+    render(file_)
+    results['file'] = file_.getvalue()
+    (fd, tmp_filename) = tempfile.mkstemp()
+    try:
+        render(fd)
+        os.close(fd)
+        with open(tmp_filename, newline='') as tmp_file:
+            results['fd'] = tmp_file.read()
+    finally:
+        os.unlink(tmp_filename)
+    for output in sorted(results):
+        if results[output] != _test_data_to_bind_text:
+            raise AssertionError('data_to_bind() %s output differs from '
+                                    'expected zone text' % output)
+    print('data_to_bind() test passed')
+
+def benchmark_data_to_bind(sizes=(1000, 10000, 100000), group_rrs=50):
+    """
+    Print data_to_bind() time against zone size, rendering to a string
+    and to a file descriptor.
+    """
+    for size in sizes:
+        zi_data = _test_data_to_bind_data()
+        for i in range(0, size, group_rrs):
+            zi_data['rr_groups'].append({'comment': 'Group %s' % i, 
+                'rrs': [_test_rr('host%s' % j, 'A', 
+                            '10.%s.%s.%s' % (j >> 16, (j >> 8) & 255, j & 255),
+                            comment='Host %s' % j if j % 10 == 0 else None)
+                        for j in range(i, min(i + group_rrs, size))]})
+        start = time.time()
+        data_to_bind(zi_data)
+        string_elapsed = time.time() - start
+        (fd, tmp_filename) = tempfile.mkstemp()
+        try:
+            start = time.time()
+            data_to_bind(zi_data, file=fd)
+            fd_elapsed = time.time() - start
+            os.close(fd)
+        finally:
+            os.unlink(tmp_filename)
+        print('%8s RRs: %8.3f s to string, %8.3f s to fd - %8.1f RRs/s'
+                % (size, string_elapsed, fd_elapsed, size/string_elapsed))
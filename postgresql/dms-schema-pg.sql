@@ -173,6 +173,24 @@ $$;
 
 ALTER FUNCTION public.delete_associated_rr() OWNER TO pgsql;
 
+--
+-- Name: reverse_networks_new_generation(); Type: FUNCTION; Schema: public; Owner: pgsql
+--
+
+CREATE FUNCTION reverse_networks_new_generation() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+  BEGIN
+    -- New generation value is never reused, even after a rollback
+    UPDATE reverse_networks_generation
+        SET generation = nextval('reverse_networks_generation_seq');
+    RETURN NULL;
+  END;
+$$;
+
+
+ALTER FUNCTION public.reverse_networks_new_generation() OWNER TO pgsql;
+
 --
 -- Name: sm_servers_update_mtime_column(); Type: FUNCTION; Schema: public; Owner: pgsql
 --
@@ -360,7 +378,8 @@ CREATE TABLE resource_records (
     ref_id bigint,
     update_op character varying(60),
     ug_id bigint,
-    track_reverse boolean DEFAULT false
+    track_reverse boolean DEFAULT false,
+    rr_hash character varying(40)
 );
 
 
@@ -421,6 +440,39 @@ ALTER TABLE public.reverse_networks_id_seq OWNER TO pgsql;
 ALTER SEQUENCE reverse_networks_id_seq OWNED BY reverse_networks.id;
 
 
+--
+-- Name: reverse_networks_generation; Type: TABLE; Schema: public; Owner: pgsql; Tablespace: 
+--
+
+CREATE TABLE reverse_networks_generation (
+    generation bigint NOT NULL
+);
+
+
+ALTER TABLE public.reverse_networks_generation OWNER TO pgsql;
+
+--
+-- Name: reverse_networks_generation_seq; Type: SEQUENCE; Schema: public; Owner: pgsql
+--
+
+CREATE SEQUENCE reverse_networks_generation_seq
+    START WITH 1
+    INCREMENT BY 1
+    NO MINVALUE
+    NO MAXVALUE
+    CACHE 1;
+
+
+ALTER TABLE public.reverse_networks_generation_seq OWNER TO pgsql;
+
+--
+-- Data for Name: reverse_networks_generation; Type: TABLE DATA; Schema: public; Owner: pgsql
+--
+
+INSERT INTO reverse_networks_generation (generation)
+    VALUES (nextval('reverse_networks_generation_seq'));
+
+
 --
 -- Name: rr_comments; Type: TABLE; Schema: public; Owner: pgsql; Tablespace: 
 --
@@ -1285,6 +1337,20 @@ CREATE INDEX resource_records_ug_id_idx ON resource_records USING btree (ug_id);
 CREATE INDEX resource_records_zi_id_idx ON resource_records USING btree (zi_id);
 
 
+--
+-- Name: resource_records_zi_id_lower_label_idx; Type: INDEX; Schema: public; Owner: pgsql; Tablespace: 
+--
+
+CREATE INDEX resource_records_zi_id_lower_label_idx ON resource_records USING btree (zi_id, lower(label));
+
+
+--
+-- Name: resource_records_zi_id_rr_hash_idx; Type: INDEX; Schema: public; Owner: pgsql; Tablespace: 
+--
+
+CREATE INDEX resource_records_zi_id_rr_hash_idx ON resource_records USING btree (zi_id, rr_hash);
+
+
 --
 -- Name: rr_comments_tag_idx; Type: INDEX; Schema: public; Owner: pgsql; Tablespace: 
 --
@@ -1621,6 +1687,13 @@ CREATE TRIGGER delete_associated_comment AFTER DELETE ON resource_records FOR EA
 CREATE TRIGGER delete_associated_reference AFTER DELETE ON sm_zone FOR EACH ROW EXECUTE PROCEDURE delete_associated_reference();
 
 
+--
+-- Name: reverse_networks_new_generation; Type: TRIGGER; Schema: public; Owner: pgsql
+--
+
+CREATE TRIGGER reverse_networks_new_generation AFTER INSERT OR DELETE OR UPDATE OR TRUNCATE ON reverse_networks FOR EACH STATEMENT EXECUTE PROCEDURE reverse_networks_new_generation();
+
+
 --
 -- Name: sm_servers_update_mtime; Type: TRIGGER; Schema: public; Owner: pgsql
 --
@@ -1905,6 +1978,26 @@ GRANT ALL ON SEQUENCE reverse_networks_id_seq TO pgsql;
 GRANT USAGE ON SEQUENCE reverse_networks_id_seq TO dms;
 
 
+--
+-- Name: reverse_networks_generation; Type: ACL; Schema: public; Owner: pgsql
+--
+
+REVOKE ALL ON TABLE reverse_networks_generation FROM PUBLIC;
+REVOKE ALL ON TABLE reverse_networks_generation FROM pgsql;
+GRANT ALL ON TABLE reverse_networks_generation TO pgsql;
+GRANT SELECT,UPDATE ON TABLE reverse_networks_generation TO dms;
+
+
+--
+-- Name: reverse_networks_generation_seq; Type: ACL; Schema: public; Owner: pgsql
+--
+
+REVOKE ALL ON SEQUENCE reverse_networks_generation_seq FROM PUBLIC;
+REVOKE ALL ON SEQUENCE reverse_networks_generation_seq FROM pgsql;
+GRANT ALL ON SEQUENCE reverse_networks_generation_seq TO pgsql;
+GRANT USAGE ON SEQUENCE reverse_networks_generation_seq TO dms;
+
+
 --
 -- Name: rr_comments; Type: ACL; Schema: public; Owner: pgsql
 --
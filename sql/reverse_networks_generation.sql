@@ -0,0 +1,46 @@
+--
+-- Copyright (c) Net24 Limited, Christchurch, New Zealand 2011-2012
+--       and     Voyager Internet Ltd, New Zealand, 2012-2013
+--
+--    This file is part of py-magcode-core.
+--
+--    Py-magcode-core is free software: you can redistribute it and/or modify
+--    it under the terms of the GNU  General Public License as published
+--    by the Free Software Foundation, either version 3 of the License, or
+--    (at your option) any later version.
+--
+--    Py-magcode-core is distributed in the hope that it will be useful,
+--    but WITHOUT ANY WARRANTY; without even the implied warranty of
+--    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+--    GNU  General Public License for more details.
+--
+--    You should have received a copy of the GNU  General Public License
+--    along with py-magcode-core.  If not, see <http://www.gnu.org/licenses/>.
+-- Reverse network generation counter.  Bumped by a trigger whenever
+-- reverse_networks changes, so that each process can check its reverse
+-- network trie is current.
+CREATE SEQUENCE reverse_networks_generation_seq;
+GRANT USAGE ON SEQUENCE reverse_networks_generation_seq TO dms;
+
+CREATE TABLE reverse_networks_generation (
+	generation bigint NOT NULL
+);
+GRANT SELECT,UPDATE ON TABLE reverse_networks_generation TO dms;
+INSERT INTO reverse_networks_generation (generation)
+	VALUES (nextval('reverse_networks_generation_seq'));
+
+CREATE OR REPLACE FUNCTION reverse_networks_new_generation() 
+        RETURNS TRIGGER AS '
+  BEGIN
+    -- New generation value is never reused, even after a rollback
+    UPDATE reverse_networks_generation
+        SET generation = nextval(''reverse_networks_generation_seq'');
+    RETURN NULL;
+  END;
+' LANGUAGE 'plpgsql';
+
+DROP TRIGGER IF EXISTS reverse_networks_new_generation ON reverse_networks;
+CREATE TRIGGER reverse_networks_new_generation 
+	AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON reverse_networks
+	FOR EACH STATEMENT
+	EXECUTE PROCEDURE reverse_networks_new_generation();
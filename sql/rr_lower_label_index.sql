@@ -0,0 +1,23 @@
+--
+-- Copyright (c) Net24 Limited, Christchurch, New Zealand 2011-2012
+--       and     Voyager Internet Ltd, New Zealand, 2012-2013
+--
+--    This file is part of py-magcode-core.
+--
+--    Py-magcode-core is free software: you can redistribute it and/or modify
+--    it under the terms of the GNU  General Public License as published
+--    by the Free Software Foundation, either version 3 of the License, or
+--    (at your option) any later version.
+--
+--    Py-magcode-core is distributed in the hope that it will be useful,
+--    but WITHOUT ANY WARRANTY; without even the implied warranty of
+--    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+--    GNU  General Public License for more details.
+--
+--    You should have received a copy of the GNU  General Public License
+--    along with py-magcode-core.  If not, see <http://www.gnu.org/licenses/>.
+
+-- Index RR labels case insensitively within a ZI, for reading in the RRs
+-- of the labels an incremental update touches.
+CREATE INDEX resource_records_zi_id_lower_label_idx ON resource_records 
+	USING btree (zi_id, lower(label));